@@ -0,0 +1,53 @@
+"""Node problems solved in matrix form (HiGHS through SciPy) against the
+Pyomo models solved by `solver`, on the bundled examples and generated
+trees.
+
+Both backends solve the same problems, so they reach the same bounds; the
+difference is the time. The matrix backend is faster where most of the time
+goes into Pyomo: the production trees, whose many small linear problems it
+solves 4 to 5 times faster than `appsi_highs`, and less so the wildfire
+trees with Lagrangian cuts, whose subproblems still go through Pyomo.
+
+Usage:
+    python benchmarks/backends.py [solver]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import cut_families, generators, stabilization  # noqa: E402
+from ndusc import nd  # noqa: E402
+
+CASES = stabilization.CASES + [
+    (name, generate, 'lagrangian') for name, generate in cut_families.CASES]
+
+
+def main(solver='appsi_highs'):
+    # The model files of the bundled trees are relative to the root
+    os.chdir(generators.ROOT)
+    print('{:>18} {:>6} {:>7} {:>9} {:>5} {:>7} {:>8} {:>10}'.format(
+        'case', 'nodes', 'backend', 'status', 'iter', 'solves', 'time',
+        'objective'))
+    for case in CASES:
+        name, generate = case[:2]
+        cut_family = case[2] if len(case) > 2 else 'benders'
+        tree, data = generate()
+        for backend in ('pyomo', 'matrix'):
+            start = time.time()
+            output = nd.nested_decomposition(tree, data, solver=solver,
+                                             max_iter=200,
+                                             cut_family=cut_family,
+                                             backend=backend)
+            print('{:>18} {:>6} {:>7} {:>9} {:>5} {:>7} {:>8.2f} '
+                  '{:>10.4f}'.format(
+                      name, len(tree['nodes']), backend, output['status'],
+                      output['iterations'], output['solves'],
+                      time.time() - start, output['upper_bound']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
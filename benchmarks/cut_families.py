@@ -0,0 +1,52 @@
+"""Benders, integer L-shaped, strengthened Benders and Lagrangian cuts on
+the wildfire example (binary first stage, integer recourse).
+
+Usage:
+    python benchmarks/cut_families.py [solver]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import generators  # noqa: E402
+from benchmarks.stabilization import bundled  # noqa: E402
+from ndusc import cuts, nd  # noqa: E402
+
+CASES = [
+    # (name, tree and data)
+    ('wildfire', lambda: bundled('data')),
+    ('wildfire-s10-r5', lambda: (
+        generators.wildfire_tree(10), generators.wildfire_data(5))),
+    ('wildfire-s10-r7', lambda: (
+        generators.wildfire_tree(10), generators.wildfire_data(7))),
+    ('wildfire-s30-r5', lambda: (
+        generators.wildfire_tree(30), generators.wildfire_data(5))),
+]
+
+
+def main(solver='appsi_highs'):
+    # The model files of the bundled trees are relative to the root
+    os.chdir(generators.ROOT)
+    print('{:>18} {:>6} {:>12} {:>9} {:>5} {:>7} {:>8} {:>10} {:>10}'.format(
+        'case', 'nodes', 'family', 'status', 'iter', 'solves', 'time',
+        'lower', 'upper'))
+    for name, generate in CASES:
+        tree, data = generate()
+        for family in cuts.cut_families:
+            start = time.time()
+            output = nd.nested_decomposition(tree, data, solver=solver,
+                                             max_iter=150, cut_family=family)
+            print('{:>18} {:>6} {:>12} {:>9} {:>5} {:>7} {:>8.2f} {:>10.4f} '
+                  '{:>10.4f}'.format(
+                      name, len(tree['nodes']), family, output['status'],
+                      output['iterations'], output['solves'],
+                      time.time() - start, output['lower_bound'],
+                      output['upper_bound']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
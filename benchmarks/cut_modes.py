@@ -0,0 +1,52 @@
+"""Single, multi and hybrid optimality cuts on the production example.
+
+Usage:
+    python benchmarks/cut_modes.py [solver]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import generators  # noqa: E402
+from ndusc import nd  # noqa: E402
+
+CASES = [
+    # (branching, stages, production capacity, demand range)
+    (2, 3, 2, (1, 5)),
+    (3, 4, 3, (0, 6)),
+    (2, 5, 3, (0, 8)),
+    (6, 3, 4, (0, 9)),
+    (30, 3, 4, (0, 9)),
+]
+
+MODES = [
+    ('single', None),
+    ('hybrid', 3),
+    ('multi', None),
+]
+
+
+def main(solver='appsi_highs'):
+    print('{:>9} {:>6} {:>6} {:>8} {:>5} {:>6} {:>8} {:>10}'.format(
+        'branching', 'stages', 'nodes', 'mode', 'k', 'iter', 'time',
+        'objective'))
+    for branching, stages, prod, demands in CASES:
+        for mode, k in MODES:
+            tree = generators.production_tree(branching, stages,
+                                              demands=demands)
+            start = time.time()
+            output = nd.nested_decomposition(
+                tree, generators.production_data(prod), solver=solver,
+                cut_mode=mode, cut_clusters=k)
+            print('{:>9} {:>6} {:>6} {:>8} {:>5} {:>6} {:>8.2f} {:>10.4f}'
+                  .format(branching, stages, len(tree['nodes']), mode,
+                          k or '', output['iterations'], time.time() - start,
+                          output['upper_bound']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
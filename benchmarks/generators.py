@@ -0,0 +1,159 @@
+"""Generators of scaled versions of the bundled examples."""
+
+import os
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST1 = os.path.join(ROOT, 'tests', 'test1')
+LEE = os.path.join(ROOT, 'data')
+
+# Resources of the wildfire example (`data/data.yaml`): C, P, A, PR
+RESOURCES = {
+    'Dozer': (175, 300, 2, 0.36),
+    'Tractor': (150, 500, 2.5, 0.45),
+    'Grupo_I': (125, 500, 0.5, 0.20),
+    'Grupo_II': (175, 600, 1, 0.25),
+    'Maquina_I': (75, 400, 1.5, 0.09),
+    'Maquina_II': (100, 900, 1.5, 0.1),
+    'Maquina_III': (125, 600, 1, 0.15),
+}
+
+
+def production_tree(branching=2, stages=3, seed=0, demands=(1, 5)):
+    """Tree of the Birge & Louveaux production example (`tests/test1`).
+
+    Every node has `branching` equiprobable children, up to `stages` stages,
+    and a random integer demand in `demands`.
+
+    Return:
+        :obj:`dict`: tree information, as loaded from a `tree.yaml` file.
+    """
+    rng = np.random.RandomState(seed)
+    nodes = [_production_node(1, None, 1, 1.0, rng, demands)]
+    stage_nodes = [nodes[0]]
+    for stage in range(2, stages + 1):
+        new_nodes = []
+        for parent in stage_nodes:
+            for b in range(branching):
+                new_nodes.append(_production_node(
+                    len(nodes) + len(new_nodes) + 1, parent['id'], stage,
+                    parent['probability'] / branching, rng, demands))
+        nodes.extend(new_nodes)
+        stage_nodes = new_nodes
+    return {'nodes': nodes}
+
+
+def production_stages(stages=3, outcomes=2, seed=0, demands=(1, 5)):
+    """Stages of the production example for :mod:`ndusc.sddp`.
+
+    Every stage but the first has `outcomes` equiprobable random integer
+    demands in `demands`.
+
+    Return:
+        :obj:`dict`: stages information, as loaded from a `stages.yaml`
+        file.
+    """
+    rng = np.random.RandomState(seed)
+    first = _production_node(1, None, 1, 1.0, rng, demands)
+    result = [{'stage': 1, 'model': first['model'],
+               'params': first['params']}]
+    for stage in range(2, stages + 1):
+        node = _production_node(stage, stage - 1, stage, 1.0, rng, demands)
+        result.append({
+            'stage': stage,
+            'model': node['model'],
+            'outcomes': [
+                {'probability': 1.0 / outcomes,
+                 'params': {'demand': int(rng.randint(demands[0],
+                                                      demands[1] + 1))}}
+                for k in range(outcomes)],
+        })
+    return {'stages': result}
+
+
+def production_data(prod=2):
+    """Data of the production example with production capacity `prod`."""
+    return {'sets': None,
+            'params': {'prod': prod, 'cost': 1, 'high_cost': 3,
+                       'store_cost': 0.5}}
+
+
+def _production_node(nodeid, prev_id, stage, probability, rng, demands):
+    node = {
+        'id': nodeid,
+        'prev_id': prev_id,
+        'stage': stage,
+        'probability': probability,
+        'model': {
+            'file': os.path.join(TEST1, 'model_S1.py'),
+            'function': 'model_S1',
+        },
+        'params': {'demand': int(rng.randint(demands[0], demands[1] + 1))},
+    }
+    if prev_id is not None:
+        node['model'] = {
+            'file': os.path.join(TEST1, 'model_S2.py'),
+            'function': 'model_S2',
+            'linking': {'y': 'y_prev'},
+        }
+    return node
+
+
+def wildfire_tree(scenarios=2, periods=6, seed=0):
+    """Tree of the wildfire example of Lee (`data`).
+
+    The root chooses the resources and each of its `scenarios` children is
+    a wildfire, with random increasing perimeters (`SP`) and costs (`NVC`)
+    over `periods` periods, around those of `data/tree.yaml`.
+
+    Return:
+        :obj:`dict`: tree information, as loaded from a `tree.yaml` file.
+    """
+    rng = np.random.RandomState(seed)
+    nodes = [{
+        'id': 1,
+        'prev_id': None,
+        'stage': 1,
+        'probability': 1.0,
+        'model': {'file': os.path.join(LEE, 'model_S1.py'),
+                  'function': 'model_S1'},
+    }]
+    for k in range(scenarios):
+        sp = np.cumsum(rng.uniform(0.1, 0.8, periods))
+        nvc = np.cumsum(rng.uniform(50, 700, periods))
+        nodes.append({
+            'id': k + 2,
+            'prev_id': 1,
+            'stage': 2,
+            'probability': 1.0 / scenarios,
+            'model': {'file': os.path.join(LEE, 'model_S2.py'),
+                      'function': 'model_S2'},
+            'params': {
+                'NVC': {j + 1: round(float(v)) for j, v in enumerate(nvc)},
+                'SP': {j + 1: round(float(v), 2) for j, v in enumerate(sp)},
+            },
+        })
+    return {'nodes': nodes}
+
+
+def wildfire_data(resources=7, periods=6, seed=0):
+    """Data of the wildfire example with `resources` resources.
+
+    The first resources are those of `data/data.yaml`, the others are
+    random resources in their ranges.
+    """
+    rng = np.random.RandomState(seed)
+    names = list(RESOURCES)[:resources]
+    values = [RESOURCES[name] for name in names]
+    low = np.min(list(RESOURCES.values()), axis=0)
+    high = np.max(list(RESOURCES.values()), axis=0)
+    for k in range(len(names), resources):
+        names.append('Resource_{}'.format(k + 1))
+        values.append(tuple(np.round(rng.uniform(low, high), 2).tolist()))
+    params = {'NumPer': periods,
+              'H': {j: j for j in range(1, periods + 1)}}
+    for c, param in enumerate(('C', 'P', 'A', 'PR')):
+        params[param] = {name: value[c]
+                         for name, value in zip(names, values)}
+    return {'sets': {'Resources': names}, 'params': params}
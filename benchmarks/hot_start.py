@@ -0,0 +1,45 @@
+"""Hot starts of the node solves (MIP starts and simplex bases) against
+solves from scratch, on the bundled examples and generated trees.
+
+Both runs solve the same problems, so they take the same iterations and
+solves; the difference is the time.
+
+Usage:
+    python benchmarks/hot_start.py [solver]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import generators  # noqa: E402
+from benchmarks.stabilization import CASES  # noqa: E402
+from ndusc import nd  # noqa: E402
+
+
+def main(solver='appsi_highs'):
+    # The model files of the bundled trees are relative to the root
+    os.chdir(generators.ROOT)
+    print('{:>18} {:>6} {:>5} {:>9} {:>5} {:>7} {:>8} {:>10}'.format(
+        'case', 'nodes', 'hot', 'status', 'iter', 'solves', 'time',
+        'objective'))
+    for name, generate in CASES:
+        tree, data = generate()
+        for hot_start in (False, True):
+            start = time.time()
+            output = nd.nested_decomposition(tree, data, solver=solver,
+                                             max_iter=200,
+                                             hot_start=hot_start)
+            print('{:>18} {:>6} {:>5} {:>9} {:>5} {:>7} {:>8.2f} '
+                  '{:>10.4f}'.format(
+                      name, len(tree['nodes']), 'yes' if hot_start else 'no',
+                      output['status'], output['iterations'],
+                      output['solves'], time.time() - start,
+                      output['upper_bound']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
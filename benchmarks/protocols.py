@@ -0,0 +1,45 @@
+"""FF, FB and FFFB sequencing protocols on deep production trees.
+
+Usage:
+    python benchmarks/protocols.py [solver]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import generators  # noqa: E402
+from ndusc import nd  # noqa: E402
+
+CASES = [
+    # (branching, stages, production capacity, demand range)
+    (2, 4, 3, (0, 6)),
+    (2, 6, 3, (0, 6)),
+    (2, 8, 3, (0, 6)),
+    (3, 5, 3, (0, 6)),
+    (4, 5, 4, (0, 9)),
+]
+
+
+def main(solver='appsi_highs'):
+    print('{:>9} {:>6} {:>6} {:>8} {:>6} {:>7} {:>8} {:>10}'.format(
+        'branching', 'stages', 'nodes', 'protocol', 'iter', 'solves', 'time',
+        'objective'))
+    for branching, stages, prod, demands in CASES:
+        tree = generators.production_tree(branching, stages, demands=demands)
+        for protocol in nd.protocols:
+            start = time.time()
+            output = nd.nested_decomposition(
+                tree, generators.production_data(prod), solver=solver,
+                protocol=protocol, max_iter=1000)
+            print('{:>9} {:>6} {:>6} {:>8} {:>6} {:>7} {:>8.2f} {:>10.4f}'
+                  .format(branching, stages, len(tree['nodes']), protocol,
+                          output['iterations'], output['solves'],
+                          time.time() - start, output['upper_bound']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
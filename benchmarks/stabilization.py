@@ -0,0 +1,88 @@
+"""Stabilization of the masters (proximal, trust region and level) against
+plain nested decomposition, on the bundled examples and generated trees.
+
+The iterations are the full passes over the tree; the solves include the
+extra solves of the stabilized masters.
+
+Usage:
+    python benchmarks/stabilization.py [solver]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import generators  # noqa: E402
+from ndusc import input_module, nd, stabilization  # noqa: E402
+
+
+def bundled(directory):
+    """Tree and data of the example in `directory` (relative to the root
+    of the repository)."""
+    loader = input_module.Input_module(
+        os.path.join(directory, 'data.yaml'),
+        os.path.join(directory, 'tree.yaml'))
+    return loader.load_tree(), loader.load_data()
+
+
+CASES = [
+    # (name, tree and data)
+    ('test1', lambda: bundled('tests/test1')),
+    ('wildfire', lambda: bundled('data')),
+    ('production-b3-s4', lambda: (
+        generators.production_tree(3, 4, demands=(0, 6)),
+        generators.production_data(3))),
+    ('production-b10-s3', lambda: (
+        generators.production_tree(10, 3, demands=(0, 6)),
+        generators.production_data(3))),
+    ('production-b2-s6', lambda: (
+        generators.production_tree(2, 6, demands=(0, 6)),
+        generators.production_data(3))),
+    ('production-b4-s4', lambda: (
+        generators.production_tree(4, 4, demands=(0, 9)),
+        generators.production_data(3))),
+    ('production-b6-s4', lambda: (
+        generators.production_tree(6, 4, demands=(0, 6)),
+        generators.production_data(3))),
+    ('wildfire-s100-r7', lambda: (
+        generators.wildfire_tree(100), generators.wildfire_data(7))),
+    ('wildfire-s10-r30', lambda: (
+        generators.wildfire_tree(10), generators.wildfire_data(30))),
+]
+
+METHODS = (None,) + stabilization.methods
+
+
+def main(solver='appsi_highs'):
+    # The model files of the bundled trees are relative to the root
+    os.chdir(generators.ROOT)
+    print('{:>18} {:>6} {:>12} {:>9} {:>5} {:>7} {:>6} {:>7} {:>5} {:>8} '
+          '{:>10}'.format('case', 'nodes', 'method', 'status', 'iter',
+                          'solves', 'stab', 'serious', 'null', 'time',
+                          'objective'))
+    for name, generate in CASES:
+        tree, data = generate()
+        for method in METHODS:
+            stabilizer = None
+            if method is not None:
+                stabilizer = stabilization.Stabilizer(method)
+            start = time.time()
+            output = nd.nested_decomposition(tree, data, solver=solver,
+                                             max_iter=200,
+                                             stabilize=stabilizer)
+            print('{:>18} {:>6} {:>12} {:>9} {:>5} {:>7} {:>6} {:>7} {:>5} '
+                  '{:>8.2f} {:>10.4f}'.format(
+                      name, len(tree['nodes']), method or 'none',
+                      output['status'], output['iterations'],
+                      output['solves'],
+                      stabilizer.stabilized if stabilizer else '',
+                      stabilizer.serious if stabilizer else '',
+                      stabilizer.null if stabilizer else '',
+                      time.time() - start, output['upper_bound']))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,283 @@
+"""Benchmark suite on scaled versions of the bundled examples.
+
+Each case generates a tree (see :mod:`benchmarks.generators`), writes it to
+YAML files, and runs in a fresh process:
+
+    - `load`: loading the files with :class:`ndusc.input_module.Input_module`.
+    - `build`: building the models (:meth:`ndusc.model.Persistent_models.
+      template`), loading the parameters and state of each node, and
+      building the elastic problems of the feasibility cuts.
+    - `solve`: the solver calls (:func:`ndusc.model.solve`, without the
+      extraction).
+    - `extraction`: reading the solutions (:mod:`ndusc.format_sol`).
+    - `cuts`: computing the cuts and adding them to the models.
+    - `bookkeeping`: the rest of the decomposition (tree updates, cut
+      pools, bounds, ...).
+
+The times of the phases are exclusive (a phase called from another one is
+not counted in it). The peak memory is the maximum resident size of the
+process. The results are printed and, with `--output`, written as JSON
+with the environment (commit, versions), so runs of two versions can be
+compared with `--compare`.
+
+Usage:
+    python benchmarks/suite.py [--suite small|scaling|all] [--cases NAME ...]
+        [--solver SOLVER] [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import generators  # noqa: E402
+
+ROOT = generators.ROOT
+
+PHASES = ('load', 'build', 'solve', 'extraction', 'cuts', 'bookkeeping')
+
+
+def case(name, example, max_iter=100, **size):
+    return dict(name=name, example=example, max_iter=max_iter, **size)
+
+
+SUITES = {
+    'small': [
+        case('production-b2-s3', 'production', branching=2, stages=3),
+        case('production-b3-s4', 'production', branching=3, stages=4),
+        case('production-b2-s6', 'production', branching=2, stages=6),
+        case('production-b10-s3', 'production', branching=10, stages=3),
+        case('wildfire-s10-r7', 'wildfire', scenarios=10, resources=7),
+        case('wildfire-s100-r7', 'wildfire', scenarios=100, resources=7),
+        case('wildfire-s10-r30', 'wildfire', scenarios=10, resources=30),
+    ],
+    # From 10 to 10^5 nodes, a few iterations each
+    'scaling': [
+        case('production-n10', 'production', 3, branching=9, stages=2),
+        case('production-n121', 'production', 3, branching=3, stages=5),
+        case('production-n1111', 'production', 3, branching=10, stages=4),
+        case('production-n11111', 'production', 2, branching=10, stages=5),
+        case('production-n111111', 'production', 1, branching=10, stages=6),
+        case('wildfire-n11', 'wildfire', 3, scenarios=10, resources=7),
+        case('wildfire-n1001', 'wildfire', 3, scenarios=1000, resources=7),
+        case('wildfire-n100001', 'wildfire', 1, scenarios=100000,
+             resources=7),
+        case('wildfire-r100', 'wildfire', 3, scenarios=10, resources=100),
+        case('wildfire-r1000', 'wildfire', 3, scenarios=10, resources=1000),
+    ],
+}
+SUITES['all'] = SUITES['small'] + SUITES['scaling']
+
+
+def generate(spec):
+    """Return the tree and the data of the case `spec`."""
+    if spec['example'] == 'production':
+        return (generators.production_tree(spec['branching'],
+                                           spec['stages'], demands=(0, 6)),
+                generators.production_data(3))
+    return (generators.wildfire_tree(spec['scenarios']),
+            generators.wildfire_data(spec['resources']))
+
+
+class Phase_timer(object):
+    """Exclusive time of the phases of a run.
+
+    The functions of each phase are wrapped while the timer is installed
+    (as a context manager). Only valid with the serial executor.
+    """
+
+    def __init__(self):
+        from ndusc import cuts, format_sol, model, parallel
+        self.targets = [
+            ('build', model.Persistent_models, 'template'),
+            ('build', model.Template, 'apply'),
+            ('build', model, 'set_state'),
+            ('build', cuts, 'elastic_problem'),
+            ('solve', model, 'solve'),
+            ('extraction', format_sol, 'get_solution'),
+            ('extraction', format_sol.Extraction_plan, 'extract'),
+            ('extraction', format_sol.Extraction_plan, '__init__'),
+            ('cuts', cuts, 'create_cuts'),
+            ('cuts', cuts, 'compute_opt_cuts'),
+            ('cuts', cuts, 'compute_feas_cuts'),
+            ('cuts', cuts, 'cut_groups'),
+            ('cuts', cuts, 'stack_gradients'),
+            ('cuts', parallel, '_gradient'),
+        ]
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.stack = []
+        self.last = None
+        self.saved = []
+
+    def __enter__(self):
+        for phase, owner, name in self.targets:
+            function = getattr(owner, name)
+            self.saved.append((owner, name, function))
+            setattr(owner, name, self._wrap(phase, function))
+        return self
+
+    def __exit__(self, *args):
+        for owner, name, function in reversed(self.saved):
+            setattr(owner, name, function)
+        self.saved = []
+
+    def _wrap(self, phase, function):
+        def wrapper(*args, **kwargs):
+            self._switch(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._switch(None)
+        return wrapper
+
+    def _switch(self, phase):
+        now = time.perf_counter()
+        if self.stack:
+            self.times[self.stack[-1]] += now - self.last
+        if phase is None:
+            self.stack.pop()
+        else:
+            self.stack.append(phase)
+        self.last = now
+
+
+def run_case(spec, solver):
+    """Run the case `spec` in this process and return its results."""
+    import yaml
+    from ndusc import input_module, nd, reduction
+
+    tree_data, data = generate(spec)
+    with tempfile.TemporaryDirectory() as directory:
+        path_tree = os.path.join(directory, 'tree.yaml')
+        path_data = os.path.join(directory, 'data.yaml')
+        reduction.write_yaml(tree_data, path_tree)
+        with open(path_data, 'w') as data_file:
+            yaml.safe_dump(data, data_file)
+        start = time.perf_counter()
+        loader = input_module.Input_module(path_data, path_tree)
+        tree_data, data = loader.load_tree(), loader.load_data()
+        load = time.perf_counter() - start
+
+    timer = Phase_timer()
+    start = time.perf_counter()
+    with timer:
+        output = nd.nested_decomposition(tree_data, data, solver=solver,
+                                         max_iter=spec['max_iter'])
+    total = time.perf_counter() - start
+
+    phases = dict(timer.times, load=load)
+    phases['bookkeeping'] = total - sum(timer.times.values())
+    return dict(
+        spec,
+        nodes=len(tree_data['nodes']),
+        status=output['status'],
+        iterations=output['iterations'],
+        solves=output['solves'],
+        builds=output['builds'],
+        lower_bound=output['lower_bound'],
+        upper_bound=output['upper_bound'],
+        phases=phases,
+        total=total + load,
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        peak_memory_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10),
+    )
+
+
+def environment(solver):
+    """Versions and machine of the run."""
+    import numpy
+    import pyomo.version
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+            universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'pyomo': pyomo.version.version,
+        'solver': solver,
+        'machine': platform.node(),
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, path):
+    """Print the ratio of the times to those of the results in `path`."""
+    with open(path) as old_file:
+        old = {r['name']: r for r in json.load(old_file)['results']}
+    print('\nRatio to {} (> 1 is slower)'.format(path))
+    print('{:>20} {:>7}'.format('case', 'total') + ''.join(
+        ' {:>10}'.format(phase) for phase in PHASES))
+    for result in results:
+        before = old.get(result['name'])
+        if before is None:
+            continue
+        ratios = [result['total'] / before['total']] + [
+            result['phases'][p] / before['phases'][p]
+            if before['phases'][p] > 0 else float('nan') for p in PHASES]
+        print('{:>20} {:>7.2f}'.format(result['name'], ratios[0]) + ''.join(
+            ' {:>10.2f}'.format(ratio) for ratio in ratios[1:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--suite', choices=sorted(SUITES), default='small')
+    parser.add_argument('--cases', nargs='*', help='names of the cases')
+    parser.add_argument('--solver', default='appsi_highs')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of previous results')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # Child process: one case
+        print(json.dumps(run_case(json.loads(args.case), args.solver)))
+        return
+
+    specs = [spec for spec in SUITES[args.suite]
+             if not args.cases or spec['name'] in args.cases]
+    print('{:>20} {:>7} {:>9} {:>5} {:>7} {:>8}'.format(
+        'case', 'nodes', 'status', 'iter', 'solves', 'MB') + ''.join(
+        ' {:>10}'.format(phase) for phase in PHASES))
+    results = []
+    for spec in specs:
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--case',
+             json.dumps(spec), '--solver', args.solver],
+            capture_output=True, universal_newlines=True)
+        if child.returncode:
+            print('{:>20} failed:\n{}'.format(spec['name'], child.stderr))
+            continue
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print('{:>20} {:>7} {:>9} {:>5} {:>7} {:>8.1f}'.format(
+            result['name'], result['nodes'], result['status'],
+            result['iterations'], result['solves'],
+            result['peak_memory_mb']) + ''.join(
+            ' {:>10.3f}'.format(result['phases'][phase])
+            for phase in PHASES))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'environment': environment(args.solver),
+                       'results': results}, output_file, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
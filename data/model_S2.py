@@ -27,7 +27,7 @@ def model_S2(data):
     model.NumPer = Param(initialize=data['params']['NumPer'], within=Integers)
 
     def Periods_rule(model):
-        return set(range(1, model.NumPer()+1))
+        return list(range(1, model.NumPer()+1))
 
     model.Periods = Set(initialize=Periods_rule)
 
@@ -60,7 +60,7 @@ def model_S2(data):
 
     model.M = Param(initialize=M_init ,within=PositiveReals)
 
-    model.Z = Param(model.Resources, initialize=data['params']['Z'])
+    model.Z = Param(model.Resources, initialize=data['params']['Z'], mutable=True)
 
     #
     # Variables
@@ -0,0 +1,246 @@
+"""Checkpoints of the state of a nested decomposition.
+
+A checkpoint is the state of a run at the end of an iteration:
+
+    - the tree, as given to :func:`ndusc.nd.nested_decomposition` (the
+      information of its nodes, without results), so the run can be resumed
+      without the tree file.
+    - for each node: its trial solution (`variables`, `value` and `cost`),
+      the names of its state variables, the clusters of its children in
+      the hybrid cut mode (the groups of its cuts) and its cut pools as
+      arrays (see :meth:`ndusc.cut_pool.Cut_pool.state`).
+    - the output of the run (bounds, iterations and counters) and the
+      bounds of each iteration (`history`).
+
+The file is a header followed by the binary encoding of the state (see
+:func:`ndusc.distributed.encode`; the cut pools are raw numpy arrays). It
+is written to a temporary file in the same directory, synced and renamed
+over the previous checkpoint, so a run stopped while writing leaves the
+previous checkpoint.
+
+A run is resumed from a checkpoint with :func:`resume`: the tree is rebuilt,
+the cut pools and trial solutions of its nodes restored, and the iterations
+continue from the last one saved, with the same bounds. A new run can also
+start from the cuts of an old one (`warm_start` of
+:func:`ndusc.nd.nested_decomposition`), e.g. after changing the data of the
+nodes; the cuts must still be valid for the new problems.
+"""
+
+import os
+import struct
+import time
+
+from ndusc import distributed
+
+MAGIC = b'NDUSCCKP'
+VERSION = 1
+HEADER = struct.Struct('!8sI')
+
+# Results kept for each node
+_node_keys = ('variables', 'value', 'cost', 'state_names', 'cut_groups')
+
+# Output entries restored on resume
+_output_keys = ('lower_bound', 'upper_bound', 'iterations', 'solves',
+                'builds', 'cuts_evicted', 'cuts_revived')
+
+
+class Checkpoint(object):
+    """Periodic checkpoints of a run.
+
+    A checkpoint is written at the end of an iteration once `every`
+    iterations or `seconds` seconds (if given) have passed since the last
+    one, and at the end of the run.
+
+    Args:
+        path (:obj:`str`): checkpoint file.
+        every (:obj:`int`): iterations between checkpoints.
+        seconds (:obj:`float`): time between checkpoints.
+
+    Example:
+        >>> output = nd.nested_decomposition(
+        ...     tree_data, data, checkpoint_path=Checkpoint('run.ckpt',
+        ...                                                 every=10))
+        >>> # After the run is stopped
+        >>> output = checkpoint.resume('run.ckpt', data)
+    """
+
+    def __init__(self, path, every=1, seconds=None):
+        self.path = path
+        self.every = every
+        self.seconds = seconds
+        self.tree_data = None
+        self.history = []
+        self.saved = 0
+        self.time = time.time()
+
+    def start(self, tree_data, history=()):
+        """Start the checkpoints of a run on the tree `tree_data`, with the
+        bounds `history` of the previous iterations."""
+        self.tree_data = {'nodes': [dict(node)
+                                    for node in tree_data['nodes']]}
+        self.history = list(history)
+        self.saved = self.history[-1][0] if self.history else 0
+        self.time = time.time()
+
+    def iteration(self, output, tree_nc):
+        """Record the end of the last iteration of `output`, and write a
+        checkpoint if it is due."""
+        iteration = output['iterations']
+        if iteration == 0 or (self.history and
+                              self.history[-1][0] >= iteration):
+            return
+        self.history.append((iteration, output['lower_bound'],
+                             output['upper_bound']))
+        if iteration - self.saved >= self.every or (
+                self.seconds is not None and
+                time.time() - self.time >= self.seconds):
+            self.write(output, tree_nc)
+
+    def finish(self, output, tree_nc):
+        """Write the checkpoint of the end of the run."""
+        self.iteration(output, tree_nc)
+        if self.saved < output['iterations'] or not os.path.exists(
+                self.path):
+            self.write(output, tree_nc)
+
+    def write(self, output, tree_nc):
+        """Write the checkpoint of the current state."""
+        save(self.path, state(tree_nc, output, self.tree_data, self.history))
+        self.saved = output['iterations']
+        self.time = time.time()
+
+
+def state(tree_nc, output, tree_data=None, history=()):
+    """Return the state of a run.
+
+    Args:
+        tree_nc (:obj:`ndusc.tree.Tree`): tree of the run.
+        output (:obj:`dict`): output of the run.
+        tree_data (:obj:`dict`): tree information given to the run.
+        history (:obj:`list`): ``(iteration, lower bound, upper bound)``
+            of the previous iterations.
+
+    Return:
+        :obj:`dict`: `version`, `tree`, `nodes` (id -> results and cut
+        pools), `output` and `history`.
+    """
+    nodes = {}
+    for node in tree_nc.nodes:
+        saved = {key: node[key] for key in _node_keys if key in node}
+        saved['cut_pool'] = {kind: pool.state()
+                             for kind, pool in node['cut_pool'].items()}
+        nodes[node['id']] = saved
+    return {'version': VERSION,
+            'tree': tree_data,
+            'nodes': nodes,
+            'output': {key: output[key] for key in _output_keys},
+            'history': [tuple(entry) for entry in history]}
+
+
+def save(path, run_state):
+    """Write `run_state` (see :func:`state`) to the file `path`,
+    atomically."""
+    directory = os.path.dirname(os.path.abspath(path))
+    temporary = os.path.join(directory, '.{}.tmp{}'.format(
+        os.path.basename(path), os.getpid()))
+    try:
+        with open(temporary, 'wb') as checkpoint_file:
+            checkpoint_file.write(HEADER.pack(MAGIC, VERSION))
+            checkpoint_file.write(distributed.encode(run_state))
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    # Make the rename durable
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def load(path):
+    """Return the state saved in the checkpoint file `path`.
+
+    Raises:
+        ValueError: if `path` is not a checkpoint of a known version.
+    """
+    with open(path, 'rb') as checkpoint_file:
+        data = checkpoint_file.read()
+    if len(data) < HEADER.size:
+        raise ValueError('{} is not a checkpoint'.format(path))
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('{} is not a checkpoint'.format(path))
+    if version != VERSION:
+        raise ValueError('Unknown checkpoint version {} in {}'.format(
+            version, path))
+    return distributed.decode(memoryview(data)[HEADER.size:])
+
+
+def restore(tree_nc, run_state, output=None):
+    """Install the cuts and trial solutions of `run_state` in the nodes of
+    `tree_nc` with the same id (the cut pools must have been created, see
+    :func:`ndusc.cuts.init_cut_pools`).
+
+    Args:
+        run_state (:obj:`dict`): state of a run, see :func:`state`, or the
+            path of its checkpoint.
+        output (:obj:`dict`): if given (resume) the bounds, iterations and
+            counters of `run_state` are restored in it and the cuts keep
+            their ages. Otherwise (warm start) only the cuts are installed,
+            as new cuts.
+
+    Return:
+        :obj:`int`: number of nodes restored.
+    """
+    if isinstance(run_state, str):
+        run_state = load(run_state)
+    restored = 0
+    for nodeid, saved in run_state['nodes'].items():
+        if nodeid not in tree_nc.position:
+            continue
+        node = tree_nc.return_node(nodeid)
+        for kind, pool_state in saved['cut_pool'].items():
+            node['cut_pool'][kind].load_state(pool_state,
+                                              ages=output is not None)
+        # The clusters of the hybrid mode are those of the groups of the cuts
+        if 'cut_groups' in saved:
+            node['cut_groups'] = saved['cut_groups']
+        if output is not None:
+            for key in _node_keys:
+                if key in saved:
+                    node[key] = saved[key]
+        restored += 1
+    if output is not None:
+        output.update(run_state['output'])
+    return restored
+
+
+def resume(path, data, **kwargs):
+    """Resume the run saved in the checkpoint `path`.
+
+    The run goes on from the last iteration saved, with the same tree,
+    cuts and bounds, and its checkpoints are written to `path`.
+
+    Args:
+        path (:obj:`str`): checkpoint file.
+        data (:obj:`dict`): dictionary with problem data.
+        kwargs: other arguments of :func:`ndusc.nd.nested_decomposition`
+            (they are not saved in the checkpoint). `max_iter` counts the
+            iterations of the whole run.
+
+    Return:
+        :obj:`dict`: output of :func:`ndusc.nd.nested_decomposition`.
+    """
+    # Imported here as ndusc.nd uses this module
+    from ndusc import nd
+    run_state = load(path)
+    kwargs.setdefault('checkpoint_path', path)
+    return nd.nested_decomposition(run_state['tree'], data,
+                                   warm_start=run_state, resume=True,
+                                   **kwargs)
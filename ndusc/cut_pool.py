@@ -0,0 +1,290 @@
+"""Pool of the cuts of a node."""
+
+import numpy as np
+
+
+class Cut_pool(object):
+    """Cuts of one kind (feasibility or optimality) of a node.
+
+    The cuts are stored as rows of a dense coefficient array over the state
+    variables of the node (the columns, ``(name, index)`` keys), with their
+    right hand sides and groups. A cut is
+
+        ``coefs * x + Aux_Obj[group] >= rhs``  (optimality)
+        ``coefs * x >= rhs``                   (feasibility)
+
+    The pool:
+
+        - Drops near-duplicates: cuts are hashed by their coefficients rounded
+          to `decimals` (feasibility cuts are first scaled to unit norm), so a
+          new cut parallel to a stored one of the same group only keeps the
+          larger right hand side (the dominant cut).
+        - Tracks the slack of every cut at the solutions of the node and the
+          last iteration it was active (slack below `tol`).
+        - Evicts from the live cuts (the cuts in the model of the node) those
+          inactive for `max_age` iterations. They stay in the pool and are
+          made live again if a later solution violates them.
+
+    The live cuts are kept in the dictionary `live` (cut id -> cut
+    dictionary, see :mod:`ndusc.cuts`), which is ``node['cuts'][kind]``.
+
+    Args:
+        kind (:obj:`str`): 'feas' or 'opt'.
+        max_age (:obj:`int`): iterations a cut can be inactive before being
+            evicted. If None cuts are never evicted.
+        decimals (:obj:`int`): decimals of the coefficients in the hash.
+        tol (:obj:`float`): slack tolerance.
+    """
+
+    def __init__(self, kind, max_age=None, decimals=9, tol=1e-6):
+        self.kind = kind
+        self.max_age = max_age
+        self.decimals = decimals
+        self.tol = tol
+
+        self.columns = {}
+        self.groups = {}
+        self.group_names = []
+        self.coefs = np.zeros((0, 0))
+        self.rhs = np.zeros(0)
+        self.group = np.zeros(0, dtype=np.int64)
+        self.last_active = np.zeros(0, dtype=np.int64)
+        self.slack = np.zeros(0)
+        self.alive = np.zeros(0, dtype=bool)
+        self.is_live = np.zeros(0, dtype=bool)
+        self.n = 0
+        self.iteration = 0
+
+        self.hashes = {}
+        self.live = {}
+
+    def __len__(self):
+        return self.n
+
+    def add(self, cut):
+        """Add a cut to the pool.
+
+        Args:
+            cut (:obj:`dict`): cut dictionary, see :mod:`ndusc.cuts`.
+
+        Return:
+            :obj:`int`: id of the cut in the pool, or None if it is dominated
+            by a cut of the pool.
+        """
+        coef_key, rhs_key = ('E', 'e') if self.kind == 'opt' else ('D', 'd')
+        group = self._group_code(cut.get('group'))
+        columns = [self._column(key) for key in cut[coef_key]]
+        row = np.zeros(len(self.columns))
+        row[columns] = list(cut[coef_key].values())
+        rhs = cut[rhs_key]
+
+        # Near-duplicates
+        key, scale = self._key(row, group)
+        cid = self.hashes.get(key)
+        if cid is not None:
+            if rhs / scale <= self.rhs[cid] / self._scale(cid) + self.tol:
+                # Dominated: make the stored cut live again
+                self.last_active[cid] = self.iteration
+                self._revive(cid)
+                return None
+            self._evict(cid)
+
+        cid = self._append(row, rhs, group)
+        self.hashes[key] = cid
+        self._revive(cid)
+        return cid
+
+    def update(self, variables, iteration):
+        """Update the slacks and activity of the cuts.
+
+        Args:
+            variables (:obj:`dict`): solution of the node,
+                ``{name: {index: value}}``.
+            iteration (:obj:`int`): current iteration.
+
+        Return:
+            :obj:`tuple`: lists of the ids of the cuts evicted and of the cuts
+            made live again because the solution violates them.
+        """
+        self.iteration = iteration
+        if self.n == 0:
+            return [], []
+        x = np.array([variables[name][index]
+                      for name, index in self.columns])
+        slack = (self.coefs[:self.n, :len(self.columns)] @ x
+                 - self.rhs[:self.n])
+        if self.kind == 'opt':
+            aux = variables.get('Aux_Obj', {})
+            theta = np.array([aux.get(g, 0.0) or 0.0 for g in self.groups])
+            slack += theta[self.group[:self.n]]
+        self.slack[:self.n] = slack
+
+        live = self.is_live[:self.n].copy()
+        active = slack <= self.tol
+        self.last_active[:self.n][active & live] = iteration
+
+        revived = np.nonzero(~live & self.alive[:self.n] &
+                             (slack < -self.tol))[0].tolist()
+        for cid in revived:
+            self.last_active[cid] = iteration
+            self._revive(cid)
+
+        evicted = []
+        if self.max_age is not None:
+            old = live & (iteration - self.last_active[:self.n] >=
+                          self.max_age)
+            evicted = np.nonzero(old)[0].tolist()
+            for cid in evicted:
+                del self.live[cid]
+                self.is_live[cid] = False
+        return evicted, revived
+
+    def cuts(self, ids=None):
+        """Return the cut dictionaries of `ids` (all the cuts if None)."""
+        if ids is None:
+            ids = np.nonzero(self.alive[:self.n])[0].tolist()
+        return {cid: self._cut(cid) for cid in ids}
+
+    def state(self):
+        """Return the cuts of the pool as arrays, to be restored with
+        :meth:`load_state`.
+
+        Return:
+            :obj:`dict`: `columns` (keys of the columns), `group_names`,
+            one row per cut of `coefs`, `rhs`, `group` (code of the group in
+            `group_names`), `last_active`, `slack`, `alive` and `is_live`,
+            and the `iteration` of the last update.
+        """
+        n, m = self.n, len(self.columns)
+        return {'columns': list(self.columns),
+                'group_names': list(self.group_names),
+                'coefs': self.coefs[:n, :m].copy(),
+                'rhs': self.rhs[:n].copy(),
+                'group': self.group[:n].copy(),
+                'last_active': self.last_active[:n].copy(),
+                'slack': self.slack[:n].copy(),
+                'alive': self.alive[:n].copy(),
+                'is_live': self.is_live[:n].copy(),
+                'iteration': self.iteration}
+
+    def load_state(self, state, ages=True):
+        """Replace the cuts of the pool by those of `state` (see
+        :meth:`state`). The dictionary `live` is updated in place.
+
+        Args:
+            ages (:obj:`bool`): if False the cuts are taken as active at
+                iteration 0 (e.g. to start a new run with them), otherwise
+                their last activity is kept.
+        """
+        self.columns = {key: j for j, key in enumerate(state['columns'])}
+        self.group_names = list(state['group_names'])
+        self.groups = {g: k for k, g in enumerate(self.group_names)}
+        n, m = len(state['rhs']), len(self.columns)
+        capacity = max(8, n)
+        self.coefs = np.zeros((capacity, max(1, m)))
+        self.coefs[:n, :m] = state['coefs']
+        self.rhs = _grow(np.asarray(state['rhs'], dtype=np.float64),
+                         capacity)
+        self.group = _grow(np.asarray(state['group'], dtype=np.int64),
+                           capacity)
+        self.slack = _grow(np.asarray(state['slack'], dtype=np.float64),
+                           capacity)
+        self.alive = _grow(np.asarray(state['alive'], dtype=bool), capacity)
+        self.is_live = _grow(np.asarray(state['is_live'], dtype=bool),
+                             capacity)
+        self.n = n
+        if ages:
+            self.last_active = _grow(
+                np.asarray(state['last_active'], dtype=np.int64), capacity)
+            self.iteration = state['iteration']
+        else:
+            self.last_active = np.zeros(capacity, dtype=np.int64)
+            self.iteration = 0
+
+        self.hashes = {}
+        for cid in np.flatnonzero(self.alive[:n]).tolist():
+            self.hashes[self._key(self.coefs[cid, :m], self.group[cid])[0]] \
+                = cid
+        self.live.clear()
+        for cid in np.flatnonzero(self.is_live[:n]).tolist():
+            self.live[cid] = self._cut(cid)
+
+    def _key(self, row, group):
+        """Return the hash key of a cut and its scale."""
+        scale = 1.0
+        if self.kind == 'feas':
+            scale = np.linalg.norm(row) or 1.0
+        direction = np.round(row / scale, self.decimals) + 0.0
+        return (int(group), np.trim_zeros(direction, 'b').tobytes()), scale
+
+    def _cut(self, cid):
+        coef_key, rhs_key = ('E', 'e') if self.kind == 'opt' else ('D', 'd')
+        row = self.coefs[cid]
+        cut = {coef_key: {key: float(row[j])
+                          for key, j in self.columns.items() if row[j] != 0},
+               rhs_key: float(self.rhs[cid])}
+        if self.kind == 'opt':
+            cut['group'] = self.group_names[self.group[cid]]
+        return cut
+
+    def _revive(self, cid):
+        if not self.is_live[cid]:
+            self.live[cid] = self._cut(cid)
+            self.is_live[cid] = True
+
+    def _evict(self, cid):
+        self.alive[cid] = False
+        self.is_live[cid] = False
+        self.live.pop(cid, None)
+
+    def _scale(self, cid):
+        if self.kind == 'feas':
+            return np.linalg.norm(self.coefs[cid]) or 1.0
+        return 1.0
+
+    def _column(self, key):
+        j = self.columns.get(key)
+        if j is None:
+            j = len(self.columns)
+            self.columns[key] = j
+            if j >= self.coefs.shape[1]:
+                self.coefs = np.hstack(
+                    [self.coefs, np.zeros((self.coefs.shape[0],
+                                           max(1, self.coefs.shape[1])))])
+        return j
+
+    def _group_code(self, group):
+        code = self.groups.get(group)
+        if code is None:
+            code = len(self.groups)
+            self.groups[group] = code
+            self.group_names.append(group)
+        return code
+
+    def _append(self, row, rhs, group):
+        if self.n >= self.coefs.shape[0]:
+            capacity = max(8, 2 * self.coefs.shape[0])
+            self.coefs = _grow(self.coefs, capacity)
+            self.rhs = _grow(self.rhs, capacity)
+            self.group = _grow(self.group, capacity)
+            self.last_active = _grow(self.last_active, capacity)
+            self.slack = _grow(self.slack, capacity)
+            self.alive = _grow(self.alive, capacity)
+            self.is_live = _grow(self.is_live, capacity)
+        cid = self.n
+        self.coefs[cid, :] = 0.0
+        self.coefs[cid, :len(row)] = row
+        self.rhs[cid] = rhs
+        self.group[cid] = group
+        self.last_active[cid] = self.iteration
+        self.slack[cid] = 0.0
+        self.alive[cid] = True
+        self.is_live[cid] = False
+        self.n += 1
+        return cid
+
+
+def _grow(array, capacity):
+    new = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    new[:array.shape[0]] = array
+    return new
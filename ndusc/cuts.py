@@ -1,118 +1,820 @@
-
-# create_feas_cuts -------------------------------------------------------------
+import numpy as np
+from pyomo.environ import (Any, Binary, ConstraintList, Constraint,
+                           NonNegativeReals, Objective, Param, Reals, Var,
+                           VarList, minimize, value)
+from pyomo.core.expr.numvalue import is_constant
+from pyomo.core.expr.calculus.derivatives import Modes, differentiate
+from pyomo.core.expr.visitor import (identify_mutable_parameters,
+                                     identify_variables, replace_expressions)
+from scipy import sparse
+
+from ndusc import cut_pool
+from ndusc import instrument
+
+# The cuts of a node are kept in its cut pools, node['cut_pool'][kind] (see
+# :class:`ndusc.cut_pool.Cut_pool`), and its live cuts, those that are in its
+# model, in node['cuts'][kind] as dictionaries cut id -> cut:
+#
+#   - feasibility cuts: {'D': {(name, index): coef}, 'd': rhs}
+#       sum(D[k] * x[k]) >= d
+#   - optimality cuts: {'E': {(name, index): coef}, 'e': rhs, 'group': g}
+#       sum(E[k] * x[k]) + Aux_Obj[g] >= e
+#
+# where x[k] = model.<name>[<index>] is a variable of the node that feeds
+# its children. Aux_Obj[g] approximates the expected cost of the children in
+# the group g: a single group with all the children (single cut), one group
+# per child (multi cut) or k clusters of children (hybrid), see
+# :data:`cut_modes`.
+#
+# The optimality cuts computed from the nodes of a stage are of one of the
+# :data:`cut_families` (see :func:`stage_family`). All of them are given by
+# the value of the cut at the state of the node and its gradient, so they
+# are added in the same way (see :func:`compute_opt_cuts`).
+
+cut_modes = ('single', 'multi', 'hybrid')
+cut_families = ('benders', 'integer', 'strengthened', 'lagrangian')
+
+
+# create_cuts ------------------------------------------------------------------
 def create_cuts(model, node):
+    """Make the cuts of `model` the live cuts of `node`.
+
+    If `model` is shared with other nodes (see :class:`ndusc.model.Template`)
+    and has the cuts of another node, they are removed first. Nodes that
+    share their cuts (e.g. the outcomes of a stage in :mod:`ndusc.sddp`)
+    have the same `cuts_id`, used instead of their id.
+
+    Args:
+        model (:obj:`pyomo.environ.ConcreteModel`): problem of the node.
+        node (:obj:`dict`): node information.
     """
-    """
-    if 'cuts' in node.keys():
-        log.info('Add cuts:')
-        if 'feas' in node['cuts'].keys():
-            log.info('\t- feasibility cuts')
-            create_feas_cuts(model, node['cuts']['feas'])
-        if 'opt' in node['cuts'].keys():
-            log.info('\t- optimality cuts')
-            create_opt_cuts(model, node['cuts']['opt'])
+    owner = node.get('cuts_id', node['id'])
+    with instrument.span('load cuts', owner):
+        if not hasattr(model, '_cut_info'):
+            model._cut_info = {'feas': set(), 'opt': set(), 'groups': [],
+                               'node': owner}
+        elif model._cut_info['node'] != owner:
+            remove_cuts(model)
+            model._cut_info['node'] = owner
+        if 'cuts' in node.keys():
+            if 'feas' in node['cuts'].keys():
+                create_feas_cuts(model, node['cuts']['feas'])
+            if 'opt' in node['cuts'].keys():
+                create_opt_cuts(model, node['cuts']['opt'])
+# ---------------------------------------------------------------------------- #
+
+
+# remove_cuts ------------------------------------------------------------------
+def remove_cuts(model):
+    """Remove all the cuts of `model` and restore its objective function."""
+    info = model._cut_info
+    for cid in info['feas']:
+        if cid in model._Cuts_Feas:
+            del model._Cuts_Feas[cid]
+    for cid in info['opt']:
+        del model._Cuts_Opt[cid]
+    info['feas'].clear()
+    info['opt'].clear()
+    if model.component('Aux_Obj') is not None:
+        for g in list(model.Aux_Obj.keys()):
+            del model.Aux_Obj[g]
+    if model.component('_Obj') is not None:
+        model.del_component('_Obj')
+        info['objective'].activate()
+    info['groups'] = []
 # ---------------------------------------------------------------------------- #
 
 
 # create_feas_cuts -------------------------------------------------------------
 def create_feas_cuts(model, cuts):
-    #
-    # Sets
-    #
+    """Make the feasibility cuts of `model` the cuts of `cuts`."""
+    if model.component('_Cuts_Feas') is None:
+        model._Cuts_Feas = Constraint(Any)
+
+    installed = model._cut_info['feas']
+    for cid in installed - set(cuts):
+        if cid in model._Cuts_Feas:
+            del model._Cuts_Feas[cid]
+        installed.discard(cid)
+    for cid, cut in cuts.items():
+        if cid in installed:
+            continue
+        lhs = sum(coef * _state_var(model, key)
+                  for key, coef in cut['D'].items())
+        if not is_constant(lhs):
+            model._Cuts_Feas[cid] = lhs >= cut['d']
+        installed.add(cid)
+# ---------------------------------------------------------------------------- #
+
+
+# create_opt_cuts --------------------------------------------------------------
+def create_opt_cuts(model, cuts):
+    """Make the optimality cuts of `model` the cuts of `cuts`.
 
-    model._Cuts_Feas = Set(initialize=cuts['sets']['Cuts_Feas'])
+    The variable `Aux_Obj[g]` of each new group of cuts g is added to the
+    objective function.
+    """
+    info = model._cut_info
+    if model.component('Aux_Obj') is None:
+        if not cuts:
+            return
+        model.Aux_Obj = Var(Any, dense=False)
+        model._Cuts_Opt = Constraint(Any)
+        for o in model.component_data_objects(Objective, active=True):
+            info['objective'] = o
+
+    installed = info['opt']
+    for cid in installed - set(cuts):
+        del model._Cuts_Opt[cid]
+        installed.discard(cid)
+
+    new_cuts = [(cid, cut) for cid, cut in cuts.items()
+                if cid not in installed]
+    groups = [cut.get('group', 0) for cid, cut in new_cuts]
+    if any(g not in info['groups'] for g in groups):
+        for g in groups:
+            if g not in info['groups']:
+                info['groups'].append(g)
+        if model.component('_Obj') is not None:
+            model.del_component('_Obj')
+        objective = info['objective']
+        objective.deactivate()
+        model._Obj = Objective(
+            expr=objective.expr + sum(model.Aux_Obj[g]
+                                      for g in info['groups']),
+            sense=objective.sense)
+
+    for (cid, cut), g in zip(new_cuts, groups):
+        lhs = sum(coef * _state_var(model, key)
+                  for key, coef in cut['E'].items())
+        model._Cuts_Opt[cid] = lhs + model.Aux_Obj[g] >= cut['e']
+        installed.add(cid)
+# ---------------------------------------------------------------------------- #
 
-    #
-    # Parameters
-    #
 
-    model._D = Param(model._Cuts_Feas,
-                    initialize=cuts['params']['D'])
+# init_cut_pools ---------------------------------------------------------------
+def init_cut_pools(node, max_age=None):
+    """Create the cut pools of `node`.
 
-    model._d = Param(model._Cuts_Feas,
-                    initialize=cuts['params']['d'])
+    Args:
+        node (:obj:`dict`): node information.
+        max_age (:obj:`int`): iterations a cut can be inactive before it is
+            evicted from the model (see :class:`ndusc.cut_pool.Cut_pool`).
+    """
+    node['cut_pool'] = {}
+    node['cuts'] = {}
+    for kind in ('feas', 'opt'):
+        pool = cut_pool.Cut_pool(kind, max_age)
+        node['cut_pool'][kind] = pool
+        node['cuts'][kind] = pool.live
+# ---------------------------------------------------------------------------- #
 
-    #
-    # Constraints
-    #
 
-    def _opt_feas_rule(model, l):
-        return sum(model.D[l,i]*model.Z[i] for i in model.Resources) >= model.d[l]
+# add_cut ----------------------------------------------------------------------
+def add_cut(node, kind, cut):
+    """Add `cut` to the pool of kind `kind` ('feas' or 'opt') of `node`.
 
-    model._opt_cuts = Constraint(model._Cuts_Feas, rule=_opt_feas_rule)
+    Return:
+        :obj:`int`: id of the cut, None if it is dominated by a cut of the
+        pool.
+    """
+    if 'cut_pool' not in node:
+        init_cut_pools(node)
+    cid = node['cut_pool'][kind].add(cut)
+    if cid is not None:
+        instrument.count('cuts_added', node=node.get('cuts_id', node['id']))
+    return cid
 # ---------------------------------------------------------------------------- #
 
 
-# create_opt_cuts --------------------------------------------------------------
-def create_opt_cuts(model, cuts):
-    #
-    # Sets
-    #
+# update_cut_pools -------------------------------------------------------------
+def update_cut_pools(node, iteration):
+    """Update the activity of the cuts of `node` with its last solution.
 
-    model._Cuts_Opt = Set(initialize=cuts['sets']['Cuts_Opt'])
+    Return:
+        :obj:`tuple`: number of cuts evicted and made live again.
+    """
+    evicted = revived = 0
+    for pool in node.get('cut_pool', {}).values():
+        pool_evicted, pool_revived = pool.update(node['variables'], iteration)
+        evicted += len(pool_evicted)
+        revived += len(pool_revived)
+    if evicted:
+        instrument.count('cuts_evicted', evicted, node['id'])
+    if revived:
+        instrument.count('cuts_revived', revived, node['id'])
+    return evicted, revived
+# ---------------------------------------------------------------------------- #
 
-    #
-    # Parameters
-    #
 
-    model._E = Param(model._Cuts_Opt,
-                    initialize=cuts['params']['E'])
+# future_cost ------------------------------------------------------------------
+def future_cost(model):
+    """Return the value of `Aux_Obj` in `model` (0 if it has no cuts)."""
+    if model.component('Aux_Obj') is None:
+        return 0.0
+    return sum(value(v) for v in model.Aux_Obj.values())
+# ---------------------------------------------------------------------------- #
+
+
+# lift_future_cost -------------------------------------------------------------
+def lift_future_cost(model, node):
+    """Set each `Aux_Obj[g]` of `model` to the smallest value that satisfies
+    the live optimality cuts of `node` of the group g at the current values
+    of the state variables (e.g. to complete a starting solution)."""
+    if model.component('Aux_Obj') is None:
+        return
+    lifted = {}
+    for cut in node.get('cuts', {}).get('opt', {}).values():
+        g = cut.get('group', 0)
+        rhs = cut['e'] - sum(coef * value(_state_var(model, key))
+                             for key, coef in cut['E'].items())
+        if g not in lifted or rhs > lifted[g]:
+            lifted[g] = rhs
+    for g, rhs in lifted.items():
+        if g in model.Aux_Obj:
+            model.Aux_Obj[g].set_value(rhs, skip_validation=True)
+# ---------------------------------------------------------------------------- #
 
-    model._e = Param(model._Cuts_Opt,
-                    initialize=cuts['params']['e'])
 
-    #
-    # Variables
-    #
+# state_gradient ---------------------------------------------------------------
+def state_gradient(problem, params):
+    """Return the gradient of the optimal value of a solved problem with
+    respect to its state.
 
-    model.Aux_Obj = Var()
+    The problem must have been solved with duals. For each linking parameter
+    p the derivative is the derivative of the objective function minus the
+    sum over the constraints of the dual times the derivative of the
+    constraint (body minus bound) with respect to p.
 
-    #
-    # Obj
-    #
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): solved problem.
+        params (:obj:`dict`): linking parameters, see
+            :func:`ndusc.model.linking_params`.
 
-    for o in problem.component_objects(Objective, active=True):
-        if o.active:
-            problem._Obj = Objective(rule=o.rule+model.Aux_Obj)
-            o.deactivate()
+    Return:
+        :obj:`dict`: ``{(name, index): derivative}``.
+    """
+    keys = {}
+    for name, param in params.items():
+        for index in param:
+            keys[id(param[index])] = (name, index)
+    gradient = {key: 0.0 for key in keys.values()}
+
+    for o in problem.component_data_objects(Objective, active=True):
+        for p, d in _derivatives(o.expr, keys):
+            gradient[keys[id(p)]] += d
+
+    for c in problem.component_data_objects(Constraint, active=True):
+        dual = problem.dual.get(c)
+        if not dual:
+            continue
+        if c.upper is None or (c.lower is not None and not c.equality
+                               and dual > 0):
+            bound = c.lower
+        else:
+            bound = c.upper
+        for p, d in _derivatives(c.body, keys):
+            gradient[keys[id(p)]] -= dual * d
+        for p, d in _derivatives(bound, keys):
+            gradient[keys[id(p)]] += dual * d
+
+    return gradient
+# ---------------------------------------------------------------------------- #
 
-    #
-    # Constraints
-    #
 
-    def _opt_cuts_rule(model, l):
-        return sum(model.E[l,i]*model.Z[i] for i in model.Resources) >= model.e[l]
+# Technology -------------------------------------------------------------------
+class Technology(object):
+    """Linking (technology) matrix of a problem and its parent.
 
-    model._opt_cuts = Constraint(model._Cuts_Opt, rule=_opt_cuts_rule)
+    The constraints of the problem that contain linking parameters (the
+    rows) and the linking parameters (the columns, ``(name, index)`` keys)
+    are found once, and the derivatives of the constraints and the objective
+    function with respect to the parameters are stored in sparse matrices:
+    `body`, `lower` and `upper` (derivatives of the body and the bounds of
+    each row) and the vector `objective`. After each solve the gradient of
+    the optimal value with respect to the state is
+
+        ``objective - body.T @ duals + bound.T @ duals``
+
+    where the bound of each row is the active one.
+
+    If some derivative depends on the variables (the parameters multiply
+    variables) `linear` is False and :func:`state_gradient` must be used.
+    Derivatives that depend on other mutable parameters (e.g. the scenario
+    parameters of a shared model, see :class:`ndusc.model.Template`) are
+    evaluated again by :meth:`refresh`.
+
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): problem of the node.
+        params (:obj:`dict`): linking parameters, see
+            :func:`ndusc.model.linking_params`.
+    """
+
+    def __init__(self, problem, params):
+        self.columns = []
+        keys = {}
+        for name, param in params.items():
+            for index in param:
+                keys[id(param[index])] = len(self.columns)
+                self.columns.append((name, index))
+        self.linear = True
+        self._dynamic = []
+
+        self._objective = np.zeros(len(self.columns))
+        for o in problem.component_data_objects(Objective, active=True):
+            for j, d in self._derivatives(o.expr, keys):
+                if is_constant(d):
+                    self._objective[j] += value(d)
+                else:
+                    self._dynamic.append(('objective', j, d))
+
+        self.rows = []
+        has_lower, has_upper, equality = [], [], []
+        self._entries = {'body': ([], [], []), 'lower': ([], [], []),
+                         'upper': ([], [], [])}
+        for c in problem.component_data_objects(Constraint, active=True):
+            row = len(self.rows)
+            found = False
+            for part, expr in (('body', c.body), ('lower', c.lower),
+                               ('upper', c.upper)):
+                entries = self._entries[part]
+                for j, d in self._derivatives(expr, keys):
+                    if not is_constant(d):
+                        self._dynamic.append((part, len(entries[0]), d))
+                    entries[0].append(value(d))
+                    entries[1].append(row)
+                    entries[2].append(j)
+                    found = True
+            if found:
+                self.rows.append(c)
+                has_lower.append(c.lower is not None)
+                has_upper.append(c.upper is not None)
+                equality.append(c.equality)
+
+        self.has_lower = np.array(has_lower, dtype=bool)
+        self.has_upper = np.array(has_upper, dtype=bool)
+        self.equality = np.array(equality, dtype=bool)
+        self.objective = self._objective
+        self._matrices()
+        self.refresh()
+
+    def refresh(self):
+        """Evaluate again the derivatives that depend on mutable
+        parameters."""
+        if not self._dynamic:
+            return
+        self.objective = self._objective.copy()
+        for part, k, d in self._dynamic:
+            if part == 'objective':
+                self.objective[k] += value(d)
+            else:
+                self._entries[part][0][k] = value(d)
+        self._matrices()
+
+    def duals(self, problem):
+        """Return the duals of the rows in the solved `problem`."""
+        dual = problem.dual
+        return np.array([dual.get(c) or 0.0 for c in self.rows])
+
+    def gradient(self, problem, duals=None):
+        """Return the gradient of the optimal value of the solved `problem`
+        with respect to the state, aligned with `columns`.
+
+        Args:
+            duals (:obj:`numpy.ndarray`): duals of the `rows`. If None they
+                are read from the `dual` suffix of `problem`.
+        """
+        self.refresh()
+        if duals is None:
+            duals = self.duals(problem)
+        use_lower = self.has_lower & (~self.has_upper | (
+            ~self.equality & (duals > 0)))
+        return (self.objective - self.body.T @ duals
+                + self.lower.T @ (duals * use_lower)
+                + self.upper.T @ (duals * ~use_lower))
+
+    def _matrices(self):
+        shape = (len(self.rows), len(self.columns))
+        self.body, self.lower, self.upper = [
+            sparse.csr_matrix((data, (rows, cols)), shape=shape)
+            for data, rows, cols in (self._entries['body'],
+                                     self._entries['lower'],
+                                     self._entries['upper'])]
+
+    def _derivatives(self, expr, keys):
+        if expr is None or not hasattr(expr, 'is_expression_type'):
+            return []
+        derivatives = []
+        for p in identify_mutable_parameters(expr):
+            if id(p) not in keys:
+                continue
+            d = differentiate(expr, wrt=p, mode=Modes.reverse_symbolic)
+            if any(True for v in identify_variables(d, include_fixed=True)):
+                self.linear = False
+            else:
+                derivatives.append((keys[id(p)], d))
+        return derivatives
 # ---------------------------------------------------------------------------- #
 
 
-# compute_cuts -----------------------------------------------------------------
-def compute_feas_cuts(node, tree):
+# state_vector -----------------------------------------------------------------
+def state_vector(variables, columns):
+    """Return the values of the state `columns` in `variables`."""
+    return np.array([variables[name][index] for name, index in columns],
+                    dtype=np.float64)
+# ---------------------------------------------------------------------------- #
+
+
+# stack_gradients --------------------------------------------------------------
+def stack_gradients(columns, gradients):
+    """Stack the gradients of several problems.
+
+    Args:
+        columns (:obj:`list`): state columns of each gradient.
+        gradients (:obj:`list`): gradients (arrays).
+
+    Return:
+        :obj:`tuple`: union of the columns and matrix with one row per
+        gradient.
     """
+    if all(c == columns[0] for c in columns):
+        return list(columns[0]), np.vstack(gradients)
+    union = {}
+    for cols in columns:
+        for key in cols:
+            union.setdefault(key, len(union))
+    matrix = np.zeros((len(gradients), len(union)))
+    for k, (cols, gradient) in enumerate(zip(columns, gradients)):
+        matrix[k, [union[key] for key in cols]] = gradient
+    return list(union), matrix
+# ---------------------------------------------------------------------------- #
+
+
+# compute_feas_cuts ------------------------------------------------------------
+def compute_feas_cuts(node, infeasibility, columns, gradient, x):
+    """Add to `node` the feasibility cut of one of its children.
+
+    Args:
+        node (:obj:`dict`): parent node.
+        infeasibility (:obj:`float`): optimal value of the elastic problem
+            of the child (see :func:`elastic_problem`).
+        columns (:obj:`list`): state columns.
+        gradient (:obj:`numpy.ndarray`): gradient of the infeasibility with
+            respect to the state.
+        x (:obj:`numpy.ndarray`): state given to the child.
+
+    Return:
+        :obj:`int`: id of the cut, None if it is dominated.
     """
+    with instrument.span('compute cuts', node.get('cuts_id', node['id'])):
+        d = infeasibility - float(gradient @ x)
+        return add_cut(node, 'feas',
+                       {'D': dict(zip(columns, (-gradient).tolist())),
+                        'd': d})
+# ---------------------------------------------------------------------------- #
 
-    tree = compute_feas_cuts(tree)
-    tree = compute_feas_cuts(tree)
 
-    return tree
+# compute_opt_cuts -------------------------------------------------------------
+def compute_opt_cuts(node, columns, probabilities, values, gradients, x,
+                     groups=None):
+    """Add to `node` the optimality cuts built from its children.
+
+    For the children in each group g the cut is
+
+        ``E_g = - sum(p * gradient)``, ``e_g = sum(p * (value - gradient x))``
+
+    computed for all the groups at once as matrix products.
+
+    Args:
+        node (:obj:`dict`): parent node.
+        columns (:obj:`list`): state columns.
+        probabilities (:obj:`numpy.ndarray`): probability of each child
+            conditioned on `node`.
+        values (:obj:`numpy.ndarray`): optimal value of each child.
+        gradients (:obj:`numpy.ndarray`): gradient of the value of each child
+            (rows) with respect to the state.
+        x (:obj:`numpy.ndarray`): state given to the children, or one row
+            per child if they were solved at different states.
+        groups (:obj:`list`): group of each child. One cut is added for each
+            group. If None all the children are in the group 0.
+
+    Return:
+        :obj:`list`: ids of the cuts added (None for the dominated cuts).
+    """
+    with instrument.span('compute cuts', node.get('cuts_id', node['id'])):
+        return _opt_cuts(node, columns, probabilities, values, gradients, x,
+                         groups)
+
+
+def _opt_cuts(node, columns, probabilities, values, gradients, x, groups):
+    n = len(values)
+    if groups is None:
+        groups = [0] * n
+    codes = {}
+    for g in groups:
+        codes.setdefault(g, len(codes))
+    weights = np.zeros((len(codes), n))
+    weights[[codes[g] for g in groups], np.arange(n)] = probabilities
+
+    x = np.asarray(x)
+    E = -weights @ gradients
+    if x.ndim == 2:
+        e = weights @ (np.asarray(values) - (gradients * x).sum(axis=1))
+    else:
+        e = weights @ (np.asarray(values) - gradients @ x)
+    return [add_cut(node, 'opt', {'E': dict(zip(columns, E[k].tolist())),
+                                  'e': float(e[k]), 'group': g})
+            for g, k in codes.items()]
 # ---------------------------------------------------------------------------- #
 
 
-# compute_feas_cuts ------------------------------------------------------------
-def compute_feas_cuts(node, tree):
+# cut_groups -------------------------------------------------------------------
+def cut_groups(node, children_ids, values, gradients, mode='single', k=None):
+    """Return the group of the optimality cuts of each child of `node`.
+
+    Args:
+        node (:obj:`dict`): parent node.
+        children_ids (:obj:`list`): ids of the children.
+        values (:obj:`numpy.ndarray`): optimal value of each child.
+        gradients (:obj:`numpy.ndarray`): gradient of each child, see
+            :func:`compute_opt_cuts`.
+        mode (:obj:`str`): 'single' (one group), 'multi' (one group per
+            child) or 'hybrid' (`k` groups).
+        k (:obj:`int`): number of groups of the hybrid mode.
+
+    The hybrid groups are computed the first time, clustering the children
+    by their first linearization (value and gradient), and kept in
+    ``node['cut_groups']`` so each `Aux_Obj[g]` always approximates the same
+    children.
     """
+    if mode == 'single':
+        return [0] * len(children_ids)
+    if mode == 'multi':
+        return list(children_ids)
+    if mode != 'hybrid':
+        raise ValueError('Unknown cut mode: {}'.format(mode))
+
+    if 'cut_groups' not in node:
+        points = np.column_stack([values, gradients])
+        labels = cluster(points, k or 1)
+        node['cut_groups'] = dict(zip(children_ids, labels.tolist()))
+    return [node['cut_groups'][nodeid] for nodeid in children_ids]
+# ---------------------------------------------------------------------------- #
+
+
+# cluster ----------------------------------------------------------------------
+def cluster(points, k, max_iter=100):
+    """Deterministic k-means of the rows of `points`.
+
+    The columns are scaled to unit range and the centers are initialized by
+    farthest point selection from the first point.
+
+    Return:
+        :obj:`numpy.ndarray`: group (0, ..., k-1) of each point.
     """
+    n = points.shape[0]
+    k = min(k, n)
+    scale = points.max(axis=0) - points.min(axis=0)
+    scale[scale == 0] = 1.0
+    points = (points - points.min(axis=0)) / scale
+
+    centers = [0]
+    distance = ((points - points[0]) ** 2).sum(axis=1)
+    while len(centers) < k:
+        centers.append(int(distance.argmax()))
+        distance = np.minimum(
+            distance, ((points - points[centers[-1]]) ** 2).sum(axis=1))
+    centers = points[centers]
+
+    labels = np.zeros(n, dtype=np.int64)
+    for iteration in range(max_iter):
+        distances = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(
+            axis=2)
+        new_labels = distances.argmin(axis=1)
+        if iteration > 0 and (new_labels == labels).all():
+            break
+        labels = new_labels
+        for g in range(k):
+            if (labels == g).any():
+                centers[g] = points[labels == g].mean(axis=0)
+    return labels
+# ---------------------------------------------------------------------------- #
 
 
+# stage_family -----------------------------------------------------------------
+def stage_family(cut_family, stage):
+    """Return the family of the optimality cuts computed from the nodes of
+    `stage`:
+
+        - 'benders': from the duals of the problems (of their relaxation if
+          they have integer variables).
+        - 'integer': integer L-shaped cuts (Laporte and Louveaux), from the
+          value of the problems and a lower bound of their value at any
+          state (see :func:`integer_gradient`).
+        - 'strengthened': strengthened Benders cuts, the Benders cut moved
+          up to the Lagrangian relaxation of the copy of the state (see
+          :func:`lagrangian_problem`) at the duals.
+        - 'lagrangian': Lagrangian cuts, the multipliers of the strengthened
+          cut improved by subgradient steps.
+
+    The families other than 'benders' need binary states, and add no-good
+    feasibility cuts (see :func:`compute_nogood_cut`) for the infeasible
+    nodes whose relaxation is feasible.
+
+    Args:
+        cut_family: family of all the stages, or dictionary stage ->
+            family (the stages not in it use 'benders').
+
+    Raises:
+        ValueError: if the family is unknown.
+    """
+    if isinstance(cut_family, dict):
+        family = cut_family.get(stage, 'benders')
+    else:
+        family = cut_family or 'benders'
+    if family not in cut_families:
+        raise ValueError('Unknown cut family: {}'.format(family))
+    return family
+# ---------------------------------------------------------------------------- #
+
+
+# binary_state -----------------------------------------------------------------
+def binary_state(x, tol=1e-6):
+    """Return the state `x` rounded to 0 and 1.
 
-    return tree
+    Raises:
+        ValueError: if some value of `x` is not binary.
+    """
+    rounded = np.round(x)
+    if ((rounded != 0) & (rounded != 1)).any() or \
+            (np.abs(x - rounded) > tol).any():
+        raise ValueError('Integer and Lagrangian cuts need binary states')
+    return rounded
 # ---------------------------------------------------------------------------- #
 
 
-# compute_opt_cuts -------------------------------------------------------------
-def compute_feas_cuts(node, tree):
+# integer_gradient -------------------------------------------------------------
+def integer_gradient(value, bound, x):
+    """Return the gradient of the integer L-shaped cut of a node.
+
+    With S the state variables at 1 in the binary state `x`, the cut
+
+        ``theta >= (value - bound) * (sum_S x_i - sum_notS x_i - |S| + 1)
+        + bound``
+
+    is `value` at `x` and at most `bound` at any other binary state, so it
+    is valid if `value` is (a lower bound of) the value of the node at `x`
+    and `bound` a lower bound of its value at any state. Its gradient is
+    ``(value - bound) * (2 x - 1)``.
+    """
+    return (value - bound) * (2 * x - 1)
+# ---------------------------------------------------------------------------- #
+
+
+# compute_nogood_cut -----------------------------------------------------------
+def compute_nogood_cut(node, columns, x):
+    """Add to `node` the feasibility cut that removes the binary state `x`
+    given to one of its children:
+
+        ``sum_S (1 - x_i) + sum_notS x_i >= 1``
+
+    Return:
+        :obj:`int`: id of the cut, None if it is dominated.
     """
+    with instrument.span('compute cuts', node.get('cuts_id', node['id'])):
+        x = binary_state(x)
+        return add_cut(node, 'feas',
+                       {'D': dict(zip(columns, (1 - 2 * x).tolist())),
+                        'd': float(1 - x.sum())})
+# ---------------------------------------------------------------------------- #
+
+
+# lagrangian_problem -----------------------------------------------------------
+def lagrangian_problem(problem, params):
+    """Return the Lagrangian relaxation of the copy of the state of a
+    problem.
+
+    The linking parameters of a clone of `problem` are replaced by binary
+    variables `_Copy[j]`, free copies of the state (aligned with the
+    `columns` of :class:`Technology`, in `_copy_columns`), and the term
+    ``- sum(_Multiplier[j] * _Copy[j])`` is added to the objective, with
+    mutable multipliers. If L is its optimal value with the multipliers pi,
+
+        ``theta >= L + pi x``
+
+    is a valid cut of the value of the problem at the binary states x.
     """
-    return tree
+    with instrument.span('lagrangian'):
+        return _lagrangian_problem(problem, params)
+
+
+def _lagrangian_problem(problem, params):
+    lagrangian = problem.clone()
+    columns, copies = [], []
+    for name, param in params.items():
+        param = lagrangian.component(param.local_name)
+        for index in param:
+            columns.append((name, index))
+            copies.append(param[index])
+    n = len(columns)
+    lagrangian._Copy = Var(range(n), domain=Binary)
+    lagrangian._Multiplier = Param(range(n), mutable=True, initialize=0.0)
+    lagrangian._copy_columns = columns
+    substitution = {id(p): lagrangian._Copy[j] for j, p in enumerate(copies)}
+
+    lagrangian._Copies = ConstraintList()
+    for c in list(lagrangian.component_data_objects(Constraint, active=True)):
+        parts = (c.body, c.lower, c.upper)
+        if not any(id(p) in substitution for part in parts
+                   if part is not None
+                   for p in identify_mutable_parameters(part)):
+            continue
+        body, lower, upper = [_substitute(part, substitution)
+                              for part in parts]
+        if c.equality:
+            lagrangian._Copies.add(body - upper == 0)
+        else:
+            if lower is not None:
+                lagrangian._Copies.add(body - lower >= 0)
+            if upper is not None:
+                lagrangian._Copies.add(body - upper <= 0)
+        c.deactivate()
+
+    expr = 0
+    for o in list(lagrangian.component_data_objects(Objective, active=True)):
+        expr = _substitute(o.expr, substitution)
+        o.deactivate()
+    lagrangian._Lagrangian_Obj = Objective(
+        expr=expr - sum(lagrangian._Multiplier[j] * lagrangian._Copy[j]
+                        for j in range(n)),
+        sense=minimize)
+    return lagrangian
 # ---------------------------------------------------------------------------- #
+
+
+# elastic_problem --------------------------------------------------------------
+def elastic_problem(problem):
+    """Return the elastic (phase 1) version of an infeasible problem.
+
+    Every constraint gets non negative slack variables, integer variables are
+    relaxed and the objective is the sum of the slacks.
+    """
+    with instrument.span('elastic'):
+        return _elastic_problem(problem)
+
+
+def _elastic_problem(problem):
+    elastic = problem.clone()
+    for o in list(elastic.component_data_objects(Objective, active=True)):
+        o.deactivate()
+    for v in elastic.component_data_objects(Var, active=True):
+        if not v.is_continuous():
+            lb, ub = v.bounds
+            v.domain = Reals
+            v.setlb(lb)
+            v.setub(ub)
+
+    elastic._Slack = VarList(domain=NonNegativeReals)
+    elastic._Elastic = ConstraintList()
+    for c in list(elastic.component_data_objects(Constraint, active=True)):
+        if c.equality:
+            s_up = elastic._Slack.add()
+            s_lo = elastic._Slack.add()
+            elastic._Elastic.add(c.body + s_lo - s_up == c.upper)
+        else:
+            if c.lower is not None:
+                s_lo = elastic._Slack.add()
+                elastic._Elastic.add(c.body + s_lo >= c.lower)
+            if c.upper is not None:
+                s_up = elastic._Slack.add()
+                elastic._Elastic.add(c.body - s_up <= c.upper)
+        c.deactivate()
+
+    elastic._Elastic_Obj = Objective(expr=sum(elastic._Slack.values()),
+                                     sense=minimize)
+    return elastic
+# ---------------------------------------------------------------------------- #
+
+
+def _derivatives(expr, keys):
+    """Derivatives of `expr` with respect to the linking params in it."""
+    if expr is None or not hasattr(expr, 'is_expression_type'):
+        return []
+    return [(p, value(differentiate(expr, wrt=p,
+                                    mode=Modes.reverse_symbolic)))
+            for p in identify_mutable_parameters(expr) if id(p) in keys]
+
+
+def _substitute(expr, substitution):
+    """`expr` with the parameters in `substitution` (id -> variable)
+    replaced."""
+    if id(expr) in substitution:
+        return substitution[id(expr)]
+    if hasattr(expr, 'is_expression_type') and expr.is_expression_type():
+        return replace_expressions(expr, substitution)
+    return expr
+
+
+def _state_var(model, key):
+    name, index = key
+    return model.component(name)[index]
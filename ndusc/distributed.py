@@ -0,0 +1,568 @@
+"""Distributed executor: a coordinator and workers on other hosts.
+
+The process running :func:`ndusc.nd.nested_decomposition` with
+``executor='distributed'`` is the coordinator. It keeps the tree, the cut
+pools and the bounds, and sends the problems of the nodes to workers over
+TCP. Each worker owns whole subtrees of the tree: the nodes of the first
+stage with at least as many nodes as workers, with all their descendants,
+are assigned to the workers balancing their number of nodes (the nodes of
+the stages above it are assigned one by one). A worker keeps the models of
+its nodes alive, and receives with each task the trial solution of the
+parent of the node and the changes of its live cuts.
+
+If the connection to a worker is lost its subtrees are reassigned to the
+remaining workers (the least loaded first). They get the nodes, and all
+their live cuts with their next task, and the tasks that were running on
+the lost worker are sent again.
+
+A worker is started with::
+
+    python -m ndusc.distributed --host 0.0.0.0 --port 5000
+
+from a directory where the model files of the tree are found (they are
+given by their paths), and its address is passed to the coordinator::
+
+    nd.nested_decomposition(tree, data, executor='distributed',
+                            workers=['host1:5000', 'host2:5000'])
+
+``workers=n`` starts `n` workers on localhost, which is how a distributed
+run is tested on a single machine.
+
+Messages are frames of a header ``(type, length)`` (:data:`HEADER`) and a
+payload of `length` bytes encoded by :func:`encode`: a tagged binary format
+of the values used by the decomposition (numbers, strings, lists, tuples,
+dictionaries and numpy arrays, sent as their raw data). The coordinator
+sends `INIT` (data, solver, persistent, shared, hot_start, backend), then
+`TASK` (kind, nodes assigned since the previous task, batch of tasks)
+messages, answered by `RESULT` or `ERROR` (traceback of the worker), and
+`CLOSE`.
+"""
+
+import argparse
+import heapq
+import logging as log
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pyomo.opt.results import container
+
+from ndusc import instrument
+from ndusc import parallel
+
+INIT, TASK, RESULT, ERROR, CLOSE = range(1, 6)
+
+HEADER = struct.Struct('!BI')
+
+
+class Worker_lost(Exception):
+    """The connection to a worker was lost."""
+
+
+class Distributed_executor(object):
+    """Solves the tasks in workers connected over TCP.
+
+    Args:
+        tree_nc (:obj:`ndusc.tree.Tree`): scenario tree.
+        data (:obj:`dict`): dictionary with problem data.
+        solver (:obj:`str`): solver name.
+        persistent (:obj:`bool`): see :class:`ndusc.model.Persistent_models`.
+        workers: addresses (``'host:port'``) of the workers, or number of
+            workers to start on localhost (default: number of cpus).
+        shared, hot_start (:obj:`bool`), backend (:obj:`str`): see
+            :class:`ndusc.model.Persistent_models`.
+    """
+
+    def __init__(self, tree_nc, data, solver='gurobi', persistent=True,
+                 workers=None, shared=True, hot_start=False,
+                 backend='pyomo'):
+        self.processes = []
+        if workers is None or isinstance(workers, int):
+            self.processes = start_local_workers(workers or os.cpu_count())
+            workers = [address for process, address in self.processes]
+        self.addresses = list(workers)
+        self.workers = len(self.addresses)
+
+        self.subtree, self.members = assign_subtrees(tree_nc, self.workers)
+        self.sent = {node['id']: {'feas': set(), 'opt': set()}
+                     for node in tree_nc.nodes}
+        self.data_nodes = {node['id']: parallel._data_node(node)
+                           for node in tree_nc.nodes}
+        self.tree = tree_nc
+
+        self.state_lock = threading.Lock()
+        self.locks = [threading.Lock() for k in range(self.workers)]
+        self.sockets = [None] * self.workers
+        self.alive = [False] * self.workers
+        self.known = [set() for k in range(self.workers)]
+        self.pending = [[] for k in range(self.workers)]
+        self.load = [0] * self.workers
+        self.owner = {}
+
+        init = (data, solver, persistent, shared, hot_start, backend)
+        for k, address in enumerate(self.addresses):
+            try:
+                self.sockets[k] = connect(address)
+                send_message(self.sockets[k], INIT, init)
+                _result(receive_message(self.sockets[k]), address)
+                self.alive[k] = True
+            except OSError as error:
+                log.warning('Worker {} not available: {}'.format(address,
+                                                                 error))
+        if not any(self.alive):
+            self.close()
+            raise RuntimeError('No worker available')
+        with self.state_lock:
+            self._assign(sorted(self.members,
+                                key=lambda key: -len(self.members[key])))
+        self.dispatcher = ThreadPoolExecutor(max_workers=self.workers)
+        log.info('Connected to {} workers'.format(sum(self.alive)))
+
+    def solve(self, tasks):
+        """See :meth:`ndusc.parallel.Serial_executor.solve`."""
+        return self._map('solve', tasks)
+
+    def feasibility(self, tasks):
+        """See :meth:`ndusc.parallel.Serial_executor.feasibility`."""
+        return self._map('feasibility', [(n, s, True) for n, s in tasks])
+
+    def submit(self, kind, task):
+        """See :meth:`ndusc.parallel.Serial_executor.submit`."""
+        return self.dispatcher.submit(lambda: self._map(kind, [task])[0])
+
+    def close(self):
+        if getattr(self, 'dispatcher', None) is not None:
+            self.dispatcher.shutdown()
+        for k, sock in enumerate(self.sockets):
+            if sock is None:
+                continue
+            try:
+                if self.alive[k]:
+                    send_message(sock, CLOSE, None)
+            except OSError:
+                pass
+            sock.close()
+        for process, address in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def _map(self, kind, tasks):
+        output = [None] * len(tasks)
+        left = list(range(len(tasks)))
+        while left:
+            with self.state_lock:
+                if not any(self.alive):
+                    raise RuntimeError('All the workers were lost')
+                batches = {}
+                for position in left:
+                    nodeid = tasks[position][0]['id']
+                    k = self.owner[self.subtree[nodeid]]
+                    batches.setdefault(k, []).append(position)
+            if len(batches) == 1:
+                (k, positions), = batches.items()
+                results = {k: self._batch(k, kind, tasks, positions)}
+            else:
+                futures = {k: self.dispatcher.submit(self._batch, k, kind,
+                                                     tasks, positions)
+                           for k, positions in batches.items()}
+                results = {k: future.result()
+                           for k, future in futures.items()}
+            left = []
+            for k, positions in batches.items():
+                if results[k] is None:
+                    # Lost worker: send its tasks to the new owners
+                    left.extend(positions)
+                    continue
+                for position, result in zip(positions, results[k]):
+                    output[position] = result
+        return output
+
+    def _batch(self, k, kind, tasks, positions):
+        """Send the tasks at `positions` to the worker `k`.
+
+        Return:
+            :obj:`list`: results of the tasks, None if the worker was lost
+            or does not own all their nodes anymore.
+        """
+        with self.locks[k]:
+            with self.state_lock:
+                if not self.alive[k] or any(
+                        self.owner[self.subtree[tasks[p][0]['id']]] != k
+                        for p in positions):
+                    return None
+                assigned = self._assignment(k)
+                batch = [(tasks[p][0]['id'], tasks[p][1:],
+                          self._new_cuts(tasks[p][0])) for p in positions]
+            start = time.perf_counter()
+            try:
+                send_message(self.sockets[k], TASK, (kind, assigned, batch))
+                message = receive_message(self.sockets[k])
+            except (OSError, Worker_lost) as error:
+                self._lost(k, error)
+                return None
+            instrument.record('worker', start, time.perf_counter(),
+                              self.addresses[k], tasks=len(batch))
+        return _result(message, self.addresses[k])
+
+    def _assign(self, keys):
+        """Assign the subtrees `keys` to the least loaded workers."""
+        heap = [(self.load[k], k) for k in range(self.workers)
+                if self.alive[k]]
+        heapq.heapify(heap)
+        for key in keys:
+            load, k = heapq.heappop(heap)
+            self.owner[key] = k
+            self.pending[k].append(key)
+            self.load[k] += len(self.members[key])
+            heapq.heappush(heap, (self.load[k], k))
+
+    def _assignment(self, k):
+        """Nodes of the subtrees assigned to `k` since its last task, and
+        the data of their ancestors it does not have."""
+        nodes = []
+        ancestors = []
+        for key in self.pending[k]:
+            for nodeid in self.members[key]:
+                node = self.tree.return_node(nodeid)
+                nodes.append(parallel._static_node(node))
+                self.known[k].add(nodeid)
+                self.sent[nodeid] = {'feas': set(), 'opt': set()}
+                for ancestor in self.tree.return_ancestors(nodeid)[:-1]:
+                    if ancestor not in self.known[k]:
+                        self.known[k].add(ancestor)
+                        ancestors.append(self.data_nodes[ancestor])
+        self.pending[k] = []
+        return nodes, ancestors
+
+    def _lost(self, k, error):
+        with self.state_lock:
+            if not self.alive[k]:
+                return
+            self.alive[k] = False
+            self.sockets[k].close()
+            keys = [key for key, owner in self.owner.items() if owner == k]
+            log.warning('Lost worker {} ({}), reassigning {} subtrees'.format(
+                self.addresses[k], error, len(keys)))
+            if any(self.alive):
+                self._assign(sorted(keys,
+                                    key=lambda key: -len(self.members[key])))
+
+    def _new_cuts(self, node):
+        new_cuts = {}
+        for kind, live in node.get('cuts', {}).items():
+            sent = self.sent[node['id']][kind]
+            added = {cid: cut for cid, cut in live.items() if cid not in sent}
+            removed = [cid for cid in sent if cid not in live]
+            if added or removed:
+                new_cuts[kind] = (added, removed)
+                sent.update(added)
+                sent.difference_update(removed)
+        return new_cuts
+
+
+def assign_subtrees(tree_nc, workers):
+    """Split the tree in subtrees to distribute among `workers`.
+
+    The subtrees are rooted at the nodes of the first stage with at least
+    `workers` nodes (the last stage if none). The nodes of the stages above
+    it are subtrees of one node.
+
+    Return:
+        :obj:`tuple`: node id -> key of its subtree, and key -> node ids of
+        the subtree (in the order of the tree). The key of a subtree is the
+        id of its root.
+    """
+    depth = len(tree_nc.stages) - 1
+    for k, stage in enumerate(tree_nc.stages):
+        if len(tree_nc.return_stage_nodes(stage)) >= workers:
+            depth = k
+            break
+    subtree = {}
+    members = {}
+    for node in tree_nc.nodes:
+        path = tree_nc.return_ancestors(node['id'])
+        key = path[depth] if len(path) > depth else node['id']
+        subtree[node['id']] = key
+        members.setdefault(key, []).append(node['id'])
+    return subtree, members
+
+
+def start_local_workers(n):
+    """Start `n` workers on localhost.
+
+    Return:
+        :obj:`list`: ``(process, address)`` of each worker.
+    """
+    env = dict(os.environ)
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package] + [p for p in [env.get('PYTHONPATH')] if p])
+    processes = [subprocess.Popen(
+        [sys.executable, '-m', 'ndusc.distributed', '--port', '0', '--once'],
+        stdout=subprocess.PIPE, env=env, universal_newlines=True)
+        for k in range(n)]
+    workers = []
+    for process in processes:
+        # The worker prints its address once it listens
+        address = process.stdout.readline().split()[-1]
+        process.stdout.close()
+        workers.append((process, address))
+    return workers
+
+
+def connect(address):
+    """Open a connection to the worker at `address` (``'host:port'``)."""
+    host, port = address.rsplit(':', 1)
+    sock = socket.create_connection((host, int(port)))
+    _configure(sock)
+    return sock
+
+
+def _configure(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Detect the hosts that disappear without closing the connection
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', 10), ('TCP_KEEPINTVL', 5),
+                          ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                            value)
+
+
+def _result(message, address):
+    kind, payload = message
+    if kind == ERROR:
+        raise RuntimeError('Worker {} failed:\n{}'.format(address, payload))
+    return payload
+
+
+# Messages --------------------------------------------------------------------
+def send_message(sock, kind, value):
+    """Send the message of type `kind` with payload `value`."""
+    payload = encode(value)
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+    instrument.count('bytes_sent', HEADER.size + len(payload))
+
+
+def receive_message(sock):
+    """Return the next message, ``(type, payload)``.
+
+    Raises:
+        Worker_lost: if the connection is closed.
+    """
+    kind, length = HEADER.unpack(_receive(sock, HEADER.size))
+    instrument.count('bytes_received', HEADER.size + length)
+    return kind, decode(_receive(sock, length))
+
+
+def _receive(sock, n):
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    position = 0
+    while position < n:
+        received = sock.recv_into(view[position:], n - position)
+        if not received:
+            raise Worker_lost('Connection closed')
+        position += received
+    return buffer
+
+
+_int = struct.Struct('!q')
+_float = struct.Struct('!d')
+_size = struct.Struct('!I')
+
+
+def encode(value):
+    """Encode `value` in the binary format of the messages.
+
+    The values are None, bool, int, float, str, bytes, list, tuple, dict,
+    numpy arrays and scalars, and the values of Pyomo's results containers
+    (the solver information of a full solution, see
+    :func:`ndusc.format_sol.get_solver_info`), sent as their value.
+
+    Raises:
+        TypeError: if `value` contains a value of another type.
+    """
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def _encode(value, out):
+    if value is None:
+        out += b'N'
+    elif value is True or value is False:
+        out += b'T' if value else b'F'
+    elif isinstance(value, np.generic) and not isinstance(value, np.ndarray):
+        _encode(value.item(), out)
+    elif isinstance(value, container.UndefinedData):
+        out += b'N'
+    elif isinstance(value, container.ScalarData):
+        _encode(value.value, out)
+    elif isinstance(value, int):
+        if -2 ** 63 <= value < 2 ** 63:
+            out += b'i' + _int.pack(value)
+        else:
+            data = str(value).encode()
+            out += b'I' + _size.pack(len(data)) + data
+    elif isinstance(value, float):
+        out += b'f' + _float.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b's' + _size.pack(len(data)) + data
+    elif isinstance(value, bytes):
+        out += b'b' + _size.pack(len(value)) + value
+    elif isinstance(value, (list, tuple)):
+        out += (b'l' if isinstance(value, list) else b't') \
+            + _size.pack(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b'd' + _size.pack(len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        dtype = value.dtype.str.encode()
+        out += b'a' + bytes([len(dtype)]) + dtype + bytes([value.ndim])
+        for n in value.shape:
+            out += _size.pack(n)
+        out += value.tobytes()
+    else:
+        raise TypeError('Can not send {!r} ({}) to a worker'.format(
+            value, type(value).__name__))
+
+
+def decode(data):
+    """Decode a value encoded by :func:`encode`."""
+    value, position = _decode(memoryview(data), 0)
+    return value
+
+
+def _decode(data, position):
+    tag = data[position:position + 1].tobytes()
+    position += 1
+    if tag == b'N':
+        return None, position
+    if tag in (b'T', b'F'):
+        return tag == b'T', position
+    if tag == b'i':
+        return _int.unpack_from(data, position)[0], position + _int.size
+    if tag == b'f':
+        return _float.unpack_from(data, position)[0], position + _float.size
+    if tag == b'a':
+        n = data[position]
+        dtype = np.dtype(data[position + 1:position + 1 + n].tobytes()
+                         .decode())
+        position += 1 + n
+        ndim = data[position]
+        position += 1
+        shape = tuple(_size.unpack_from(data, position + 4 * k)[0]
+                      for k in range(ndim))
+        position += 4 * ndim
+        size = int(np.prod(shape)) * dtype.itemsize
+        value = np.frombuffer(data[position:position + size], dtype=dtype)
+        return value.reshape(shape).copy(), position + size
+    n = _size.unpack_from(data, position)[0]
+    position += _size.size
+    if tag in (b's', b'b', b'I'):
+        raw = data[position:position + n].tobytes()
+        value = raw if tag == b'b' else raw.decode()
+        return (int(value) if tag == b'I' else value), position + n
+    if tag in (b'l', b't'):
+        items = []
+        for k in range(n):
+            item, position = _decode(data, position)
+            items.append(item)
+        return (items if tag == b'l' else tuple(items)), position
+    if tag == b'd':
+        value = {}
+        for k in range(n):
+            key, position = _decode(data, position)
+            value[key], position = _decode(data, position)
+        return value, position
+    raise ValueError('Unknown tag: {!r}'.format(tag))
+# --------------------------------------------------------------------------- #
+
+
+# Worker ----------------------------------------------------------------------
+def serve(host='localhost', port=0, once=False):
+    """Run a worker, serving one coordinator at a time.
+
+    Args:
+        host (:obj:`str`): interface to listen on.
+        port (:obj:`int`): port to listen on (0 for any free port).
+        once (:obj:`bool`): if True stop after the first coordinator.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen()
+    print('Listening on {}:{}'.format(*listener.getsockname()[:2]),
+          flush=True)
+    with listener:
+        while True:
+            conn, address = listener.accept()
+            log.info('Coordinator {}:{} connected'.format(*address[:2]))
+            _configure(conn)
+            with conn:
+                try:
+                    _serve(conn)
+                except (OSError, Worker_lost) as error:
+                    log.warning('Coordinator lost: {}'.format(error))
+            if once:
+                break
+
+
+def _serve(conn):
+    nodes = {}
+    data_nodes = {}
+    node_solver = None
+    while True:
+        kind, payload = receive_message(conn)
+        if kind == CLOSE:
+            return
+        try:
+            if kind == INIT:
+                data, solver, persistent, shared, hot_start, backend = payload
+                node_solver = parallel.Node_solver(
+                    data, solver, persistent, shared=shared,
+                    nodes=data_nodes, hot_start=hot_start, backend=backend)
+                send_message(conn, RESULT, None)
+                continue
+            task_kind, (assigned, ancestors), batch = payload
+            for ancestor in ancestors:
+                data_nodes.setdefault(ancestor['id'], ancestor)
+            for node in assigned:
+                nodes[node['id']] = data_nodes[node['id']] = node
+            function = getattr(node_solver, task_kind)
+            parallel._apply_cuts(nodes, batch)
+            results = [function(nodes[nodeid], *args)
+                       for nodeid, args, new_cuts in batch]
+            send_message(conn, RESULT, results)
+        except Exception:
+            send_message(conn, ERROR, traceback.format_exc())
+# --------------------------------------------------------------------------- #
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Worker of the distributed nested decomposition.')
+    parser.add_argument('--host', default='localhost',
+                        help='interface to listen on')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='port to listen on (0 for any free port)')
+    parser.add_argument('--once', action='store_true',
+                        help='stop after the first coordinator')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.once)
@@ -1,4 +1,6 @@
+import numpy as np
 from pyomo.environ import *
+from pyomo.core.expr.visitor import identify_variables
 
 # get_solution -----------------------------------------------------------------
 def get_solution(problem, solver_results, duals):
@@ -46,22 +48,9 @@ def get_constraints(problem):
     for c in problem.component_objects(Constraint, active=True):
         results[c.getname()] = {}
         cobject = getattr(problem, str(c))
-        for index in cbject:
-            results[c.getname()][index]['dual'] = problem.dual[cobject[index]]
-    
-    return results
-# ---------------------------------------------------------------------------- #
-
-# get_constraints --------------------------------------------------------------
-def get_constraints(problem):
-    """
-    """
-    results = {}
-    for c in problem.component_objects(Constraint, active=True):
-        results[c.getname()] = {}
-        cobject = getattr(problem, str(c))
-        for index in cbject:
-            results[c.getname()][index]['dual'] = problem.dual[cobject[index]]
+        for index in cobject:
+            results[c.getname()][index] = {
+                'dual': problem.dual.get(cobject[index])}
     
     return results
 # ---------------------------------------------------------------------------- #
@@ -84,4 +73,75 @@ def get_solver_info(solver_results):
     """
     """
     return solver_results['Solver'][0]
-# ---------------------------------------------------------------------------- #
\ No newline at end of file
+# --------------------------------------------------------------------------- #
+
+
+# Extraction_plan -------------------------------------------------------------
+class Extraction_plan(object):
+    """Precompiled extraction of the solution values used by the algorithm.
+
+    Only the state variables (those that feed the children of the node),
+    the future cost variables (`Aux_Obj`) and the objective value are needed
+    to drive the decomposition. The plan records once the variable objects of
+    the state, and after each solve reads their values into the preallocated
+    array `values`, aligned with `columns`. If asked, the duals of the
+    constraints `rows` (those that appear in the cut formulas, see
+    :class:`ndusc.cuts.Technology`) are read in the same way into `duals`.
+    :func:`get_solution` gives the full solution, for reporting.
+
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): problem of the node.
+        names (:obj:`list`): names of the state variables.
+        rows (:obj:`list`): constraints whose duals are extracted.
+    """
+
+    def __init__(self, problem, names, rows=()):
+        self.columns = []
+        self.vars = []
+        for name in names:
+            var = problem.component(name)
+            if isinstance(var, Var):
+                for index, v in var.items():
+                    self.columns.append((name, index))
+                    self.vars.append(v)
+        self.values = np.zeros(len(self.vars))
+        self.rows = list(rows)
+        self.duals = np.zeros(len(self.rows))
+        objective = getattr(problem, '_cut_info', {}).get('objective')
+        if objective is None:
+            objective = next(problem.component_data_objects(Objective,
+                                                            active=True))
+        self.objective_vars = list(identify_variables(objective.expr))
+
+    def load_vars(self, problem):
+        """Return the variables whose values must be loaded: those of the
+        plan, of the objective, `Aux_Obj` and the deviations of the
+        stabilization (see :mod:`ndusc.stabilization`)."""
+        variables = self.vars + self.objective_vars
+        for name in ('Aux_Obj', '_Stab_Dev'):
+            var = problem.component(name)
+            if var is not None:
+                variables.extend(var.values())
+        return variables
+
+    def extract(self, problem, duals=None):
+        """Return the results of the solved `problem`: `objective`,
+        `variables` (state and `Aux_Obj`), `state` (columns and values) and,
+        if `duals` (mapping constraint -> dual, e.g. the `dual` suffix) is
+        given, the array of `duals` of the rows.
+        """
+        self.values[:] = [v.value for v in self.vars]
+        variables = {}
+        for (name, index), value in zip(self.columns, self.values.tolist()):
+            variables.setdefault(name, {})[index] = value
+        aux = problem.component('Aux_Obj')
+        if aux is not None:
+            variables['Aux_Obj'] = {g: v.value for g, v in aux.items()}
+        results = {'objective': get_objective(problem),
+                   'variables': variables,
+                   'state': (self.columns, self.values.copy())}
+        if duals is not None:
+            self.duals[:] = [duals.get(c) or 0.0 for c in self.rows]
+            results['duals'] = self.duals.copy()
+        return results
+# --------------------------------------------------------------------------- #
@@ -1,19 +1,320 @@
+"""Load the tree and the data of a problem.
+
+Two formats are supported:
+
+    - `yaml`: the tree and data files. They are parsed with the libyaml C
+      parser when PyYAML has it, and the nodes of the tree are built one at
+      a time from the parser events (:meth:`Input_module.iter_nodes`).
+    - `npy`: a directory of numpy arrays for the tree and another one for
+      the data, written by :meth:`Input_module.convert`. The arrays are
+      loaded by memory map.
+
+The columnar (`npy`) directories have:
+
+    - `id`, `prev_id`, `has_prev`, `stage`, `probability`: one value per
+      node (the data is a single record without them).
+    - `extras` and `extra`: the other keys of the nodes (model, sets, ...)
+      as python literals, stored once, and the code of each node. The nodes
+      loaded with the same extras share their values (e.g. the `model`
+      dictionary).
+    - `param_names` and, for the k-th numeric parameter, `param<k>_node`
+      (record of each value), `param<k>_index` (code of its index),
+      `param<k>_labels` (indices as python literals) and `param<k>_value`.
+      Parameters that are not numbers, or dictionaries of numbers, are kept
+      in the extras.
+"""
+
+import ast
+import os
+from array import array
+
+import numpy as np
 import yaml
 
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+formats = ('yaml', 'npy')
+
+_node_columns = ('id', 'prev_id', 'stage', 'probability')
+
 
 class Input_module():
+    """Loader of the tree and data of a problem.
+
+    Args:
+        path_data (:obj:`str`): data file (`yaml`) or directory (`npy`).
+        path_tree (:obj:`str`): tree file (`yaml`) or directory (`npy`).
+        format (:obj:`str`): 'yaml' or 'npy'.
+
+    Example:
+        >>> yaml_input = Input_module('data/data.yaml', 'data/tree.yaml')
+        >>> yaml_input.convert('data/data.npy', 'data/tree.npy')
+        >>> npy_input = Input_module('data/data.npy', 'data/tree.npy',
+        ...                          format='npy')
+        >>> tree = npy_input.load_tree()
+    """
 
     def __init__(self, path_data, path_tree, format="yaml"):
+        if format not in formats:
+            raise ValueError('Unknown format: {}'.format(format))
         self.path_data = path_data
         self.path_tree = path_tree
         self.format = format
 
     def load_tree(self):
+        """Return the tree, ``{'nodes': [node, ...]}``."""
+        return {'nodes': list(self.iter_nodes())}
+
+    def iter_nodes(self):
+        """Yield the nodes of the tree one at a time."""
+        if self.format == 'npy':
+            for node in _read_records(self.path_tree):
+                yield node
+            return
         with open(self.path_tree, "r") as tree_file:
-            data_tree = yaml.load(tree_file)
-        return data_tree
+            for node in _yaml_nodes(tree_file):
+                yield node
 
     def load_data(self):
+        """Return the data dictionary."""
+        if self.format == 'npy':
+            return next(_read_records(self.path_data))
         with open(self.path_data, "r") as data_file:
-            data = yaml.load(data_file)
+            data = yaml.load(data_file, Loader=Loader)
         return data
+
+    def convert(self, path_data, path_tree):
+        """Write the data and the tree in the `npy` format.
+
+        The nodes are read one at a time, so the tree is never fully loaded.
+
+        Args:
+            path_data (:obj:`str`): directory of the data.
+            path_tree (:obj:`str`): directory of the tree.
+        """
+        _write_records([self.load_data() or {}], path_data, nodes=False)
+        _write_records(self.iter_nodes(), path_tree, nodes=True)
+
+
+# YAML streaming --------------------------------------------------------------
+class _Event_constructor(object):
+    """Builds python objects from the events of the YAML parser."""
+
+    def __init__(self):
+        self.loader = yaml.SafeLoader('')
+        self.anchors = {}
+
+    def build(self, event, events):
+        if isinstance(event, yaml.AliasEvent):
+            return self.anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            obj = self._scalar(event)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            obj = []
+            for item in events:
+                if isinstance(item, yaml.SequenceEndEvent):
+                    break
+                obj.append(self.build(item, events))
+        elif isinstance(event, yaml.MappingStartEvent):
+            obj = {}
+            for key in events:
+                if isinstance(key, yaml.MappingEndEvent):
+                    break
+                key = self.build(key, events)
+                obj[key] = self.build(next(events), events)
+        else:
+            raise ValueError('Unexpected YAML event: {}'.format(event))
+        if event.anchor is not None:
+            self.anchors[event.anchor] = obj
+        return obj
+
+    def _scalar(self, event):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = self.loader.resolve(yaml.ScalarNode, event.value,
+                                      event.implicit)
+        node = yaml.ScalarNode(tag, event.value, style=event.style)
+        constructor = self.loader.yaml_constructors.get(
+            tag, self.loader.yaml_constructors[None])
+        return constructor(self.loader, node)
+
+
+def _yaml_nodes(stream):
+    """Yield the items of the top level `nodes` list of a YAML stream."""
+    events = yaml.parse(stream, Loader=Loader)
+    constructor = _Event_constructor()
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+    else:
+        return
+    for key in events:
+        if isinstance(key, yaml.MappingEndEvent):
+            return
+        key = constructor.build(key, events)
+        event = next(events)
+        if key != 'nodes' or not isinstance(event, yaml.SequenceStartEvent):
+            constructor.build(event, events)
+            continue
+        for item in events:
+            if isinstance(item, yaml.SequenceEndEvent):
+                break
+            yield constructor.build(item, events)
+# --------------------------------------------------------------------------- #
+
+
+# Columnar format -------------------------------------------------------------
+class _Param_table(object):
+
+    def __init__(self):
+        self.records = array('q')
+        self.indices = array('q')
+        self.values = array('d')
+        self.labels = {}
+        self.integer = True
+
+    def add(self, record, index, value):
+        label = repr(index)
+        code = self.labels.get(label)
+        if code is None:
+            code = self.labels[label] = len(self.labels)
+        self.records.append(record)
+        self.indices.append(code)
+        self.values.append(value)
+        self.integer = self.integer and isinstance(value, int)
+
+
+def _is_number(value):
+    return (isinstance(value, (int, float))
+            and not isinstance(value, bool))
+
+
+def _is_table(value):
+    if _is_number(value):
+        return True
+    return (isinstance(value, dict) and len(value) > 0
+            and all(_is_number(v) for v in value.values()))
+
+
+def _write_records(records, path, nodes=True):
+    """Write `records` (nodes or data dictionaries) to the directory
+    `path`."""
+    columns = {name: array('d' if name == 'probability' else 'q')
+               for name in _node_columns}
+    has_prev = array('b')
+    extra = array('q')
+    extras = {}
+    tables = {}
+
+    n = 0
+    for record in records:
+        record = dict(record)
+        if nodes:
+            for name in _node_columns:
+                value = record.pop(name, None)
+                if name == 'prev_id':
+                    has_prev.append(value is not None)
+                    value = -1 if value is None else value
+                elif name == 'probability' and value is None:
+                    # Default of ndusc.tree.Tree
+                    value = 1.0
+                if name != 'probability' and not isinstance(value, int):
+                    raise ValueError('The npy format needs integer node ids '
+                                     'and stages: {}'.format(value))
+                columns[name].append(value)
+
+        params = record.get('params')
+        if isinstance(params, dict):
+            rest = {}
+            for name, value in params.items():
+                if not _is_table(value):
+                    rest[name] = value
+                    continue
+                table = tables.setdefault(name, _Param_table())
+                if isinstance(value, dict):
+                    for index, v in value.items():
+                        table.add(n, index, v)
+                else:
+                    table.add(n, None, value)
+            record['params'] = rest
+
+        key = repr(record)
+        code = extras.get(key)
+        if code is None:
+            code = extras[key] = len(extras)
+        extra.append(code)
+        n += 1
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {'extra': np.frombuffer(extra, dtype=np.int64),
+              'extras': np.array(list(extras), dtype=str),
+              'param_names': np.array(list(tables), dtype=str)}
+    if nodes:
+        for name in _node_columns:
+            arrays[name] = np.frombuffer(
+                columns[name],
+                dtype=np.float64 if name == 'probability' else np.int64)
+        arrays['has_prev'] = np.frombuffer(has_prev, dtype=np.int8) \
+            .astype(bool)
+    for k, table in enumerate(tables.values()):
+        values = np.frombuffer(table.values, dtype=np.float64)
+        arrays['param{}_node'.format(k)] = np.frombuffer(table.records,
+                                                         dtype=np.int64)
+        arrays['param{}_index'.format(k)] = np.frombuffer(table.indices,
+                                                          dtype=np.int64)
+        arrays['param{}_labels'.format(k)] = np.array(list(table.labels),
+                                                      dtype=str)
+        arrays['param{}_value'.format(k)] = (
+            values.astype(np.int64) if table.integer else values)
+    for name, values in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), values)
+
+
+def _read_records(path):
+    """Yield the records (nodes or data dictionaries) of the directory
+    `path`."""
+
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    extra = load('extra')
+    extras = [ast.literal_eval(str(e)) for e in load('extras')]
+    nodes = os.path.exists(os.path.join(path, 'id.npy'))
+    if nodes:
+        columns = {name: load(name) for name in _node_columns}
+        has_prev = load('has_prev')
+
+    tables = []
+    for k, name in enumerate(load('param_names')):
+        records = load('param{}_node'.format(k))
+        labels = [ast.literal_eval(str(label))
+                  for label in load('param{}_labels'.format(k))]
+        starts = np.searchsorted(records, np.arange(len(extra) + 1))
+        tables.append((str(name), starts, load('param{}_index'.format(k)),
+                       labels, load('param{}_value'.format(k))))
+
+    for n in range(len(extra)):
+        record = dict(extras[extra[n]])
+        if nodes:
+            record['id'] = int(columns['id'][n])
+            record['prev_id'] = (int(columns['prev_id'][n]) if has_prev[n]
+                                 else None)
+            record['stage'] = int(columns['stage'][n])
+            record['probability'] = float(columns['probability'][n])
+        params = {}
+        for name, starts, indices, labels, values in tables:
+            start, end = starts[n], starts[n + 1]
+            if start == end:
+                continue
+            # Only the values of the node are read from the memory map
+            if labels[indices[start]] is None:
+                params[name] = values[start].item()
+            else:
+                params[name] = dict(zip(
+                    [labels[i] for i in indices[start:end].tolist()],
+                    values[start:end].tolist()))
+        if params:
+            params.update(record.get('params') or {})
+            record['params'] = params
+        yield record
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,359 @@
+"""Instrumentation of the decomposition runs.
+
+While a :class:`Recorder` is enabled (:func:`enable` and :func:`disable`, or
+the context manager :func:`recording`) the decomposition records:
+
+    - spans: timed sections, with the node and the iteration they belong
+      to, and their self time (without the spans they contain):
+
+        - 'forward stage', 'backward stage', 'feasibility' (:mod:`ndusc.nd`),
+          'forward pass', 'backward pass' (:mod:`ndusc.sddp`): the steps of
+          the algorithm. Their self time is the tree queries and the updates
+          of the tree with the results.
+        - 'node solve', 'node feasibility': the solve of a node
+          (:class:`ndusc.parallel.Node_solver`).
+        - 'build': the builder of the model of a node (`model.load` of its
+          file).
+        - 'opt.solve': the solver.
+        - 'extract': reading the solution (:mod:`ndusc.format_sol`).
+        - 'load cuts': loading the cuts of a node in its model.
+        - 'gradient': the gradient of the value of a node.
+        - 'compute cuts': computing the cuts of a node from its children.
+        - 'elastic': building the elastic problem of an infeasible node.
+        - 'worker': the round trip of a batch of tasks to a worker process
+          or host (the spans of the nodes solved by a worker are not
+          recorded).
+
+    - counters, per node and iteration: 'solves', 'builds', 'cuts_added',
+      'cuts_evicted', 'cuts_revived', 'bytes_sent' and 'bytes_received'
+      (tasks and results exchanged with the worker processes and hosts).
+
+The recording is exported as Chrome trace events (:meth:`Recorder.
+write_chrome_trace`, to open in chrome://tracing or https://ui.perfetto.dev)
+or summarized in a table (:meth:`Recorder.summary`). With `profile`, a
+profiler (cProfile by default) runs while the spans of that name do, in one
+thread at a time, see :meth:`Recorder.profile_stats`.
+
+When no recorder is enabled :func:`span` returns a shared no-op context
+manager and :func:`count` returns at once, so the instrumentation costs a
+function call at each point::
+
+    from ndusc import instrument
+    with instrument.recording(profile='opt.solve') as recorder:
+        output = nd.nested_decomposition(tree_data, data)
+    recorder.write_chrome_trace('trace.json')
+    print(recorder.summary())
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+# Active recorder, None when the instrumentation is disabled
+_recorder = None
+_null = contextlib.nullcontext()
+
+
+def enable(profile=None, profiler=None):
+    """Start recording, replacing the active recorder if any.
+
+    Args:
+        profile (:obj:`str`): name of the spans to profile.
+        profiler: object with `enable` and `disable` methods (e.g. a
+            sampling profiler). Default: :class:`cProfile.Profile`.
+
+    Return:
+        :obj:`Recorder`: the new recorder.
+    """
+    global _recorder
+    _recorder = Recorder(profile, profiler)
+    return _recorder
+
+
+def disable():
+    """Stop recording.
+
+    Return:
+        :obj:`Recorder`: the recorder that was active (None if none).
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def active():
+    """Return the active recorder, None if the instrumentation is
+    disabled."""
+    return _recorder
+
+
+@contextlib.contextmanager
+def recording(profile=None, profiler=None):
+    """Record while in the context (see :func:`enable`)."""
+    recorder = enable(profile, profiler)
+    try:
+        yield recorder
+    finally:
+        if _recorder is recorder:
+            disable()
+
+
+def span(name, node=None, **args):
+    """Return a context manager that records the span `name` of the node
+    `node` (id), with the arguments `args`."""
+    if _recorder is None:
+        return _null
+    return _Span(_recorder, name, node, args)
+
+
+def count(name, value=1, node=None):
+    """Add `value` to the counter `name` of the node `node` (id) in the
+    current iteration."""
+    if _recorder is not None:
+        _recorder.count(name, value, node)
+
+
+def record(name, start, end, thread=None, node=None, **args):
+    """Record a span timed by the caller (:func:`time.perf_counter` values),
+    in the timeline `thread` (default: the calling thread)."""
+    if _recorder is not None:
+        _recorder.record(name, start, end, thread, node, args)
+
+
+def set_iteration(iteration):
+    """Set the iteration of the spans and counters recorded next."""
+    if _recorder is not None:
+        _recorder.set_iteration(iteration)
+
+
+class _Span(object):
+    __slots__ = ('recorder', 'name', 'node', 'args', 'start', 'child')
+
+    def __init__(self, recorder, name, node, args):
+        self.recorder = recorder
+        self.name = name
+        self.node = node
+        self.args = args
+
+    def __enter__(self):
+        self.recorder._enter(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder._exit(self)
+
+
+class Recorder(object):
+    """Spans and counters of a run.
+
+    Args:
+        profile (:obj:`str`): name of the spans to profile.
+        profiler: object with `enable` and `disable` methods. Default:
+            :class:`cProfile.Profile` if `profile` is given.
+
+    Attributes:
+        spans (:obj:`list`): ``(name, thread, start, duration, self time,
+            node, iteration, args)`` of each span, times in seconds from the
+            start of the recording.
+        counters (:obj:`dict`): ``(name, iteration, node) -> value``.
+        iterations (:obj:`list`): ``(start, iteration)`` of each iteration.
+    """
+
+    def __init__(self, profile=None, profiler=None):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.iterations = []
+        self.iteration = 0
+        self.profile = profile
+        if profiler is None and profile is not None:
+            profiler = cProfile.Profile()
+        self.profiler = profiler
+        self._profiled = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    # Recording ---------------------------------------------------------------
+    def _enter(self, span):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+        span.child = 0.0
+        if span.name == self.profile and self._profiled is None:
+            with self._lock:
+                if self._profiled is None:
+                    self._profiled = span
+                    self.profiler.enable()
+        span.start = time.perf_counter()
+
+    def _exit(self, span):
+        end = time.perf_counter()
+        duration = end - span.start
+        stack = self._local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child += duration
+        if self._profiled is span:
+            self.profiler.disable()
+            self._profiled = None
+        self.spans.append((span.name, threading.get_ident(),
+                           span.start - self.origin, duration,
+                           duration - span.child, span.node, self.iteration,
+                           span.args))
+
+    def record(self, name, start, end, thread=None, node=None, args=None):
+        """See :func:`record`."""
+        self.spans.append((name, threading.get_ident() if thread is None
+                           else thread, start - self.origin, end - start,
+                           end - start, node, self.iteration, args or {}))
+
+    def count(self, name, value=1, node=None):
+        """See :func:`count`."""
+        key = (name, self.iteration, node)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_iteration(self, iteration):
+        """See :func:`set_iteration`."""
+        self.iteration = iteration
+        self.iterations.append((time.perf_counter() - self.origin, iteration))
+
+    # Reports -----------------------------------------------------------------
+    def totals(self, by=None):
+        """Return the totals of the spans and counters.
+
+        Args:
+            by (:obj:`str`): None, 'iteration' or 'node'.
+
+        Return:
+            :obj:`dict`: ``{key: {'spans': {name: {'calls', 'total', 'self',
+            'max'}}, 'counters': {name: value}}}``, with the iteration or
+            the node as key (None if `by` is None).
+        """
+        position = {None: None, 'iteration': 6, 'node': 5}[by]
+        totals = {}
+        for span in self.spans:
+            key = None if position is None else span[position]
+            spans = totals.setdefault(key, {'spans': {}, 'counters': {}})
+            entry = spans['spans'].setdefault(
+                span[0], {'calls': 0, 'total': 0.0, 'self': 0.0, 'max': 0.0})
+            entry['calls'] += 1
+            entry['total'] += span[3]
+            entry['self'] += span[4]
+            entry['max'] = max(entry['max'], span[3])
+        position = {None: None, 'iteration': 1, 'node': 2}[by]
+        for key, value in self.counters.items():
+            group = None if position is None else key[position]
+            counters = totals.setdefault(group, {'spans': {}, 'counters': {}})
+            counters = counters['counters']
+            counters[key[0]] = counters.get(key[0], 0) + value
+        return totals
+
+    def summary(self, by=None):
+        """Return a table of the spans and counters.
+
+        Args:
+            by (:obj:`str`): None (one row per span name: calls, total and
+                self time, mean and max duration, and the totals of the
+                counters), 'iteration' or 'node' (one row per iteration or
+                node: self time of each span name and counters).
+        """
+        totals = self.totals(by)
+        lines = []
+        if by is None:
+            total = totals.get(None, {'spans': {}, 'counters': {}})
+            lines.append('{:<18} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+                'span', 'calls', 'total s', 'self s', 'mean ms', 'max ms'))
+            for name, entry in sorted(total['spans'].items(),
+                                      key=lambda item: -item[1]['self']):
+                lines.append(
+                    '{:<18} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'
+                    .format(name, entry['calls'], entry['total'],
+                            entry['self'],
+                            1e3 * entry['total'] / entry['calls'],
+                            1e3 * entry['max']))
+            if total['counters']:
+                lines.append('')
+                lines.append('{:<18} {:>12}'.format('counter', 'value'))
+                for name, value in sorted(total['counters'].items()):
+                    lines.append('{:<18} {:>12}'.format(name, value))
+            return '\n'.join(lines)
+
+        spans = sorted({name for entry in totals.values()
+                        for name in entry['spans']})
+        counters = sorted({name for entry in totals.values()
+                           for name in entry['counters']})
+        lines.append('{:>10}'.format(by) + ''.join(
+            ' {:>14}'.format(name) for name in spans + counters))
+        for key in sorted(totals, key=_sort_key):
+            entry = totals[key]
+            lines.append('{:>10}'.format(str(key)) + ''.join(
+                ' {:>14.4f}'.format(entry['spans'][name]['self'])
+                if name in entry['spans'] else ' {:>14}'.format('')
+                for name in spans) + ''.join(
+                ' {:>14}'.format(entry['counters'].get(name, ''))
+                for name in counters))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Return the recording as Chrome trace events.
+
+        The spans are complete ('X') events, with their node and iteration
+        as arguments, the starts of the iterations instant ('i') events and
+        the counters of each iteration counter ('C') events at its start.
+        """
+        pid = os.getpid()
+        threads = {}
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                   'args': {'name': 'ndusc'}}]
+        for name, thread, start, duration, self_time, node, iteration, args \
+                in self.spans:
+            if thread not in threads:
+                threads[thread] = len(threads)
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': threads[thread],
+                               'args': {'name': str(thread)}})
+            events.append({'name': name, 'cat': 'ndusc', 'ph': 'X',
+                           'ts': 1e6 * start, 'dur': 1e6 * duration,
+                           'pid': pid, 'tid': threads[thread],
+                           'args': dict(args, node=node, iteration=iteration,
+                                        self_ms=1e3 * self_time)})
+
+        starts = {0: 0.0}
+        for start, iteration in self.iterations:
+            starts.setdefault(iteration, start)
+            events.append({'name': 'iteration {}'.format(iteration),
+                           'ph': 'i', 's': 'g', 'ts': 1e6 * start,
+                           'pid': pid, 'tid': 0})
+        for iteration, entry in self.totals('iteration').items():
+            if entry['counters']:
+                events.append({'name': 'counters', 'ph': 'C',
+                               'ts': 1e6 * starts.get(iteration, 0.0),
+                               'pid': pid, 'args': entry['counters']})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        """Write the Chrome trace events (:meth:`chrome_trace`) to the JSON
+        file `path`."""
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file, default=str)
+
+    def profile_stats(self, sort='cumulative', limit=30):
+        """Return the statistics of the cProfile profiler (see `profile`),
+        sorted by `sort`, `limit` functions."""
+        if not isinstance(self.profiler, cProfile.Profile):
+            raise ValueError('No cProfile profiler in this recorder')
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats(
+            sort).print_stats(limit)
+        return stream.getvalue()
+
+
+def _sort_key(key):
+    return (key is None, str(type(key)), key if key is not None else 0)
@@ -0,0 +1,469 @@
+"""Matrix form of the node problems, solved without Pyomo.
+
+Most of the time of the solve of a small linear or mixed integer node
+problem goes into Pyomo: building the expressions of its constraints and
+writing them to the solver. With the 'matrix' backend (see
+:class:`ndusc.model.Persistent_models`) the problem of each template is
+compiled once, from its Pyomo model, into the standard form
+
+    ``min c x + c0  s.t.  row_lower <= A x <= row_upper,
+    lower <= x <= upper, x[j] integer for the j in `integrality```
+
+with sparse `A`. The coefficients and bounds that depend on mutable
+parameters (the linking parameters, and the scenario parameters of a shared
+template) are kept as Pyomo expressions and evaluated again before each
+solve, so a new state only touches the arrays of the right hand sides and
+bounds. The cuts of the node are appended as rows built from their
+dictionaries (see :mod:`ndusc.cuts`), with one column per future cost
+`Aux_Obj[g]`.
+
+The problems are solved by HiGHS through `highspy` when it is installed:
+each problem keeps one HiGHS instance and passes it the whole problem at
+each solve, which starts from no basis, so the results do not depend on the
+order of the solves. Without `highspy` they go through
+:func:`scipy.optimize.linprog` (linear problems, and relaxations solved for
+their duals) and :func:`scipy.optimize.milp`, whose checks of the inputs
+cost several times the solve of a small problem. The results have the
+format of
+:meth:`ndusc.format_sol.Extraction_plan.extract`, with the duals of the
+rows of the :class:`ndusc.cuts.Technology` of the template, so they are
+used as those of Pyomo to compute the cuts.
+"""
+
+import time
+
+import numpy as np
+from pyomo.core.expr.numvalue import is_constant
+from pyomo.environ import Constraint, Objective, Var, maximize, value
+from pyomo.repn import generate_standard_repn
+from scipy import optimize, sparse
+
+# Components added to the node problems by the decomposition, not compiled
+_internal = ('Aux_Obj', '_Cuts_', '_Stab_', '_Obj')
+
+
+class Matrix_problem(object):
+    """Standard form of a node problem.
+
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): problem of the node.
+        rows (:obj:`list`): constraints whose duals are returned (the rows
+            of :class:`ndusc.cuts.Technology`).
+
+    Raises:
+        ValueError: if the problem is not linear.
+    """
+
+    def __init__(self, problem, rows=()):
+        self.variables = [v for v in problem.component_data_objects(Var)
+                          if not _is_internal(v)]
+        self.columns = {id(v): j for j, v in enumerate(self.variables)}
+        self.names = [(v.parent_component().name, v.index())
+                      for v in self.variables]
+        n = len(self.variables)
+        self.integrality = np.array([0 if v.is_continuous() else 1
+                                     for v in self.variables], dtype=np.uint8)
+        self.integer = bool(self.integrality.any())
+
+        # Expressions evaluated again at each update: (array, position, expr)
+        self._dynamic = []
+
+        objective = getattr(problem, '_cut_info', {}).get('objective')
+        if objective is None:
+            objective = next(problem.component_data_objects(Objective,
+                                                            active=True))
+        self.objective_name = objective.name
+        self.sense = -1.0 if objective.sense == maximize else 1.0
+        repn = self._repn(objective.expr)
+        self.c = np.zeros(n)
+        for v, coef in zip(repn.linear_vars, repn.linear_coefs):
+            self._set(self.c, self.columns[id(v)], coef)
+        self.c0 = np.zeros(1)
+        self._set(self.c0, 0, repn.constant)
+
+        self.lower = np.zeros(n)
+        self.upper = np.zeros(n)
+        for j, v in enumerate(self.variables):
+            if v.fixed:
+                self._set(self.lower, j, v.value)
+                self._set(self.upper, j, v.value)
+                continue
+            self._set(self.lower, j, v.lower, -np.inf)
+            self._set(self.upper, j, v.upper, np.inf)
+
+        # Rows: sorted (row, column) entries, in the order of the data of A
+        self.constraints = []
+        entries = {}
+        lower, upper, constant = [], [], []
+        for c in problem.component_data_objects(Constraint, active=True):
+            if _is_internal(c):
+                continue
+            row = len(self.constraints)
+            self.constraints.append(c)
+            repn = self._repn(c.body)
+            for v, coef in zip(repn.linear_vars, repn.linear_coefs):
+                entries[(row, self.columns[id(v)])] = coef
+            lower.append(c.lower)
+            upper.append(c.upper)
+            constant.append(repn.constant)
+        keys = sorted(entries)
+        self.A_data = np.zeros(len(keys))
+        for k, key in enumerate(keys):
+            self._set(self.A_data, k, entries[key])
+        m = len(self.constraints)
+        indptr = np.zeros(m + 1, dtype=np.int64)
+        np.add.at(indptr, [row + 1 for row, col in keys], 1)
+        self.A = sparse.csr_matrix(
+            (self.A_data, np.array([col for row, col in keys],
+                                   dtype=np.int64), np.cumsum(indptr)),
+            shape=(m, n))
+        self.row_lower = np.zeros(m)
+        self.row_upper = np.zeros(m)
+        self.row_constant = np.zeros(m)
+        for i in range(m):
+            self._set(self.row_lower, i, lower[i], -np.inf)
+            self._set(self.row_upper, i, upper[i], np.inf)
+            self._set(self.row_constant, i, constant[i])
+
+        position = {id(c): i for i, c in enumerate(self.constraints)}
+        self.rows = np.array([position[id(c)] for c in rows], dtype=np.int64)
+        # Cut rows and constraint matrices of each node sharing the
+        # problem, built again only when its cuts or the coefficients of A
+        # change
+        self._cuts = {}
+        self._system = {}
+        self._split = {}
+        self._version = 0
+        # HiGHS instance, created at the first solve (False without highspy)
+        self._highs = None
+
+    def update(self):
+        """Evaluate again the coefficients and bounds that depend on
+        mutable parameters (after a new state or scenario)."""
+        changed = False
+        for array, k, expr in self._dynamic:
+            x = _number(value(expr), array is self.lower or
+                        array is self.row_lower)
+            if array is self.A_data and array[k] != x:
+                changed = True
+            array[k] = x
+        if changed:
+            self.A.data[:] = self.A_data
+            self._version += 1
+
+    def solve(self, node, duals=True, names=None):
+        """Solve the problem with the cuts of `node`.
+
+        Args:
+            node (:obj:`dict`): node information (its live cuts).
+            duals (:obj:`bool`): if True the relaxation is solved and the
+                duals of the `rows` are returned.
+            names (:obj:`tuple`): names of the state variables to return. If
+                None all the variables are returned (and the duals of all
+                the constraints, if `duals`).
+
+        Return:
+            :obj:`tuple`: solver results (dictionary with the layout of the
+            Pyomo results read by the decomposition) and problem results
+            (None if the problem is not solved to optimality).
+        """
+        self.update()
+        cut_key, cut_rows, cut_lower, groups = self._cut_rows(node)
+        k = len(groups)
+        c = np.concatenate([self.sense * self.c, np.ones(k)])
+        row_lower = np.concatenate([self.row_lower - self.row_constant,
+                                    cut_lower])
+        row_upper = np.concatenate([self.row_upper - self.row_constant,
+                                    np.full(len(cut_lower), np.inf)])
+        lower = np.concatenate([self.lower, np.full(k, -np.inf)])
+        upper = np.concatenate([self.upper, np.full(k, np.inf)])
+
+        integrality = None
+        if self.integer and not duals:
+            integrality = np.concatenate([self.integrality,
+                                          np.zeros(k, dtype=np.uint8)])
+
+        start = time.perf_counter()
+        highs = self._solver()
+        if highs is not None:
+            result, row_duals = _highs(
+                highs, c, self._matrix(cut_key, cut_rows), row_lower,
+                row_upper, lower, upper, integrality)
+            bound = result.mip_dual_bound if integrality is not None \
+                else result.fun
+        elif integrality is not None:
+            result = optimize.milp(
+                c, integrality=integrality,
+                bounds=optimize.Bounds(lower, upper),
+                constraints=optimize.LinearConstraint(
+                    self._matrix(cut_key, cut_rows), row_lower, row_upper))
+            bound = getattr(result, 'mip_dual_bound', None)
+            row_duals = None
+        else:
+            system = self._matrices(cut_key, cut_rows, row_lower,
+                                    row_upper)
+            result, row_duals = _linprog(c, system, row_lower, row_upper,
+                                         lower, upper)
+            bound = result.fun if result.status == 0 else None
+        status = {0: 'optimal', 2: 'infeasible',
+                  3: 'unbounded'}.get(result.status, 'error')
+        objective = None
+        if status == 'optimal':
+            objective = self.sense * result.fun + float(self.c0[0])
+            if bound is not None:
+                bound = self.sense * bound + float(self.c0[0])
+        solver_results = {
+            'Problem': [{'Lower bound': bound if self.sense > 0 else
+                         objective,
+                         'Upper bound': objective if self.sense > 0 else
+                         bound}],
+            'Solver': [{'Status': 'ok' if status == 'optimal' else 'warning',
+                        'Termination condition': status,
+                        'Message': result.message,
+                        'Time': time.perf_counter() - start}]}
+        if status != 'optimal':
+            return solver_results, None
+
+        x = result.x
+        results = {'objective': {self.objective_name: {'value': objective}}}
+        if names is None:
+            variables = {}
+            for (name, index), v in zip(self.names, x[:len(self.names)]):
+                variables.setdefault(name, {})[index] = float(v)
+            results['variables'] = variables
+        else:
+            variables = {}
+            columns = [j for j, (name, index) in enumerate(self.names)
+                       if name in names]
+            for j in columns:
+                name, index = self.names[j]
+                variables.setdefault(name, {})[index] = float(x[j])
+            results['variables'] = variables
+            results['state'] = ([self.names[j] for j in columns],
+                                x[columns].copy())
+        if groups:
+            results['variables']['Aux_Obj'] = dict(
+                zip(groups, x[len(self.names):].tolist()))
+        results['future_cost'] = float(x[len(self.names):].sum())
+        if duals:
+            row_duals = self.sense * row_duals[:len(self.constraints)]
+            results['duals'] = row_duals[self.rows]
+            if names is None:
+                constraints = {}
+                for c, dual in zip(self.constraints, row_duals.tolist()):
+                    constraints.setdefault(c.parent_component().name, {})[
+                        c.index()] = {'dual': dual}
+                results['constraints'] = constraints
+        results['solver'] = solver_results['Solver'][0]
+        return solver_results, results
+
+    def _solver(self):
+        """Return the HiGHS instance of the problem, None without highspy
+        (the problem is then solved through scipy)."""
+        if self._highs is None:
+            try:
+                import highspy
+            except ImportError:
+                self._highs = False
+            else:
+                self._highs = highspy.Highs()
+                self._highs.setOptionValue('output_flag', False)
+        return self._highs or None
+
+    def _matrix(self, cut_key, cut_rows):
+        """Return the constraint matrix of the problem with the cut rows."""
+        key = (cut_key, self._version)
+        cached = self._system.get(cut_key[0])
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        k = cut_rows.shape[1] - self.A.shape[1]
+        A = sparse.vstack([sparse.hstack([self.A, sparse.csr_matrix(
+            (self.A.shape[0], k))]), cut_rows], format='csr')
+        self._system[cut_key[0]] = (key, A)
+        return A
+
+    def _matrices(self, cut_key, cut_rows, row_lower, row_upper):
+        """Return the constraint matrix `A` of the problem with the cut
+        rows, and its rows split for linprog: `A_ub` (upper bounds, then
+        lower bounds negated) and `A_eq`, with their masks."""
+        masks = {'equal': row_lower == row_upper}
+        masks['upper'] = ~masks['equal'] & np.isfinite(row_upper)
+        masks['lower'] = ~masks['equal'] & np.isfinite(row_lower)
+        A = self._matrix(cut_key, cut_rows)
+        key = (cut_key, self._version) + tuple(
+            mask.tobytes() for mask in masks.values())
+        cached = self._split.get(cut_key[0])
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        system = dict(masks, A=A, A_eq=A[masks['equal']],
+                      A_ub=sparse.vstack([A[masks['upper']],
+                                          -A[masks['lower']]], format='csr'))
+        self._split[cut_key[0]] = (key, system)
+        return system
+
+    def _cut_rows(self, node):
+        """Key of the live cuts of `node`, their rows and lower bounds, and
+        the groups of the future cost columns (built again only when the
+        cuts change)."""
+        live = node.get('cuts', {})
+        feas = live.get('feas', {})
+        opt = live.get('opt', {})
+        key = (node.get('cuts_id', node['id']), tuple(feas), tuple(opt))
+        cached = self._cuts.get(key[0])
+        if cached is not None and cached[0] == key:
+            return (key,) + cached[1]
+        groups = []
+        for cut in opt.values():
+            if cut.get('group', 0) not in groups:
+                groups.append(cut.get('group', 0))
+        n = len(self.names)
+        index = {name: j for j, name in enumerate(self.names)}
+        data, rows, cols, lower = [], [], [], []
+        for kind, cuts in (('D', feas), ('E', opt)):
+            for cut in cuts.values():
+                row = len(lower)
+                for key_var, coef in cut[kind].items():
+                    data.append(coef)
+                    rows.append(row)
+                    cols.append(index[key_var])
+                if kind == 'E':
+                    data.append(1.0)
+                    rows.append(row)
+                    cols.append(n + groups.index(cut.get('group', 0)))
+                    lower.append(cut['e'])
+                else:
+                    lower.append(cut['d'])
+        matrix = sparse.csr_matrix((data, (rows, cols)),
+                                   shape=(len(lower), n + len(groups)))
+        cut_rows = (matrix, np.array(lower, dtype=np.float64), groups)
+        self._cuts[key[0]] = (key, cut_rows)
+        return (key,) + cut_rows
+
+    def _repn(self, expr):
+        repn = generate_standard_repn(expr, compute_values=False,
+                                      quadratic=False)
+        if repn.nonlinear_expr is not None:
+            raise ValueError('The matrix backend needs linear problems')
+        return repn
+
+    def _set(self, array, k, expr, default=0.0):
+        """Store the value of `expr` in ``array[k]``, keeping it to be
+        evaluated again if it is not constant."""
+        if expr is None:
+            array[k] = default
+            return
+        if not is_constant(expr):
+            self._dynamic.append((array, k, expr))
+        array[k] = _number(value(expr), default < 0)
+
+
+def compile_problem(problem, rows=()):
+    """Return the :class:`Matrix_problem` of `problem`, None if it can not
+    be compiled (it is not linear)."""
+    try:
+        return Matrix_problem(problem, rows)
+    except ValueError:
+        return None
+
+
+def _highs(highs, c, A, row_lower, row_upper, lower, upper,
+           integrality=None):
+    """Solve the problem with HiGHS through highspy.
+
+    Args:
+        highs (:obj:`highspy.Highs`): HiGHS instance, its previous problem
+            is replaced.
+        A (:obj:`scipy.sparse.csr_matrix`): constraint matrix.
+        integrality (:obj:`numpy.ndarray`): 1 for the integer columns, None
+            for a linear problem.
+
+    Return:
+        :obj:`tuple`: result (with the fields of the result of linprog
+        read by :meth:`Matrix_problem.solve`) and duals of the rows, None
+        if it is not solved.
+    """
+    import highspy
+
+    lp = highspy.HighsLp()
+    lp.num_col_ = A.shape[1]
+    lp.num_row_ = A.shape[0]
+    lp.col_cost_ = c
+    lp.col_lower_ = lower
+    lp.col_upper_ = upper
+    lp.row_lower_ = row_lower
+    lp.row_upper_ = row_upper
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kRowwise
+    lp.a_matrix_.start_ = A.indptr
+    lp.a_matrix_.index_ = A.indices
+    lp.a_matrix_.value_ = A.data
+    if integrality is not None:
+        lp.integrality_ = [highspy.HighsVarType(int(k))
+                           for k in integrality]
+    highs.passModel(lp)
+    highs.run()
+
+    model_status = highs.getModelStatus()
+    # Status codes of linprog
+    status = {highspy.HighsModelStatus.kOptimal: 0,
+              highspy.HighsModelStatus.kInfeasible: 2,
+              highspy.HighsModelStatus.kUnbounded: 3}.get(model_status, 4)
+    result = optimize.OptimizeResult(
+        status=status, message=highs.modelStatusToString(model_status),
+        fun=None, x=None, mip_dual_bound=None)
+    if status != 0:
+        return result, None
+    info = highs.getInfo()
+    solution = highs.getSolution()
+    result.fun = info.objective_function_value
+    result.x = np.array(solution.col_value)
+    if integrality is not None:
+        result.mip_dual_bound = info.mip_dual_bound
+        return result, None
+    return result, np.array(solution.row_dual)
+
+
+def _linprog(c, system, row_lower, row_upper, lower, upper):
+    """Solve the linear problem with HiGHS through linprog.
+
+    Args:
+        system (:obj:`dict`): constraint matrices, see
+            :meth:`Matrix_problem._matrices`.
+
+    Return:
+        :obj:`tuple`: result of linprog and duals of the rows (derivatives
+        of the optimal value with respect to their active bound), None if
+        it is not solved.
+    """
+    equal, has_upper, has_lower = (system['equal'], system['upper'],
+                                   system['lower'])
+    A_ub = system['A_ub']
+    b_ub = np.concatenate([row_upper[has_upper], -row_lower[has_lower]])
+    result = optimize.linprog(
+        c, A_ub=A_ub if A_ub.shape[0] else None,
+        b_ub=b_ub if A_ub.shape[0] else None,
+        A_eq=system['A_eq'] if equal.any() else None,
+        b_eq=row_upper[equal] if equal.any() else None,
+        bounds=np.column_stack([lower, upper]), method='highs')
+    if result.status != 0:
+        return result, None
+    duals = np.zeros(len(row_lower))
+    if A_ub.shape[0]:
+        marginals = result.ineqlin.marginals
+        k = int(has_upper.sum())
+        duals[has_upper] += marginals[:k]
+        duals[has_lower] -= marginals[k:]
+    if equal.any():
+        duals[equal] = result.eqlin.marginals
+    return result, duals
+
+
+def _is_internal(component):
+    name = component.parent_component().local_name
+    return any(name.startswith(prefix) for prefix in _internal)
+
+
+def _number(x, lower=False):
+    """`x` as a float, with None as an infinite bound."""
+    if x is None:
+        return -np.inf if lower else np.inf
+    return float(x)
@@ -1,48 +1,901 @@
 # -*- coding: utf-8 -*-
-"""Modulo con..."""
+"""Node models: build, update and solve the problem of each node."""
 
+import contextlib
+import hashlib
+import importlib
+import importlib.metadata
+import importlib.util
+import os
+import sys
+import threading
+
+import numpy as np
 import pyomo.environ as pyenv
 import logging as log
-import format_sol
+from pyomo.repn import generate_standard_repn
 
+from ndusc import cuts
+from ndusc import format_sol
+from ndusc import instrument
+from ndusc import matrix
+from ndusc import stabilization
+from ndusc import utilities
 
-def load(file, function, data):
-    """Titulo.
 
-    Descripcion.
+class Builder_registry(object):
+    """Cache of the functions that build the node models.
+
+    A model is given in the tree by one of:
+
+        - `file` and `function`: function defined in a python file.
+        - `function` alone: a python callable, or the import path of one
+          (``'package.module:function'``).
+        - `entry_point`: name of an entry point of the ``ndusc.models``
+          group.
+
+    Each builder is imported once, through importlib, and kept in a
+    dictionary, so getting the builder of a node is a dictionary lookup.
+    :meth:`refresh` drops the builders whose file has changed (by mtime and
+    content hash).
+    """
+
+    group = 'ndusc.models'
+
+    def __init__(self):
+        self._builders = {}
+        self._files = {}
+
+    def builder(self, model_spec):
+        """Return the function that builds the model `model_spec`.
+
+        Args:
+            model_spec (:obj:`dict`): `model` entry of a node.
+        """
+        function = model_spec.get('function')
+        if callable(function):
+            return function
+        key = (model_spec.get('file'), function, model_spec.get('entry_point'))
+        try:
+            return self._builders[key]
+        except KeyError:
+            pass
+
+        if key[0] is not None:
+            module = self._import_file(key[0])
+            builder = getattr(module, function)
+        elif key[2] is not None:
+            builder = self._entry_point(key[2])
+        elif function is not None and ':' in function:
+            module_name, attr = function.split(':', 1)
+            builder = getattr(importlib.import_module(module_name), attr)
+        else:
+            raise ValueError('Unknown model: {}'.format(model_spec))
+        self._builders[key] = builder
+        return builder
+
+    def refresh(self):
+        """Drop the builders of the files changed since they were imported."""
+        for path, (stamp, digest) in list(self._files.items()):
+            new_stamp = _file_stamp(path)
+            if new_stamp == stamp:
+                continue
+            if new_stamp is not None and _file_digest(path) == digest:
+                self._files[path] = (new_stamp, digest)
+                continue
+            log.info('Model file changed: {}'.format(path))
+            del self._files[path]
+            for key in [k for k in self._builders if k[0] is not None
+                        and os.path.abspath(k[0]) == path]:
+                del self._builders[key]
+
+    def _import_file(self, file):
+        path = os.path.abspath(file)
+        digest = _file_digest(path)
+        name = 'ndusc_models.{}_{}'.format(
+            os.path.splitext(os.path.basename(path))[0], digest[:12])
+        module = sys.modules.get(name)
+        if module is None:
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules[name] = module
+        self._files[path] = (_file_stamp(path), digest)
+        return module
+
+    def _entry_point(self, name):
+        for entry_point in importlib.metadata.entry_points(group=self.group):
+            if entry_point.name == name:
+                return entry_point.load()
+        raise ValueError('Unknown entry point: {}'.format(name))
+
+
+registry = Builder_registry()
+
+
+def load(file, function, data):
+    """Build the problem of a node.
 
     Args:
-        file (:obj:`str`): archivo...
-        ...
+        file (:obj:`str`): path of the python file with the model.
+        function (:obj:`str`): name of the function of `file` that builds
+            the model from `data`.
+        data (:obj:`dict`): node data.
 
     Return:
+        :obj:`pyomo.environ.ConcreteModel`: problem of the node.
 
     Example:
-        >>> load(asda, asd)
-            10.0
+        >>> problem = load('data/model_S1.py', 'model_S1', data)
+    """
+    return registry.builder({'file': file, 'function': function})(data)
+
+
+def linking_params(problem, state, linking=None):
+    """Return the parameters of `problem` that receive the state.
+
+    The state of a node is the solution of its parent. By default the
+    variable `name` of the parent feeds the parameter `name` of the node;
+    `linking` maps parent variable names to other parameter names (e.g.
+    ``{'y': 'y_prev'}``).
+
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): problem of the node.
+        state (:obj:`dict`): parent variables, ``{name: {index: value}}``.
+        linking (:obj:`dict`): parent variable name -> parameter name.
+
+    Return:
+        :obj:`dict`: parent variable name -> :obj:`pyomo.environ.Param`.
+    """
+    linking = linking or {}
+    params = {}
+    for name in state:
+        param = problem.component(linking.get(name, name))
+        if isinstance(param, pyenv.Param):
+            params[name] = param
+    return params
+
+
+def set_state(params, state):
+    """Push the values of `state` into the (mutable) linking parameters."""
+    for name, param in params.items():
+        for index, value in state[name].items():
+            param[index] = value
+
+
+def relax_integers(problem):
+    """Relax the integer variables of `problem` keeping their bounds.
+
+    Return:
+        :obj:`list`: information to undo the relaxation with
+        :func:`restore_integers`.
     """
-    exec(file)
-    return eval("{}(data)".format(function))
+    relaxed = []
+    for v in problem.component_data_objects(pyenv.Var, active=True):
+        if not v.is_continuous():
+            relaxed.append((v, v.domain, v.lower, v.upper))
+            lb, ub = v.bounds
+            v.domain = pyenv.Reals
+            v.setlb(lb)
+            v.setub(ub)
+    return relaxed
+
+
+def restore_integers(relaxed):
+    """Undo :func:`relax_integers`."""
+    for v, domain, lb, ub in relaxed:
+        v.domain = domain
+        v.setlb(lb)
+        v.setub(ub)
 
 
-def solve(problem, solver='gurobi', duals=True):
+def solve(problem, solver='gurobi', duals=True, opt=None, plan=None,
+          warmstart=False):
+    """Solve a problem.
+
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): problem to solve.
+        solver (:obj:`str`): solver name.
+        duals (:obj:`bool`): if True the duals are loaded. The duals of a
+            problem with integer variables are those of its relaxation.
+        opt: solver object to reuse. If None a new one is created.
+        plan (:obj:`ndusc.format_sol.Extraction_plan`): if given only the
+            values of the plan, and the duals of its rows, are loaded (when
+            the solver allows it) and returned. Otherwise the full solution
+            is returned.
+        warmstart (:obj:`bool`): if True the values of the variables are
+            given to the solver as a starting solution (the solver must
+            accept it, see :class:`Hot_starts`).
+
+    Return:
+        :obj:`tuple`: solver results and problem results (None if the
+        problem is not solved to optimality).
+    """
 
     # Create a solver
-    opt = pyenv.SolverFactory(solver)
+    if opt is None:
+        opt = pyenv.SolverFactory(solver)
+    selective = plan is not None and hasattr(opt, 'load_vars')
 
-    # Get duals
-    problem.dual = pyenv.Suffix(direction=Suffix.IMPORT)
+    # Get duals: the persistent solvers give the duals of the plan rows,
+    # the others import them through the `dual` suffix
+    relaxed = []
+    import_duals(problem, duals and not selective)
+    if duals:
+        relaxed = relax_integers(problem)
 
     # Create a model instance and optimize
-    solver_results = opt.solve(problem)
+    try:
+        with instrument.span('opt.solve'):
+            if warmstart:
+                solver_results = opt.solve(problem, load_solutions=False,
+                                           warmstart=True)
+            else:
+                solver_results = opt.solve(problem, load_solutions=False)
+    finally:
+        restore_integers(relaxed)
 
     # Obtain results
     status = str(solver_results['Solver'][0]['Termination condition'])
     log.info('Status: ' + status)
-    if status == 'optimal':
-        results = format_sol.get_solution(problem, solver_results, duals)
-    elif status == 'infeasible':
-        results = None
-    else:
-        results = None
+    if status != 'optimal':
+        return solver_results, None
+    with instrument.span('extract'):
+        if plan is None:
+            problem.solutions.load_from(solver_results)
+            results = format_sol.get_solution(problem, solver_results, duals)
+        elif selective:
+            opt.load_vars(plan.load_vars(problem))
+            results = plan.extract(
+                problem, opt.get_duals(plan.rows) if duals else None)
+        else:
+            problem.solutions.load_from(solver_results)
+            results = plan.extract(problem,
+                                   problem.dual if duals else None)
     return solver_results, results
+
+
+def import_duals(problem, enabled):
+    """Enable or disable the import of the duals of `problem`.
+
+    The `dual` suffix is declared the first time it is enabled; later it is
+    switched off (local) when the duals are not needed.
+    """
+    suffix = problem.component('dual')
+    if suffix is None:
+        if enabled:
+            problem.dual = pyenv.Suffix(direction=pyenv.Suffix.IMPORT)
+        return
+    suffix.direction = (pyenv.Suffix.IMPORT if enabled
+                        else pyenv.Suffix.LOCAL)
+
+
+class Hot_starts(object):
+    """Starting points of the solves of the nodes.
+
+    The trial solution of a node usually changes little between iterations,
+    so each solve of a node starts from the solution of its previous solve
+    of the same kind (with or without duals):
+
+        - the values of its variables, given to the solver as a MIP start
+          (with `warmstart=True`, if :meth:`warm_start_capable`), for the
+          problems with integer variables solved without duals. The future
+          costs (`Aux_Obj`) and the deviations of the stabilization are
+          lifted to satisfy the cuts added since (see
+          :func:`ndusc.cuts.lift_future_cost`), so the previous solution is
+          still feasible unless a feasibility cut removes it.
+        - the simplex basis, for the linear problems (and the relaxations
+          solved with duals), with the HiGHS persistent solver
+          (``appsi_highs``), the only one whose interface exposes it. The
+          basis is kept by variable, constraint and cut; the rows without
+          a saved status (the cuts added since) are basic and the columns
+          nonbasic. If the result is not a basis the solve starts without
+          one.
+
+    The starts are kept by node, so the nodes that share a problem (see
+    :class:`Template`) do not start from the solutions of each other, and
+    the solves do not depend on the order of the nodes (see
+    :func:`start_basis`).
+    """
+
+    def __init__(self):
+        self.starts = {}
+        self.warm = 0
+        self.bases = 0
+
+    def load(self, node, duals, template, opt):
+        """Load the start of the next solve of `node` in its problem and the
+        solver `opt`.
+
+        Return:
+            :obj:`bool`: True if the values of the variables must be given
+            to the solver (`warmstart` of :func:`solve`).
+        """
+        start = self.starts.get((node['id'], duals))
+        problem = template.problem
+        if start is None:
+            start_basis(opt, problem, template, (node['id'], duals))
+            return False
+        warmstart = False
+        if start['values'] is not None and \
+                getattr(opt, 'warm_start_capable', lambda: False)():
+            for v, value in zip(template.variables, start['values']):
+                if value == value:
+                    v.set_value(value, skip_validation=True)
+            cuts.lift_future_cost(problem, node)
+            stabilization.lift(problem)
+            warmstart = True
+            self.warm += 1
+        if start_basis(opt, problem, template, (node['id'], duals),
+                       start['basis']):
+            self.bases += 1
+        return warmstart
+
+    def save(self, node, duals, template, opt, selective):
+        """Keep the solution of the last (optimal) solve of `node`.
+
+        Args:
+            selective (:obj:`bool`): True if only some variables were loaded
+                from the solver (see :func:`solve`).
+        """
+        values = None
+        if template.integer and not duals and \
+                getattr(opt, 'warm_start_capable', lambda: False)():
+            if selective:
+                opt.load_vars(template.variables)
+            values = np.array([np.nan if v.value is None else v.value
+                               for v in template.variables])
+        basis = None
+        if duals or not template.integer:
+            basis = _get_basis(opt, template.problem, template)
+        self.starts[(node['id'], duals)] = {'values': values,
+                                            'basis': basis}
+
+
+def _highs(opt):
+    """Return the HiGHS model of the persistent solver `opt`, None if it is
+    not a HiGHS solver."""
+    highs = getattr(opt, '_solver_model', None)
+    if highs is None or not hasattr(highs, 'getBasis') or \
+            not hasattr(opt, '_pyomo_con_to_solver_con_map'):
+        return None
+    return highs
+
+
+def _basis_keys(problem, template):
+    """Keys of the columns and rows of the basis of `problem`: the
+    variables and constraints (by position), the future costs and the cuts
+    (by id)."""
+    columns = [(('var', j), v) for j, v in enumerate(template.variables)]
+    aux = problem.component('Aux_Obj')
+    if aux is not None:
+        columns.extend((('Aux_Obj', g), v) for g, v in aux.items())
+    rows = [(('con', i), c) for i, c in enumerate(template.constraints)]
+    for kind, name in (('feas', '_Cuts_Feas'), ('opt', '_Cuts_Opt')):
+        component = problem.component(name)
+        if component is not None:
+            rows.extend(((kind, cid), c) for cid, c in component.items())
+    return columns, rows
+
+
+def _get_basis(opt, problem, template):
+    """Return the basis of the last solve of `problem` by `opt`, by key
+    (see :func:`_basis_keys`), None if there is none."""
+    highs = _highs(opt)
+    if highs is None:
+        return None
+    basis = highs.getBasis()
+    if not basis.valid:
+        return None
+    col_status = basis.col_status
+    row_status = basis.row_status
+    var_map = opt._pyomo_var_to_solver_var_map
+    con_map = opt._pyomo_con_to_solver_con_map
+    columns, rows = _basis_keys(problem, template)
+    saved = {}
+    for key, v in columns:
+        j = var_map.get(id(v))
+        if j is not None:
+            saved[key] = ('col', col_status[j])
+    for key, c in rows:
+        i = con_map.get(c)
+        if i is not None:
+            saved[key] = ('row', row_status[i])
+    return saved
+
+
+def start_basis(opt, problem, template, key, saved=None):
+    """Set the basis the next solve of `problem` by the persistent HiGHS
+    solver `opt` starts from.
+
+    The solver keeps the basis of its last solve, which with a shared
+    problem (see :class:`Template`) is the basis of another node: the
+    result would depend on the order of the solves (and so on the workers
+    of the executor). If the last solve was not that of the node `key`
+    (id, duals), the basis is replaced by the basis `saved` of the node
+    (see :func:`_get_basis`), or cleared.
+
+    The basis is set before the changes of `problem` are sent to the solver
+    (at the start of the solve, not to send them twice): the rows without a
+    saved status (the cuts of the previous node, removed next, and those
+    added since) are basic, and the columns nonbasic.
+
+    Return:
+        :obj:`bool`: True if the basis `saved` was loaded.
+    """
+    highs = _highs(opt)
+    if highs is None or getattr(opt, '_model', None) is not problem:
+        return False
+    if template.solved == key:
+        return False
+    template.solved = key
+    # Imported here as HiGHS is an optional solver
+    import highspy
+    basis = highs.getBasis()
+    if saved is None or not basis.valid:
+        highs.clearSolver()
+        return False
+    status = highspy.HighsBasisStatus
+    row_status = [status.kBasic] * len(basis.row_status)
+    col_status = [status.kZero] * len(basis.col_status)
+    lp = highs.getLp()
+    for j, (lb, ub) in enumerate(zip(lp.col_lower_, lp.col_upper_)):
+        if lb > -highspy.kHighsInf:
+            col_status[j] = status.kLower
+        elif ub < highspy.kHighsInf:
+            col_status[j] = status.kUpper
+    var_map = opt._pyomo_var_to_solver_var_map
+    con_map = opt._pyomo_con_to_solver_con_map
+    columns, rows = _basis_keys(problem, template)
+    for key, v in columns:
+        j = var_map.get(id(v))
+        if j is not None and key in saved:
+            col_status[j] = saved[key][1]
+    for key, c in rows:
+        i = con_map.get(c)
+        if i is not None and key in saved:
+            row_status[i] = saved[key][1]
+    basis.col_status = col_status
+    basis.row_status = row_status
+    if col_status.count(status.kBasic) + row_status.count(
+            status.kBasic) != len(row_status) or \
+            highs.setBasis(basis) != highspy.HighsStatus.kOk:
+        highs.clearSolver()
+        return False
+    return True
+
+
+# Backends of the node solves (see Persistent_models)
+backends = ('pyomo', 'matrix')
+
+
+class Template(object):
+    """Problem shared by the nodes with the same structure.
+
+    The nodes of a stage that use the same model, sets and linking usually
+    differ only in the values of some parameters. Their template is built
+    once, from the data of the first of them, and each node is a vector of
+    values of the scenario parameters: the parameters of the data that are
+    mutable parameters of the model (with the same name), other than the
+    linking parameters. The other parameters of the data are structural:
+    a node shares the template only if their values are those it was built
+    with.
+
+    The model must use the scenario parameters only through the mutable
+    parameters, not through their values at build time. This is checked
+    when a second node shares the template (see :func:`fingerprint`); if
+    the check fails, each node of the template gets its own problem.
+
+    Args:
+        problem (:obj:`pyomo.environ.ConcreteModel`): problem built from the
+            data of the first node.
+        params (:obj:`dict`): linking parameters, see :func:`linking_params`.
+        data_params (:obj:`dict`): `params` of the data of the first node
+            (without the state).
+    """
+
+    def __init__(self, problem, params, data_params):
+        self.problem = problem
+        self.params = params
+        self.technology = cuts.Technology(problem, params)
+        self.opt = None
+        self.owner = None
+        # Node (id, duals) of the last solve of `opt` (see start_basis)
+        self.solved = None
+        self.lock = threading.Lock()
+        self.plans = {}
+
+        # Copies solving other nodes at the same time (see
+        # Persistent_models.acquire), and the check of the model when a
+        # second node shares the template: scenario parameters and state
+        # of the first node, fingerprint of the problem with them and True
+        # once checked (False if the nodes can not share it)
+        self.copies = [self]
+        self.first = None
+        self.fingerprint = None
+        self.verified = None
+
+        # Variables and constraints of the model (see Hot_starts)
+        self.variables = list(problem.component_data_objects(pyenv.Var))
+        self.constraints = list(problem.component_data_objects(
+            pyenv.Constraint, active=True))
+        self.integer = any(not v.is_continuous() for v in self.variables)
+
+        # Matrix form of the problem (see Persistent_models.matrix)
+        self.matrix = None
+
+        linked = set(id(param) for param in params.values())
+        self.scenario = {}
+        self.structure = {}
+        for name, value in data_params.items():
+            component = problem.component(name)
+            if (isinstance(component, pyenv.Param) and component.mutable
+                    and id(component) not in linked):
+                self.scenario[name] = component
+            else:
+                self.structure[name] = value
+
+    def accepts(self, data_params):
+        """Return True if a node with `data_params` can use the template."""
+        if set(data_params) != set(self.scenario) | set(self.structure):
+            return False
+        return all(data_params[name] == value
+                   for name, value in self.structure.items())
+
+    def values(self, data_params):
+        """Return the vector of scenario parameters of `data_params`."""
+        return {name: data_params[name] for name in self.scenario}
+
+    def plan(self, names):
+        """Return the extraction plan of the state variables `names`."""
+        plan = self.plans.get(names)
+        if plan is None:
+            plan = self.plans[names] = format_sol.Extraction_plan(
+                self.problem, names, self.technology.rows)
+        return plan
+
+    def apply(self, nodeid, values):
+        """Load the scenario parameters `values` of the node `nodeid`."""
+        if self.owner == nodeid:
+            return
+        for name, value in values.items():
+            param = self.scenario[name]
+            if param.is_indexed():
+                param.store_values(value)
+            else:
+                param.set_value(value)
+        self.owner = nodeid
+
+
+class Persistent_models(object):
+    """Problems of the nodes kept alive between iterations.
+
+    In persistent mode the problem of each node is built once. Later solves
+    only push the new state (the solution of the parent) into its linking
+    parameters and re-solve it with the same solver object. With Pyomo's
+    persistent (``appsi_*``) solvers the problem also stays loaded in the
+    solver, which only receives the changes.
+
+    With `shared` the nodes of a stage with the same model, sets and linking
+    share one problem, their :class:`Template`, and only their scenario
+    parameters and cuts are swapped in before each solve.
+
+    The linking parameters must be declared ``mutable=True`` in the model
+    file, both to be updated and to compute the cuts of the parent.
+
+    Args:
+        data (:obj:`dict`): dictionary with problem data.
+        solver (:obj:`str`): solver name.
+        persistent (:obj:`bool`): if False every solve rebuilds the problem.
+        shared (:obj:`bool`): if True (and `persistent`) the nodes share
+            templates.
+        nodes (:obj:`dict`): id -> node of the tree, to inherit the data of
+            the ancestors (see :class:`ndusc.utilities.Node_data`).
+        hot_start (:obj:`bool`): if True (and `persistent`) each solve of a
+            node starts from its previous solution (see :class:`Hot_starts`).
+        backend (:obj:`str`): 'pyomo' (the problems are solved by `solver`
+            through Pyomo) or 'matrix' (the linear problems are compiled
+            into matrices and solved by HiGHS without Pyomo, see
+            :mod:`ndusc.matrix`; the problems that can not be compiled, and
+            the stabilized solves and the solves that fail in HiGHS, still go
+            through Pyomo).
+
+    Raises:
+        ValueError: if a linking parameter is not mutable.
+    """
+
+    def __init__(self, data, solver='gurobi', persistent=True, shared=True,
+                 nodes=None, hot_start=False, backend='pyomo'):
+        if backend not in backends:
+            raise ValueError('Unknown backend: {}'.format(backend))
+        self.data = data
+        self.node_data = utilities.Node_data(data, nodes)
+        self.solver = solver
+        self.persistent = persistent
+        self.shared = shared and persistent
+        self.hot_starts = Hot_starts() if hot_start and persistent else None
+        self.backend = backend
+        self.templates = {}
+        self.node_templates = {}
+        self.values = {}
+        self.builds = 0
+        self._lock = threading.Lock()
+
+    def template(self, node, state=None):
+        """Return the template of `node`, building it if needed.
+
+        Return:
+            :obj:`tuple`: template and True if it has been built.
+        """
+        nodeid = node['id']
+        with self._lock:
+            template = self.node_templates.get(nodeid)
+            if self.persistent and template is not None:
+                return template, False
+
+            # Get node data
+            model_data = self.node_data(node)
+            data_params = model_data.get('params') or {}
+            key = template_key(node, model_data) if self.shared else nodeid
+            state = state or {}
+            problem = None
+            for template in self.templates.get(key, []):
+                if not (self.persistent and template.accepts(data_params)):
+                    continue
+                if template.verified is None:
+                    problem, params = self._build(node, model_data, state)
+                    template.verified = template.fingerprint == fingerprint(
+                        problem, params, template.first)
+                    if not template.verified:
+                        log.warning(
+                            'Node {}: the model uses the values of the '
+                            'scenario parameters when it is built, its '
+                            'problem is not shared'.format(nodeid))
+                if template.verified:
+                    self.node_templates[nodeid] = template
+                    self.values[nodeid] = template.values(data_params)
+                    return template, False
+                key = nodeid
+                break
+
+            # Create the problem (that of a failed check has the values of
+            # the first node of the other template)
+            owner = None if problem is not None else nodeid
+            if problem is None:
+                problem, params = self._build(node, model_data, state)
+            template = Template(problem, params, data_params)
+            template.owner = owner
+            if key == nodeid:
+                self.templates[key] = [template]
+            else:
+                template.first = (template.values(data_params), state)
+                template.fingerprint = fingerprint(problem, params,
+                                                   template.first)
+                self.templates.setdefault(key, []).append(template)
+            self.node_templates[nodeid] = template
+            self.values[nodeid] = template.values(data_params)
+            return template, True
+
+    @contextlib.contextmanager
+    def acquire(self, node, template, state=None):
+        """Hold a copy of `template` for a solve of `node`.
+
+        The nodes that share a template are solved one at a time on each copy
+        of it. If the copies are solving other nodes (in other threads), a
+        new copy is built from the data of `node`, so the threads of an
+        executor solve the nodes of a stage in parallel.
+
+        Args:
+            template (:obj:`Template`): template of `node` (see
+                :meth:`template`).
+
+        Yield:
+            :obj:`Template`: copy of `template`, locked.
+        """
+        with self._lock:
+            for copy in template.copies:
+                if copy.lock.acquire(blocking=False):
+                    break
+            else:
+                copy = None
+        if copy is None:
+            problem, params = self._build(node, self.node_data(node),
+                                          state or {})
+            copy = Template(problem, params, {})
+            copy.scenario = {name: problem.component(name)
+                             for name in template.scenario}
+            copy.lock.acquire()
+            with self._lock:
+                template.copies.append(copy)
+        try:
+            yield copy
+        finally:
+            copy.lock.release()
+
+    def _build(self, node, model_data, state):
+        """Build the problem of `node`.
+
+        Return:
+            :obj:`tuple`: problem and its linking parameters.
+
+        Raises:
+            ValueError: if a linking parameter is not mutable.
+        """
+        with instrument.span('build', node['id']):
+            problem = registry.builder(node['model'])(
+                model_data.with_state(state))
+        self.builds += 1
+        params = linking_params(problem, state, node['model'].get('linking'))
+        for name, param in params.items():
+            if not param.mutable:
+                raise ValueError('Node {}: linking parameter {} must be '
+                                 'mutable'.format(node['id'], param.name))
+        return problem, params
+
+    def problem(self, node, state=None, template=None):
+        """Return the problem of `node` with `state` as parent solution.
+
+        Args:
+            template (:obj:`Template`): template of the node, if already
+                obtained with :meth:`template`.
+        """
+        if template is None:
+            template, built = self.template(node, state)
+        template.apply(node['id'], self.values[node['id']])
+        set_state(template.params, state or {})
+        return template.problem
+
+    def solve(self, node, state=None, duals=True, lock=None, template=None,
+              names=None, stabilize=None):
+        """Solve the problem of `node` with the cuts stored in the node.
+
+        If other threads can solve nodes that share the template, the
+        caller must hold a copy of it (see :meth:`acquire`).
+
+        Args:
+            lock (:obj:`threading.Lock`): if given, held while the solver
+                runs.
+            template (:obj:`Template`): see :meth:`problem`.
+            names (:obj:`tuple`): names of the state variables of the node
+                (see :meth:`Template.plan`). If None the full solution is
+                returned.
+            stabilize (:obj:`dict`): if given, the problem is solved with
+                this stabilization (see :func:`ndusc.stabilization.apply`).
+
+        Return:
+            :obj:`tuple`: solver results and problem results.
+        """
+        if template is None:
+            template, built = self.template(node, state)
+        problem = self.problem(node, state, template)
+        if stabilize is None and self.matrix(template) is not None:
+            with instrument.span('matrix.solve'):
+                solver_results, results = template.matrix.solve(
+                    node, duals, names)
+            # The numerical failures of HiGHS are solved again by `solver`
+            if solver_results['Solver'][0][
+                    'Termination condition'] != 'error':
+                return solver_results, results
+            log.info('Matrix solve failed, node {} solved through '
+                     'Pyomo'.format(node['id']))
+        cuts.create_cuts(problem, node)
+        if template.opt is None:
+            template.opt = pyenv.SolverFactory(self.solver)
+        plan = None if names is None else template.plan(names)
+        if stabilize is not None:
+            stabilization.apply(problem, stabilize)
+        try:
+            with lock or contextlib.nullcontext():
+                if self.hot_starts is None:
+                    start_basis(template.opt, problem, template,
+                                (node['id'], duals))
+                    return solve(problem, self.solver, duals, template.opt,
+                                 plan)
+                warmstart = self.hot_starts.load(node, duals, template,
+                                                 template.opt)
+                solver_results, results = solve(
+                    problem, self.solver, duals, template.opt, plan,
+                    warmstart)
+                if results is not None:
+                    self.hot_starts.save(
+                        node, duals, template, template.opt,
+                        plan is not None and hasattr(template.opt,
+                                                     'load_vars'))
+                return solver_results, results
+        finally:
+            if stabilize is not None:
+                stabilization.release(problem)
+
+    def matrix(self, template):
+        """Return the matrix form of the problem of `template` (see
+        :class:`ndusc.matrix.Matrix_problem`), compiled the first time.
+        None with the 'pyomo' backend, or if the problem is not linear.
+        """
+        if self.backend != 'matrix' or template.matrix is False:
+            return None
+        if template.matrix is None:
+            with instrument.span('compile'):
+                template.matrix = matrix.compile_problem(
+                    template.problem, template.technology.rows) or False
+            if template.matrix is False:
+                log.info('Problem not linear, solved through Pyomo')
+                return None
+        return template.matrix
+
+
+def fingerprint(problem, params, first):
+    """Return the structure of `problem` with the scenario parameters and
+    the state `first` (see :class:`Template`): the domains and bounds of
+    its variables, and the linear and quadratic coefficients, constants and
+    bounds of its constraints and objectives, by name.
+
+    Two nodes can share a template if their problems, built from their
+    data, have the same fingerprint with the same values: the model uses
+    the scenario parameters only through the mutable parameters.
+
+    Args:
+        params (:obj:`dict`): linking parameters of `problem`.
+        first (:obj:`tuple`): values of the scenario parameters and state.
+    """
+    values, state = first
+    for name, value in values.items():
+        param = problem.component(name)
+        if param.is_indexed():
+            param.store_values(value)
+        else:
+            param.set_value(value)
+    set_state(params, state)
+    rows = []
+    for v in problem.component_data_objects(pyenv.Var):
+        rows.append((v.name, str(v.domain), _number(v.lb), _number(v.ub)))
+    for c in problem.component_data_objects(
+            (pyenv.Constraint, pyenv.Objective), active=True):
+        if c.ctype is pyenv.Objective:
+            expr, bounds = c.expr, ()
+        else:
+            expr, bounds = c.body, (_number(c.lower), _number(c.upper))
+        repn = generate_standard_repn(expr, compute_values=True)
+        rows.append((c.name, bounds, _number(repn.constant),
+                     tuple(v.name for v in repn.linear_vars),
+                     tuple(_number(a) for a in repn.linear_coefs),
+                     tuple((v.name, w.name) for v, w in repn.quadratic_vars),
+                     tuple(_number(a) for a in repn.quadratic_coefs),
+                     str(repn.nonlinear_expr)))
+    return rows
+
+
+def _number(expr):
+    """Value of `expr` (None if it is None) with 12 significant digits."""
+    if expr is None:
+        return None
+    return float('{:.12g}'.format(pyenv.value(expr)))
+
+
+def template_key(node, model_data):
+    """Return the key of the nodes that can share the template of `node`.
+
+    Nodes share a template if they are in the same stage and have the same
+    model, linking and sets (:meth:`Template.accepts` checks the
+    parameters).
+    """
+    model_spec = node['model']
+    function = model_spec.get('function')
+    if callable(function):
+        function = id(function)
+    linking = tuple(sorted((model_spec.get('linking') or {}).items()))
+    return (node.get('stage'), model_spec.get('file'), function,
+            model_spec.get('entry_point'), linking,
+            repr(model_data.get('sets')))
+
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _file_digest(path):
+    with open(path, 'rb') as model_file:
+        return hashlib.sha1(model_file.read()).hexdigest()
@@ -1,131 +1,581 @@
-import tree
-
-
-def nested_decomposition(tree,data):
-    # INICIO METODO
-    #
-    # Iterate over al nodes of each stage
-    #
-    tree_nc  = tree.Tree(tree)
-
-    nodes1 = tree_nc1.return_stage_nodes(1)
-    tree_nc1.return_previous_node(1)
-
-
-
-    stages = sorted(list(set(jmespath.search("nodes[*].stage", tree))))
-
-    # dir = 1 # if 1 forward if -1 backward
-
-    # - while optimality conditions are not met
-    # while
-
-    # - for stage in stages:
-
-    # FIRST STAGE
-    stage = stages[0]
-
-    #### CAMBIA
-    stage_nodes = jmespath.search("nodes[?stage==`{}`]".format(stage), tree)
-
-    # -- for node in stage_nodes:
-
-    node = stage_nodes[0]
-
-    # Get node data
-    model_data = utilities.node_data(node, data)
-
-    # Create the problem
-    problem = model.load(node['model']['file'],
-                        node['model']['function'],
-                        model_data)
-
-
-    cuts.create_cuts(model, node)
-
-    # Solve the problem
-    solver_results, problem_results = model.solve(problem, 'gurobi', duals=False)
-
-    # update tree with new results
-    node.update(problem_results)
-
-    # SECOND STAGE
-    stage = stages[1]
-    stage_nodes = jmespath.search("nodes[?stage==`{}`]".format(stage), tree)
-
-    # -- for node in stage_nodes:
-
-    node = stage_nodes[0]
-
-    # update data with
-    model_data = utilities.node_data(node, data)
-
-    prev_id = node['prev_id']
-
-    ####
-    prev_vars = jmespath.search("nodes[?id==`{}`].variables".format(prev_id), tree)
-
-    # <------------
-    # Load solution of the previous node
-    if len(prev_vars) == 1:
-        prev_vars = prev_vars[0]
-    else:
-        print "Error more than one parent"
-
-    model_data['params'].update(prev_vars)
-    # <------------
-
-    problem = model.load(node['model']['file'],
-                        node['model']['function'],
-                        model_data)
-
-    solver_results, problem_results = model.solve(problem, 'gurobi', duals=False)
-
-
-
-
-    #
-    # Load Second Model
-    #
-    #
-    #model1 = model_S1(data, node)
-    #
-    #
-    #cuts = {
-    #            'sets':{
-    #                'Cuts_Opt':[],
-    #                'Cuts_Feas':[],
-    #            },
-    #            'params':{
-    #                'D':{},
-    #                'd':{},
-    #                'E':{},
-    #                'e':{}
-    #            }
-    #        }
-    #
-    #
-    ##
-    ## Create a solver
-    ##
-    #
-    #opt = SolverFactory('gurobi')
-    #
-    ### Create a model instance and optimize
-    #instance_S1 = model_S1.create_instance()
-    #results_S1 = opt.solve(instance_S1)
-    #instance_S1.load(results_S1)
-    #print results_S1
-    #
-    ## Iterate to eliminate the previously found solution
-    #results = {'variables':{}}
-    #for v in instance_S1.active_components(Var):
-    #    results['variables'][v.getname()] = {}
-    #    varobject = getattr(instance_S1, str(v))
-    #    for index in varobject:
-    #        results['variables'][v.getname()][index] = varobject[index].value
-    #
-
+import logging as log
+
+import numpy as np
+
+from ndusc import checkpoint
+from ndusc import cuts
+from ndusc import instrument
+from ndusc import model
+from ndusc import output_module
+from ndusc import parallel
+from ndusc import scheduler
+from ndusc import stabilization
+from ndusc import tree
+
+# Sequencing protocols of the stages (see sequenced_sweep)
+protocols = ('FF', 'FB', 'FFFB')
+
+
+def nested_decomposition(tree_data, data, solver='gurobi', persistent=True,
+                         max_iter=100, tol=1e-6, executor='serial',
+                         workers=None, cut_mode='single', cut_clusters=None,
+                         cut_max_age=None, shared=True, full_solution=False,
+                         schedule='stages', staleness=0, protocol='FFFB',
+                         output_path=None, checkpoint_path=None,
+                         warm_start=None, resume=False, stabilize=None,
+                         hot_start=False, cut_family='benders',
+                         backend='pyomo'):
+    """Nested decomposition.
+
+    Each iteration solves the tree forward, stage by stage, giving to each
+    node the solution of its parent, and then goes backward adding to each
+    parent the cut computed from its children. If a node is infeasible the
+    forward pass stops at its stage and a feasibility cut is added to its
+    parent. `protocol` changes the order in which the stages are visited
+    (see :func:`sequenced_sweep`).
+
+    Args:
+        tree_data (:obj:`dict`): tree information.
+        data (:obj:`dict`): dictionary with problem data.
+        solver (:obj:`str`): solver name.
+        persistent (:obj:`bool`): if True the problem of each node is built
+            once and only its linking parameters are updated between
+            iterations (see :class:`ndusc.model.Persistent_models`).
+        max_iter (:obj:`int`): maximum number of iterations.
+        tol (:obj:`float`): relative tolerance of the gap between bounds.
+        executor (:obj:`str`): how the nodes of a stage are solved: 'serial',
+            'threads' or 'processes' (see :mod:`ndusc.parallel`), or
+            'distributed' (workers on other hosts, see
+            :mod:`ndusc.distributed`).
+        workers (:obj:`int`): number of threads or processes (default: number
+            of cpus). With 'distributed', the addresses of the workers
+            (``'host:port'``) or the number of workers to start on
+            localhost.
+        cut_mode (:obj:`str`): optimality cuts added to each parent: 'single'
+            (one cut aggregating all its children), 'multi' (one cut per
+            child) or 'hybrid' (one cut per cluster of children, see
+            :func:`ndusc.cuts.cut_groups`).
+        cut_clusters (:obj:`int`): number of clusters of the hybrid mode.
+        cut_max_age (:obj:`int`): cuts inactive for `cut_max_age` iterations
+            are removed from the model of their node. They are kept in its cut
+            pool and added again if violated (see
+            :class:`ndusc.cut_pool.Cut_pool`). If None cuts are never removed.
+        shared (:obj:`bool`): if True the nodes of a stage with the same
+            model share one problem and only their parameters are swapped
+            (see :class:`ndusc.model.Template`).
+        full_solution (:obj:`bool`): if True the full solution of each node
+            (all the variables, and the duals) is stored in the tree, for
+            reporting. Otherwise only its state variables, those that feed
+            its children, are extracted (see
+            :class:`ndusc.format_sol.Extraction_plan`).
+        schedule (:obj:`str`): 'stages' (the stage by stage sweep above) or
+            'async' (each node is solved as soon as its parent or its
+            children have new information, see
+            :class:`ndusc.scheduler.Async_scheduler`). With 'async'
+            `max_iter` bounds the number of solves of the root.
+        staleness (:obj:`int`): with 'async', number of trial solutions of a
+            parent a linearization of its children can lag behind to be used
+            in its cuts.
+        protocol (:obj:`str`): with 'stages', sequencing protocol of the
+            stages: 'FFFB' (fast-forward-fast-back: whole forward and
+            backward passes), 'FF' (fast-forward) or 'FB' (fast-back), see
+            :data:`protocols`.
+        output_path (:obj:`str`): directory where the convergence log is
+            written after each iteration (see :mod:`ndusc.output_module`),
+            or a :class:`ndusc.output_module.Output_module`.
+        checkpoint_path (:obj:`str`): file where the state of the run is
+            saved after each iteration, or a
+            :class:`ndusc.checkpoint.Checkpoint` (to save it less often).
+        warm_start: checkpoint (path or state, see
+            :mod:`ndusc.checkpoint`) whose cuts are added to the nodes with
+            the same id before the first iteration.
+        resume (:obj:`bool`): if True the run continues the one of
+            `warm_start` (see :func:`ndusc.checkpoint.resume`): its bounds,
+            iterations and counters are restored too. Without `warm_start`
+            the run continues the one saved in `checkpoint_path`.
+        stabilize (:obj:`str`): stabilization of the trial points of the
+            masters: 'proximal', 'trust_region' or 'level', or a
+            :class:`ndusc.stabilization.Stabilizer` (to set its parameters
+            and stages). Only with the 'stages' schedule and the 'FFFB'
+            protocol.
+        hot_start (:obj:`bool`): if True (and `persistent`) each solve of a
+            node starts from its previous solution: MIP start and simplex
+            basis (see :class:`ndusc.model.Hot_starts`).
+        cut_family: family of the optimality cuts computed from the nodes
+            of each stage: 'benders', 'integer' (integer L-shaped),
+            'strengthened' or 'lagrangian' (see
+            :func:`ndusc.cuts.stage_family`), or dictionary stage ->
+            family. The families other than 'benders' need binary states.
+        backend (:obj:`str`): 'pyomo' or 'matrix' (the linear and mixed
+            integer problems are compiled once into sparse matrices and
+            solved by HiGHS, without Pyomo, see :mod:`ndusc.matrix`).
+
+    Return:
+        :obj:`dict`: status, bounds, number of iterations (solves of the
+        root), number of node `solves`, number of model builds and the tree
+        with the results of each node.
+    """
+    tree_nc = tree.Tree(tree_data)
+    model.registry.refresh()
+
+    output = {
+        'status': 'max_iter',
+        'lower_bound': -np.inf,
+        'upper_bound': np.inf,
+        'iterations': 0,
+        'solves': 0,
+        'builds': 0,
+        'cuts_evicted': 0,
+        'cuts_revived': 0,
+    }
+    for node in tree_nc.nodes:
+        cuts.init_cut_pools(node, cut_max_age)
+        # Names of the state variables, known once the children are built
+        node['state_names'] = None if tree_nc.return_children(node['id']) \
+            else ()
+
+    for stage in tree_nc.stages:
+        cuts.stage_family(cut_family, stage)
+    if schedule not in ('stages', 'async'):
+        raise ValueError('Unknown schedule: {}'.format(schedule))
+    if protocol not in protocols:
+        raise ValueError('Unknown protocol: {}'.format(protocol))
+    if stabilize is not None:
+        if schedule != 'stages' or protocol != 'FFFB':
+            raise ValueError('Stabilization needs the stages schedule and '
+                             'the FFFB protocol')
+        if not isinstance(stabilize, stabilization.Stabilizer):
+            stabilize = stabilization.Stabilizer(stabilize)
+        stabilize.start(tree_nc)
+
+    history = ()
+    if resume and warm_start is None:
+        if checkpoint_path is None:
+            raise ValueError('Resume needs a warm_start or a '
+                             'checkpoint_path')
+        warm_start = getattr(checkpoint_path, 'path', checkpoint_path)
+    if warm_start is not None:
+        if isinstance(warm_start, str):
+            warm_start = checkpoint.load(warm_start)
+        checkpoint.restore(tree_nc, warm_start, output if resume else None)
+        if resume:
+            history = warm_start['history']
+
+    # Monitors of the end of each iteration
+    monitors = []
+    run_log = open_log(output_path, algorithm='nested_decomposition',
+                       nodes=len(tree_nc.nodes), stages=len(tree_nc.stages),
+                       executor=executor, schedule=schedule,
+                       protocol=protocol, cut_mode=cut_mode)
+    if run_log is not None:
+        monitors.append(run_log)
+    if checkpoint_path is not None:
+        if not isinstance(checkpoint_path, checkpoint.Checkpoint):
+            checkpoint_path = checkpoint.Checkpoint(checkpoint_path)
+        checkpoint_path.start(tree_data, history)
+        monitors.append(checkpoint_path)
+
+    pool = parallel.create_executor(executor, tree_nc, data, solver,
+                                    persistent, workers, shared, hot_start,
+                                    backend)
+    try:
+        if schedule == 'async':
+            scheduler.Async_scheduler(
+                tree_nc, pool, output, max_iter, tol, cut_mode, cut_clusters,
+                staleness, full_solution, monitors, cut_family).run()
+        elif protocol == 'FFFB':
+            stage_sweep(tree_nc, pool, output, max_iter, tol, cut_mode,
+                        cut_clusters, full_solution, monitors, stabilize,
+                        cut_family)
+        else:
+            sequenced_sweep(tree_nc, pool, output, protocol, max_iter, tol,
+                            cut_mode, cut_clusters, full_solution, monitors,
+                            cut_family)
+    finally:
+        pool.close()
+        if run_log is not None:
+            run_log.close()
+
+    for monitor in monitors:
+        monitor.finish(output, tree_nc)
+    output['tree'] = tree_nc
+    return output
 
 
-    return output
+def stage_sweep(tree_nc, pool, output, max_iter=100, tol=1e-6,
+                cut_mode='single', cut_clusters=None, full_solution=False,
+                monitors=(), stabilize=None, cut_family='benders'):
+    """Iterate forward and backward passes until the bounds meet.
+
+    The iterations start after those already in `output` (e.g. of a
+    resumed run).
+
+    Args:
+        monitors (:obj:`list`): objects told of the end of each iteration,
+            see :func:`end_iteration`.
+        stabilize (:obj:`ndusc.stabilization.Stabilizer`): stabilization
+            of the forward passes.
+        cut_family: see :func:`ndusc.cuts.stage_family`.
+    """
+    root = tree_nc.return_stage_nodes(tree_nc.stages[0])[0]
+    for iteration in range(output['iterations'] + 1, max_iter + 1):
+        end_iteration(monitors, output, tree_nc)
+        output['iterations'] = iteration
+        instrument.set_iteration(iteration)
+        log.info('Iteration {}'.format(iteration))
+
+        # Forward pass
+        infeasible = forward_pass(tree_nc, pool, output, iteration,
+                                  full_solution, stabilize)
+        if root in infeasible:
+            output['status'] = 'infeasible'
+            break
+        if infeasible:
+            if not feasibility_cuts(tree_nc, pool, infeasible, tol, output,
+                                    cut_family):
+                # The relaxations of the infeasible nodes are feasible
+                output['status'] = 'stalled'
+                break
+            continue
+
+        # Bounds
+        if len(root['cut_pool']['opt']):
+            output['lower_bound'] = root['value'] if stabilize is None \
+                else stabilize.bound(root)
+        if update_bounds(tree_nc, output, tol):
+            output['status'] = 'optimal'
+            break
+        if stabilize is not None:
+            stabilize.update(tree_nc)
+
+        # Backward pass
+        new = backward_pass(tree_nc, pool, output, cut_mode, cut_clusters,
+                            tol, cut_family)
+        if stabilize is not None:
+            stabilize.end_iteration(new)
+
+
+def sequenced_sweep(tree_nc, pool, output, protocol='FF', max_iter=100,
+                    tol=1e-6, cut_mode='single', cut_clusters=None,
+                    full_solution=False, monitors=(), cut_family='benders'):
+    """Visit the stages following a sequencing protocol until the bounds
+    meet.
+
+    The sweep moves between neighbour stages. A forward step at a stage
+    solves its nodes at the trial solutions of their parents; a backward
+    step solves them with duals and adds the cuts of their parents. The
+    cuts are new if they are violated by the solutions of the parents (see
+    :func:`backward_stage`). After a backward step with new cuts the parents
+    are solved again (forward step). Otherwise:
+
+        - 'FF' (fast-forward): goes forward whenever possible. The sweep
+          goes to the last stage, and only goes further back than the parents
+          of a stage when the stage gives no new cut.
+        - 'FB' (fast-back): goes backward whenever possible. Each forward
+          step is followed by a backward step at the same stage, and the
+          sweep only goes forward when it gives no new cut.
+
+    'FFFB' (fast-forward-fast-back), whole forward and backward passes, is
+    :func:`stage_sweep`.
+
+    The upper bound is updated each time the last stage is solved, as all
+    the stages are then solved at the trial solutions of their parents.
+    `max_iter` bounds the number of solves of the root, and each iteration
+    ends (see `monitors` in :func:`stage_sweep`) when the root is solved
+    again.
+    """
+    stages = tree_nc.stages
+    last = len(stages) - 1
+    root = tree_nc.return_stage_nodes(stages[0])[0]
+    k, forward = 0, True
+    while True:
+        if not forward:
+            new = backward_stage(tree_nc, pool, output, stages[k], cut_mode,
+                                 cut_clusters, tol, cut_family)
+            if new:
+                k, forward = k - 1, True
+            elif protocol == 'FB' and k < last:
+                k, forward = k + 1, True
+            else:
+                k -= 1
+                forward = k == 0
+            continue
+
+        if k == 0:
+            end_iteration(monitors, output, tree_nc)
+            if output['iterations'] >= max_iter:
+                output['status'] = 'max_iter'
+                break
+            output['iterations'] += 1
+            instrument.set_iteration(output['iterations'])
+            log.info('Iteration {}'.format(output['iterations']))
+        infeasible = forward_stage(tree_nc, pool, output, stages[k],
+                                   output['iterations'], full_solution)
+        if root in infeasible:
+            output['status'] = 'infeasible'
+            break
+        if infeasible:
+            if not feasibility_cuts(tree_nc, pool, infeasible, tol, output,
+                                    cut_family):
+                output['status'] = 'stalled'
+                break
+            k -= 1
+            continue
+
+        if k == 0 and len(root['cut_pool']['opt']):
+            output['lower_bound'] = root['value']
+        if k == last:
+            if update_bounds(tree_nc, output, tol):
+                output['status'] = 'optimal'
+                break
+            forward = k == 0
+        elif protocol == 'FB' and k > 0:
+            forward = False
+        else:
+            k += 1
+
+
+def update_bounds(tree_nc, output, tol=1e-6):
+    """Update the upper bound with the costs of the nodes.
+
+    Return:
+        :obj:`bool`: True if the gap between the bounds is within `tol`.
+    """
+    costs = np.array([n['cost'] for n in tree_nc.nodes])
+    output['upper_bound'] = min(output['upper_bound'],
+                                tree_nc.expected_value(costs))
+    log.info('Bounds: [{}, {}]'.format(output['lower_bound'],
+                                       output['upper_bound']))
+    gap = output['upper_bound'] - output['lower_bound']
+    return gap <= tol * max(1.0, abs(output['upper_bound']))
+
+
+def forward_pass(tree_nc, pool, output, iteration, full_solution=False,
+                 stabilize=None):
+    """Solve the tree stage by stage and update the cut pools.
+
+    Return:
+        :obj:`list`: infeasible nodes of the first stage with any, empty if
+        all the nodes are feasible.
+    """
+    for stage in tree_nc.stages:
+        infeasible = forward_stage(tree_nc, pool, output, stage, iteration,
+                                   full_solution, stabilize)
+        if infeasible:
+            return infeasible
+    return []
+
+
+def forward_stage(tree_nc, pool, output, stage, iteration,
+                  full_solution=False, stabilize=None):
+    """Solve the nodes of `stage` at the solutions of their parents.
+
+    Args:
+        stabilize (:obj:`ndusc.stabilization.Stabilizer`): if given, the
+            trial points of the masters are stabilized.
+
+    Return:
+        :obj:`list`: infeasible nodes.
+    """
+    with instrument.span('forward stage', stage=stage):
+        nodes = tree_nc.return_stage_nodes(stage)
+        log.info('Solve stage {}'.format(stage))
+        tasks = [(node, node_state(tree_nc, node), False,
+                  None if full_solution else node['state_names'])
+                 for node in nodes]
+        if stabilize is None:
+            solutions = pool.solve(tasks)
+        else:
+            solutions, extra = stabilize.solve(tree_nc, pool, nodes, tasks)
+            output['solves'] += len(extra)
+            for node, solution in extra:
+                count_solve(output, node, solution)
+        output['solves'] += len(nodes)
+        infeasible = []
+        for node, solution in zip(nodes, solutions):
+            count_solve(output, node, solution)
+            update_state_names(tree_nc, node, solution['linking'])
+            if solution['results'] is None:
+                infeasible.append(node)
+                continue
+
+            # update tree with new results
+            node.update(solution['results'])
+            node['value'] = solution['value']
+            node['cost'] = solution['cost']
+            evicted, revived = cuts.update_cut_pools(node, iteration)
+            output['cuts_evicted'] += evicted
+            output['cuts_revived'] += revived
+        return infeasible
+
+
+def backward_pass(tree_nc, pool, output, cut_mode='single', cut_clusters=None,
+                  tol=1e-6, cut_family='benders'):
+    """Add to each node the optimality cuts computed from its children.
+
+    Return:
+        :obj:`int`: number of new cuts (see :func:`backward_stage`).
+    """
+    new = 0
+    for stage in reversed(tree_nc.stages[1:]):
+        new += backward_stage(tree_nc, pool, output, stage, cut_mode,
+                              cut_clusters, tol, cut_family)
+    return new
+
+
+def backward_stage(tree_nc, pool, output, stage, cut_mode='single',
+                   cut_clusters=None, tol=1e-6, cut_family='benders'):
+    """Add to the parents of the nodes of `stage` the optimality cuts
+    computed from them, of the family of the stage in `cut_family` (see
+    :func:`ndusc.cuts.stage_family`).
+
+    Return:
+        :obj:`int`: number of new cuts: those violated by the solution of
+        their node, whose future cost (`Aux_Obj`) is below the expected
+        value of the children of the cut (relative tolerance `tol`).
+    """
+    with instrument.span('backward stage', stage=stage):
+        return _backward_stage(tree_nc, pool, output, stage, cut_mode,
+                               cut_clusters, tol, cut_family)
+
+
+def _backward_stage(tree_nc, pool, output, stage, cut_mode, cut_clusters,
+                    tol, cut_family):
+    cond_prob = tree_nc.conditional_probability()
+    nodes = tree_nc.return_stage_nodes(stage)
+    family = cuts.stage_family(cut_family, stage)
+    solutions = pool.solve([(node, node_state(tree_nc, node), True, (), None,
+                             family) for node in nodes])
+    output['solves'] += len(nodes)
+    children = {}
+    for node, solution in zip(nodes, solutions):
+        count_solve(output, node, solution)
+        children.setdefault(node['prev_id'], []).append((node, solution))
+
+    new = 0
+    for prev_id, node_solutions in children.items():
+        prev_node = tree_nc.return_node(prev_id)
+        children_ids = [node['id'] for node, solution in node_solutions]
+        columns, gradients = cuts.stack_gradients(
+            [solution['columns'] for node, solution in node_solutions],
+            [solution['gradient'] for node, solution in node_solutions])
+        probabilities = cond_prob[[tree_nc.position[nodeid]
+                                   for nodeid in children_ids]]
+        values = np.array([solution['value']
+                           for node, solution in node_solutions])
+        groups = cuts.cut_groups(prev_node, children_ids, values,
+                                 gradients, cut_mode, cut_clusters)
+        x = cuts.state_vector(prev_node['variables'], columns)
+        cuts.compute_opt_cuts(prev_node, columns, probabilities, values,
+                              gradients, x, groups)
+        if family == 'integer':
+            # The Benders cuts of the relaxations of the children
+            benders = [solution.get('benders', solution)
+                       for node, solution in node_solutions]
+            cuts.compute_opt_cuts(
+                prev_node, columns, probabilities,
+                np.array([lin['value'] for lin in benders]),
+                cuts.stack_gradients(
+                    [solution['columns'] for node, solution in node_solutions],
+                    [lin['gradient'] for lin in benders])[1],
+                x, groups)
+
+        future = prev_node['variables'].get('Aux_Obj', {})
+        expected = {}
+        for g, p, value in zip(groups, probabilities, values):
+            expected[g] = expected.get(g, 0.0) + p * value
+        for g, value in expected.items():
+            if future.get(g) is None or \
+                    value - future[g] > tol * max(1.0, abs(value)):
+                new += 1
+    return new
+
+
+def feasibility_cuts(tree_nc, pool, infeasible, tol=1e-6, output=None,
+                     cut_family='benders'):
+    """Add to the parent of each infeasible node a feasibility cut.
+
+    Return:
+        :obj:`int`: number of cuts added. Nodes whose elastic problem has
+        optimal value 0 (their relaxation is feasible) do not get a cut,
+        unless their stage has a family of cuts other than 'benders' in
+        `cut_family`: their state (binary) is then removed by a no-good cut
+        (see :func:`ndusc.cuts.compute_nogood_cut`).
+    """
+    with instrument.span('feasibility'):
+        states = [node_state(tree_nc, node) for node in infeasible]
+        solutions = pool.feasibility(list(zip(infeasible, states)))
+        if output is not None:
+            output['solves'] += len(infeasible)
+        added = 0
+        for node, solution in zip(infeasible, solutions):
+            instrument.count('solves', node=node['id'])
+            prev_node = tree_nc.return_node(node['prev_id'])
+            if solution['infeasibility'] <= tol:
+                if cuts.stage_family(cut_family, node['stage']) == 'benders':
+                    continue
+                columns = solution['columns']
+                if cuts.compute_nogood_cut(
+                        prev_node, columns,
+                        cuts.state_vector(prev_node['variables'],
+                                          columns)) is not None:
+                    added += 1
+                continue
+            cuts.compute_feas_cuts(
+                prev_node, solution['infeasibility'], solution['columns'],
+                solution['gradient'],
+                cuts.state_vector(prev_node['variables'],
+                                  solution['columns']))
+            added += 1
+        return added
+
+
+def open_log(output_path, **info):
+    """Return the log of a run in `output_path` (directory or
+    :class:`ndusc.output_module.Output_module`), started with `info`. None
+    if `output_path` is None."""
+    if output_path is None:
+        return None
+    run_log = output_path
+    if not isinstance(run_log, output_module.Output_module):
+        run_log = output_module.Output_module(output_path)
+    run_log.start(**info)
+    return run_log
+
+
+def end_iteration(monitors, output, tree_nc):
+    """Tell the `monitors` (e.g. :class:`ndusc.output_module.
+    Output_module`, :class:`ndusc.checkpoint.Checkpoint`) of the end of the
+    last iteration of `output`, calling their method
+    ``iteration(output, tree_nc)``."""
+    for monitor in monitors:
+        monitor.iteration(output, tree_nc)
+
+
+def count_solve(output, node, solution):
+    """Count the model builds of the solve of `node` in `output`, and the
+    solve and builds in the instrumentation (see :mod:`ndusc.instrument`).
+    """
+    output['builds'] += solution['builds']
+    instrument.count('solves', node=node['id'])
+    if solution['builds']:
+        instrument.count('builds', solution['builds'], node['id'])
+
+
+def update_state_names(tree_nc, node, linking):
+    """Add the variables received by `node` to the state of its parent."""
+    prev_id = node.get('prev_id')
+    if prev_id is None:
+        return
+    prev_node = tree_nc.return_node(prev_id)
+    names = prev_node['state_names'] or ()
+    if prev_node['state_names'] is None or not set(linking) <= set(names):
+        prev_node['state_names'] = tuple(sorted(set(names) | set(linking)))
+
+
+def node_state(tree_nc, node):
+    """Return the state of `node`: the variables of its parent."""
+    prev_id = node.get('prev_id')
+    if prev_id is None:
+        return {}
+    return tree_nc.return_node(prev_id)['variables']
@@ -1,20 +1,376 @@
-class Ouput_module(Object):
-    path_output=""
-    kind_format=""
-    name_convergence_graph=""
+"""Convergence log and graphs of a run.
 
-    def __init__(self, path, format):
+The log is a JSON lines file: one record (a JSON object) per line, with
+its `event`:
+
+    - 'start': the start of the run, with the `time` (seconds since the
+      epoch) and the information given to :meth:`Output_module.start`.
+    - 'iteration': after each iteration, its `iteration`, `lower_bound`,
+      `upper_bound`, `gap` and `relative_gap` (null while a bound is
+      infinite), `time` of the iteration and `elapsed` time since the start
+      (seconds), the counters of the run (`solves`, `builds`,
+      `cuts_evicted`, `cuts_revived`), and the number of cuts in the pools
+      (`feas_cuts`, `opt_cuts`) and live (`live_cuts`).
+    - 'end': the `status` and final bounds.
+    - 'node': after the end, one per node of the tree: `id`, `prev_id`,
+      `stage`, `probability`, `value`, `cost` and number of cuts.
+
+The records are kept in a buffer of at most `buffer` lines, then written,
+flushed and synced to disk (fsync), so a run can be followed, and its log
+survives a crash, while it runs.
+
+The graphs are rendered from the log, reading it line by line, so the
+memory does not grow with the number of iterations or nodes:
+
+    - :meth:`Output_module.plot_convergence_graph`: the bounds per
+      iteration, as SVG.
+    - :meth:`Output_module.plot_tree_graph`: the tree with the value of each
+      node, in the DOT language of Graphviz (``dot -Tsvg tree.dot``).
+
+They can be rendered after the run, during it (from another process, or
+every `plot_every` iterations), or from a copied log.
+"""
+
+import json
+import math
+import os
+import time
+
+formats = ('svg',)
+
+
+class Output_module(object):
+    """Writer of the convergence log and graphs of a run.
+
+    Args:
+        path (:obj:`str`): output directory, created if needed.
+        format (:obj:`str`): format of the convergence graph (see
+            :data:`formats`).
+        buffer (:obj:`int`): maximum number of records kept before writing
+            them to disk.
+        fsync (:obj:`bool`): if True the log is synced to disk each time the
+            buffer is written.
+        plot_every (:obj:`int`): if given, the convergence graph is rendered
+            every `plot_every` iterations.
+
+    Example:
+        >>> output_module = Output_module('results')
+        >>> output = nd.nested_decomposition(tree_data, data,
+        ...                                  output_path=output_module)
+        >>> output_module.plot_convergence_graph()
+        >>> output_module.plot_tree_graph()
+    """
+
+    name_log = 'convergence.jsonl'
+    name_convergence_graph = 'convergence'
+    name_tree_graph = 'tree.dot'
+
+    def __init__(self, path, format='svg', buffer=1, fsync=True,
+                 plot_every=None):
+        if format not in formats:
+            raise ValueError('Unknown format: {}'.format(format))
         self.path_output = path
         self.kind_format = format
+        self.buffer = max(1, buffer)
+        self.fsync = fsync
+        self.plot_every = plot_every
+        self.path_log = os.path.join(path, self.name_log)
+        self._file = None
+        self._lines = []
+        self._start = None
+        self._last = None
+        self._logged = 0
+
+    # Log ---------------------------------------------------------------------
+    def start(self, **info):
+        """Start a new log (replacing the previous one), with `info` in its
+        start record."""
+        os.makedirs(self.path_output, exist_ok=True)
+        self.close()
+        self._lines = []
+        self._file = open(self.path_log, 'w')
+        self._start = self._last = time.time()
+        self._logged = 0
+        self._write(dict(info, event='start', time=self._start))
+        self.flush()
+
+    def iteration(self, output, tree_nc=None):
+        """Log the last iteration of `output` (the output dictionary of the
+        algorithm), with the cuts of the nodes of `tree_nc`.
+
+        Iterations already logged are skipped.
+        """
+        if output['iterations'] <= self._logged:
+            return
+        if self._start is None:
+            self.start()
+        now = time.time()
+        lower, upper = output['lower_bound'], output['upper_bound']
+        gap = upper - lower
+        record = {
+            'event': 'iteration',
+            'iteration': output['iterations'],
+            'lower_bound': _number(lower),
+            'upper_bound': _number(upper),
+            'gap': _number(gap),
+            'relative_gap': _number(gap / max(1.0, abs(upper))
+                                    if math.isfinite(gap) else gap),
+            'time': now - self._last,
+            'elapsed': now - self._start,
+        }
+        for key in ('solves', 'builds', 'cuts_evicted', 'cuts_revived'):
+            record[key] = output.get(key, 0)
+        if tree_nc is not None:
+            record.update(cut_counts(tree_nc))
+        self._last = now
+        self._logged = output['iterations']
+        self._write(record)
+        if self.plot_every and self._logged % self.plot_every == 0:
+            self.flush()
+            self.plot_convergence_graph()
+
+    def finish(self, output, tree_nc=None):
+        """Log the last iteration, the end of the run and the nodes of
+        `tree_nc`, and close the log."""
+        if self._start is None:
+            self.start()
+        self.iteration(output, tree_nc)
+        self._write({'event': 'end', 'status': output['status'],
+                     'iterations': output['iterations'],
+                     'lower_bound': _number(output['lower_bound']),
+                     'upper_bound': _number(output['upper_bound']),
+                     'elapsed': time.time() - self._start})
+        if tree_nc is not None:
+            for node in tree_nc.nodes:
+                self._write(node_record(node))
+        self.close()
+        if self.plot_every:
+            self.plot_convergence_graph()
+
+    def flush(self):
+        """Write the buffered records to disk."""
+        if not self._lines:
+            return
+        if self._file is None:
+            self._file = open(self.path_log, 'a')
+        self._file.write(''.join(self._lines))
+        self._lines = []
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """Write the buffered records and close the log. Later records
+        are appended to it."""
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def _write(self, record):
+        self._lines.append(json.dumps(record, default=str) + '\n')
+        if len(self._lines) >= self.buffer:
+            self.flush()
+
+    def records(self, event=None):
+        """Yield the records of the log (those of `event` if given), one at
+        a time."""
+        return read_log(self.path_log, event)
+
+    # Graphs ------------------------------------------------------------------
+    def plot_convergence_graph(self, path=None):
+        """Render the bounds of each iteration of the log as SVG.
+
+        The log is read three times (ranges, then each bound), keeping one
+        record in memory. The graph is written to a temporary file that
+        then replaces `path` (default: `name_convergence_graph` in the
+        output directory), so a viewer never sees a partial graph.
+
+        Return:
+            :obj:`str`: path of the graph.
+        """
+        if path is None:
+            path = os.path.join(self.path_output, '{}.{}'.format(
+                self.name_convergence_graph, self.kind_format))
+        ranges = _Ranges()
+        for record in self.records('iteration'):
+            ranges.add(record['iteration'],
+                       record['lower_bound'], record['upper_bound'])
+
+        width, height, margin = 640, 400, 60
+        with _replace(path) as graph:
+            graph.write(
+                '<svg xmlns="http://www.w3.org/2000/svg" width="{w}" '
+                'height="{h}" font-family="sans-serif" font-size="12">\n'
+                '<rect width="{w}" height="{h}" fill="white"/>\n'.format(
+                    w=width, h=height))
+            if not ranges.ready():
+                graph.write('<text x="{}" y="{}">No iterations</text>\n'
+                            '</svg>\n'.format(margin, height // 2))
+                return path
+
+            def x(iteration):
+                return margin + (width - 2 * margin) * (
+                    iteration - ranges.x[0]) / (ranges.x[1] - ranges.x[0])
+
+            def y(bound):
+                return height - margin - (height - 2 * margin) * (
+                    bound - ranges.y[0]) / (ranges.y[1] - ranges.y[0])
+
+            # Axes
+            graph.write(
+                '<path d="M{0},{1} V{2} H{3}" stroke="black" fill="none"/>\n'
+                .format(margin, margin, height - margin, width - margin))
+            for value in ranges.x:
+                graph.write('<text x="{:.1f}" y="{}" text-anchor="middle">'
+                            '{:g}</text>\n'.format(x(value),
+                                                   height - margin + 18,
+                                                   value))
+            for value in ranges.y:
+                graph.write('<text x="{}" y="{:.1f}" text-anchor="end">'
+                            '{:.6g}</text>\n'.format(margin - 6,
+                                                     y(value) + 4, value))
+            graph.write('<text x="{}" y="{}" text-anchor="middle">Iteration'
+                        '</text>\n'.format(width // 2, height - 15))
+
+            # Bounds
+            for key, color, legend in (('lower_bound', 'steelblue', 0),
+                                       ('upper_bound', 'firebrick', 1)):
+                graph.write('<polyline fill="none" stroke="{}" '
+                            'points="'.format(color))
+                for record in self.records('iteration'):
+                    if record[key] is not None:
+                        graph.write('{:.1f},{:.1f} '.format(
+                            x(record['iteration']), y(record[key])))
+                graph.write('"/>\n')
+                graph.write(
+                    '<text x="{}" y="{}" fill="{}">{}</text>\n'.format(
+                        width - margin - 100, margin - 25 + 15 * legend,
+                        color, key.replace('_', ' ')))
+            graph.write('</svg>\n')
+        return path
+
+    def plot_tree_graph(self, path=None):
+        """Write the tree of the log (its node records) as a Graphviz graph,
+        with the id, value and cost of each node.
+
+        Return:
+            :obj:`str`: path of the graph (default: `name_tree_graph` in the
+            output directory).
+        """
+        if path is None:
+            path = os.path.join(self.path_output, self.name_tree_graph)
+        with _replace(path) as graph:
+            graph.write('digraph tree {\n  rankdir=LR;\n'
+                        '  node [shape=box, fontsize=10];\n')
+            for record in self.records('node'):
+                label = 'node {}'.format(record['id'])
+                for key in ('value', 'cost'):
+                    if record.get(key) is not None:
+                        label += '\\n{} {:.6g}'.format(key, record[key])
+                graph.write('  {} [label="{}"];\n'.format(
+                    json.dumps(str(record['id'])), label))
+                if record.get('prev_id') is not None:
+                    graph.write('  {} -> {};\n'.format(
+                        json.dumps(str(record['prev_id'])),
+                        json.dumps(str(record['id']))))
+            graph.write('}\n')
+        return path
+
+
+# Kept for the code that used the original (misspelled) name
+Ouput_module = Output_module
+
+
+def read_log(path, event=None):
+    """Yield the records of the log `path` (those of `event` if given).
+
+    An incomplete last line (a log being written) is skipped.
+    """
+    with open(path) as log_file:
+        for line in log_file:
+            if not line.endswith('\n'):
+                break
+            record = json.loads(line)
+            if event is None or record.get('event') == event:
+                yield record
+
+
+def cut_counts(tree_nc):
+    """Return the number of cuts in the pools of the nodes of `tree_nc`
+    (`feas_cuts`, `opt_cuts`) and of live cuts (`live_cuts`). Pools shared
+    by several nodes are counted once."""
+    counts = {'feas_cuts': 0, 'opt_cuts': 0, 'live_cuts': 0}
+    seen = set()
+    for node in tree_nc.nodes:
+        for kind, pool in node.get('cut_pool', {}).items():
+            if id(pool) in seen:
+                continue
+            seen.add(id(pool))
+            counts[kind + '_cuts'] += len(pool)
+            counts['live_cuts'] += len(pool.live)
+    return counts
+
+
+def node_record(node):
+    """Return the log record of `node`."""
+    record = {'event': 'node'}
+    for key in ('id', 'prev_id', 'stage', 'probability'):
+        record[key] = node.get(key)
+    for key in ('value', 'cost'):
+        record[key] = _number(node.get(key))
+    record['cuts'] = sum(len(pool) for pool in
+                         node.get('cut_pool', {}).values())
+    return record
+
+
+def _number(value):
+    """`value` as a float, None if it is not a finite number."""
+    if value is None:
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+class _Ranges(object):
+    """Ranges of the iterations and bounds of a log."""
+
+    def __init__(self):
+        self.x = [math.inf, -math.inf]
+        self.y = [math.inf, -math.inf]
+
+    def add(self, iteration, *bounds):
+        self.x = [min(self.x[0], iteration), max(self.x[1], iteration)]
+        for bound in bounds:
+            if bound is not None:
+                self.y = [min(self.y[0], bound), max(self.y[1], bound)]
 
-    def plot_convergence_graph():
+    def ready(self):
+        """Return False if there is no point to draw. Otherwise widen the
+        ranges of zero length."""
+        if not math.isfinite(self.x[0]) or not math.isfinite(self.y[0]):
+            return False
+        if self.x[0] == self.x[1]:
+            self.x[1] += 1
+        if self.y[0] == self.y[1]:
+            self.y = [self.y[0] - 1, self.y[1] + 1]
+        return True
 
-    return
 
-//
-    def plot_tree_graph():
+class _replace(object):
+    """Open a temporary file that replaces `path` when closed."""
 
-    return
+    def __init__(self, path):
+        self.path = path
+        self.temporary = '{}.tmp{}'.format(path, os.getpid())
 
+    def __enter__(self):
+        self.file = open(self.temporary, 'w')
+        return self.file
 
-    pass
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.temporary, self.path)
+        else:
+            os.remove(self.temporary)
@@ -0,0 +1,602 @@
+"""Executors that solve the nodes of a stage.
+
+The nodes of a stage are independent given the solutions of their parents,
+so each forward and backward step sends the problems of a whole stage to an
+executor:
+
+    - `serial`: solves them one after another in this process.
+    - `threads`: solves them in a pool of threads sharing the models (a
+      shared model busy in a thread is copied for the others, see
+      :meth:`ndusc.model.Persistent_models.acquire`). Pyomo
+      redirects the output streams of the process while an in-process
+      solver (``appsi_*``, ``*_direct``, ``*_persistent``, ``highs``) runs,
+      so those solves are serialized; use `processes` with them.
+    - `processes`: solves them in worker processes. Each node is assigned to
+      one worker for the whole run, so the worker keeps its model alive
+      between iterations.
+
+All the executors return the results in the order of the tasks, so the cuts
+and bounds computed from them do not depend on the number of workers.
+"""
+
+import contextlib
+import logging as log
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+
+from ndusc import cuts
+from ndusc import format_sol
+from ndusc import instrument
+from ndusc import model
+from ndusc import stabilization
+
+
+class Node_solver(object):
+    """Solves the problems of the nodes, keeping their models.
+
+    The lower bounds of the values of the nodes used by the integer L-shaped
+    cuts are kept in `bounds` (node id -> bound).
+
+    Args:
+        data (:obj:`dict`): dictionary with problem data.
+        solver (:obj:`str`): solver name.
+        persistent (:obj:`bool`): see :class:`ndusc.model.Persistent_models`.
+        lock (:obj:`threading.Lock`): if given, held while the solver runs.
+        shared, nodes, hot_start, backend: see
+            :class:`ndusc.model.Persistent_models`.
+    """
+
+    # Maximum number of solves of the Lagrangian relaxation of a node for a
+    # Lagrangian cut
+    lagrangian_iterations = 20
+
+    def __init__(self, data, solver='gurobi', persistent=True, lock=None,
+                 shared=True, nodes=None, hot_start=False, backend='pyomo'):
+        self.models = model.Persistent_models(data, solver, persistent, shared,
+                                              nodes, hot_start, backend)
+        self.lock = lock
+        self.bounds = {}
+
+    def solve(self, node, state, duals, names=None, stabilize=None,
+              family=None):
+        """Solve the problem of `node` given the `state` of its parent.
+
+        Args:
+            names (:obj:`tuple`): state variables of `node` to extract (see
+                :class:`ndusc.format_sol.Extraction_plan`). If None the full
+                solution is extracted.
+            stabilize (:obj:`dict`): stabilization of the solve, see
+                :meth:`ndusc.stabilization.Stabilizer.settings`. The `value`
+                is then that of the objective without stabilization.
+            family (:obj:`str`): with `duals`, family of the cut computed
+                from the solve (see :func:`ndusc.cuts.stage_family`,
+                default 'benders'). The `value` and `gradient` are those of
+                the cut at the state (see :meth:`_cut`).
+
+        Return:
+            :obj:`dict`: `results` (None if the problem is not optimal),
+            `value` (objective value), `cost` (value without the future cost),
+            if `duals` the `gradient` of the value with respect to the state
+            `columns`, the names of the variables of the parent it receives
+            (`linking`) and the number of model `builds`.
+        """
+        with instrument.span('node solve', node['id'], duals=duals):
+            return self._solve(node, state, duals, names, stabilize, family)
+
+    def _solve(self, node, state, duals, names, stabilize, family):
+        template, built = self.models.template(node, state)
+        if duals and not template.technology.linear:
+            names = None
+        with self.models.acquire(node, template, state) as template:
+            solver_results, problem_results = self.models.solve(
+                node, state, duals, self.lock, template, names, stabilize)
+            output = {'results': problem_results, 'builds': int(built),
+                      'linking': tuple(template.params)}
+            if problem_results is None:
+                return output
+            problem = template.problem
+            if stabilize is None:
+                output['value'] = objective_value(problem_results)
+            else:
+                output['value'] = stabilization.model_value(problem)
+            output['cost'] = output['value'] - (
+                problem_results['future_cost'] if 'future_cost' in
+                problem_results else cuts.future_cost(problem))
+            if duals:
+                output['columns'] = template.technology.columns
+                output['gradient'] = _gradient(
+                    template.technology, problem, template.params,
+                    problem_results.get('duals'))
+                if family not in (None, 'benders'):
+                    output.update(self._cut(node, state, template, family,
+                                            output))
+        return output
+
+    def _cut(self, node, state, template, family, output):
+        """Return the `value` at the state and the `gradient` of the cut of
+        family `family` (other than 'benders') of `node`, whose relaxation
+        has been solved with duals (Benders cut in `output`).
+
+        The integer L-shaped cuts come with the Benders cut, returned as
+        `benders` (value and gradient), as they only cut off the state.
+        """
+        with instrument.span('node cut', node['id'], family=family):
+            x = cuts.binary_state(cuts.state_vector(
+                state, template.technology.columns))
+            # The Lagrangian relaxations are cloned from the Pyomo model
+            cuts.create_cuts(template.problem, node)
+            benders = {'value': output['value'],
+                       'gradient': output['gradient']}
+            target = None
+            if family in ('integer', 'lagrangian'):
+                # Value of the problem, not of its relaxation
+                solver_results, problem_results = self.models.solve(
+                    node, state, False, self.lock, template, ())
+                if problem_results is not None:
+                    target = dual_bound(solver_results,
+                                        objective_value(problem_results))
+            if family == 'integer':
+                if target is None:
+                    return benders
+                return {'value': target,
+                        'gradient': cuts.integer_gradient(
+                            target, self._recourse_bound(node, template), x),
+                        'benders': benders}
+
+            lagrangian = cuts.lagrangian_problem(template.problem,
+                                                 template.params)
+            cut = self._lagrangian_cut(lagrangian, output['gradient'], x,
+                                       target)
+            if cut is None:
+                log.warning('Node {}: Lagrangian relaxation not solved, '
+                            'Benders cut used'.format(node['id']))
+                return benders
+            return {'value': cut[0], 'gradient': cut[1]}
+
+    def _lagrangian_cut(self, lagrangian, multipliers, x, target=None):
+        """Return the best cut (value at `x` and gradient) of the
+        `lagrangian` problem (see :func:`ndusc.cuts.lagrangian_problem`)
+        from the `multipliers`.
+
+        If the `target` value is given the multipliers are improved by
+        subgradient steps (with Polyak step lengths towards `target`), at
+        most :attr:`lagrangian_iterations` solves. None if the first solve
+        fails.
+        """
+        opt = model.pyenv.SolverFactory(self.models.solver)
+        best, step = None, 1.0
+        for iteration in range(self.lagrangian_iterations):
+            lagrangian._Multiplier.store_values(dict(enumerate(multipliers)))
+            with self.lock or contextlib.nullcontext():
+                solver_results, problem_results = model.solve(
+                    lagrangian, self.models.solver, duals=False, opt=opt)
+            if problem_results is None:
+                break
+            value = dual_bound(solver_results,
+                               objective_value(problem_results)) + \
+                float(multipliers @ x)
+            if best is None or value > best[0]:
+                best = (value, multipliers)
+            else:
+                step /= 2
+            if target is None or \
+                    target - best[0] <= 1e-6 * max(1.0, abs(target)):
+                break
+            copies = np.array([v.value for v in lagrangian._Copy.values()])
+            subgradient = x - np.round(copies)
+            norm = float(subgradient @ subgradient)
+            if not norm:
+                break
+            multipliers = multipliers + \
+                step * (target - value) / norm * subgradient
+        return best
+
+    def _recourse_bound(self, node, template):
+        """Return a lower bound of the value of the problem of `node` at
+        any binary state: the optimal value of its Lagrangian relaxation
+        with null multipliers (see :func:`ndusc.cuts.lagrangian_problem`).
+
+        The bound is computed once, as the cuts added later to the node
+        only raise its value.
+
+        Raises:
+            RuntimeError: if the relaxation is not solved.
+        """
+        bound = self.bounds.get(node['id'])
+        if bound is None:
+            lagrangian = cuts.lagrangian_problem(template.problem,
+                                                 template.params)
+            cut = self._lagrangian_cut(lagrangian,
+                                       np.zeros(len(lagrangian._Copy)),
+                                       np.zeros(len(lagrangian._Copy)))
+            if cut is None:
+                raise RuntimeError('Lower bound of node {} not found'.format(
+                    node['id']))
+            bound = self.bounds[node['id']] = cut[0]
+        return bound
+
+    def feasibility(self, node, state, duals=True):
+        """Solve the elastic problem of the (infeasible) `node`.
+
+        Return:
+            :obj:`dict`: `infeasibility` (optimal value of the elastic
+            problem) and its `gradient` with respect to the state `columns`.
+        """
+        with instrument.span('node feasibility', node['id']):
+            return self._feasibility(node, state)
+
+    def _feasibility(self, node, state):
+        template, built = self.models.template(node, state)
+        with self.models.acquire(node, template, state) as template:
+            problem = self.models.problem(node, state, template)
+            cuts.create_cuts(problem, node)
+            elastic = cuts.elastic_problem(problem)
+        params = model.linking_params(elastic, state,
+                                      node['model'].get('linking'))
+        technology = cuts.Technology(elastic, params)
+        plan = None
+        if technology.linear:
+            plan = format_sol.Extraction_plan(elastic, (), technology.rows)
+        with self.lock or contextlib.nullcontext():
+            solver_results, problem_results = model.solve(
+                elastic, self.models.solver, duals=True, plan=plan)
+        if problem_results is None:
+            raise RuntimeError('Elastic problem of node {} not solved'.format(
+                node['id']))
+        return {'infeasibility': objective_value(problem_results),
+                'columns': technology.columns,
+                'gradient': _gradient(technology, elastic, params,
+                                      problem_results.get('duals'))}
+
+
+class Serial_executor(object):
+    """Solves the tasks one after another in this process.
+
+    Args:
+        tree_nc (:obj:`ndusc.tree.Tree`): scenario tree.
+        data (:obj:`dict`): dictionary with problem data.
+        solver (:obj:`str`): solver name.
+        persistent (:obj:`bool`): see :class:`ndusc.model.Persistent_models`.
+        workers (:obj:`int`): number of workers (ignored).
+        shared, hot_start (:obj:`bool`): see
+            :class:`ndusc.model.Persistent_models`.
+        backend (:obj:`str`): see :class:`ndusc.model.Persistent_models`.
+    """
+
+    def __init__(self, tree_nc, data, solver='gurobi', persistent=True,
+                 workers=None, shared=True, hot_start=False, backend='pyomo'):
+        self.node_solver = Node_solver(
+            data, solver, persistent, shared=shared,
+            nodes={node['id']: node for node in tree_nc.nodes},
+            hot_start=hot_start, backend=backend)
+        self.workers = 1
+
+    def solve(self, tasks):
+        """Solve the problems of the nodes.
+
+        Args:
+            tasks (:obj:`list`): ``(node, state, duals, names)`` tuples.
+
+        Return:
+            :obj:`list`: output of :meth:`Node_solver.solve` for each task.
+        """
+        return self._map('solve', tasks)
+
+    def feasibility(self, tasks):
+        """Solve the elastic problems of infeasible nodes.
+
+        Args:
+            tasks (:obj:`list`): ``(node, state)`` tuples.
+
+        Return:
+            :obj:`list`: output of :meth:`Node_solver.feasibility` for each
+            task.
+        """
+        return self._map('feasibility', [(n, s, True) for n, s in tasks])
+
+    def submit(self, kind, task):
+        """Solve one task ('solve' or 'feasibility').
+
+        Return:
+            :obj:`concurrent.futures.Future`: future of its output (done
+            when it returns, for the serial executor).
+        """
+        future = Future()
+        try:
+            future.set_result(getattr(self.node_solver, kind)(*task))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def close(self):
+        pass
+
+    def _map(self, kind, tasks):
+        function = getattr(self.node_solver, kind)
+        return [function(*task) for task in tasks]
+
+
+class Thread_executor(Serial_executor):
+    """Solves the tasks in a pool of threads sharing the node models."""
+
+    def __init__(self, tree_nc, data, solver='gurobi', persistent=True,
+                 workers=None, shared=True, hot_start=False, backend='pyomo'):
+        super(Thread_executor, self).__init__(tree_nc, data, solver,
+                                              persistent, shared=shared,
+                                              hot_start=hot_start,
+                                              backend=backend)
+        if in_process(solver):
+            self.node_solver.lock = threading.Lock()
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def submit(self, kind, task):
+        """See :meth:`Serial_executor.submit`."""
+        return self.pool.submit(getattr(self.node_solver, kind), *task)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def _map(self, kind, tasks):
+        function = getattr(self.node_solver, kind)
+        return list(self.pool.map(lambda task: function(*task), tasks))
+
+
+class Process_executor(object):
+    """Solves the tasks in worker processes.
+
+    The nodes are assigned to the workers round robin, in the order of the
+    tree, and each worker keeps the models of its nodes. The changes of the
+    live cuts of a node (cuts added and evicted) are sent to its worker with
+    its next task.
+    """
+
+    def __init__(self, tree_nc, data, solver='gurobi', persistent=True,
+                 workers=None, shared=True, hot_start=False, backend='pyomo',
+                 context=None):
+        workers = workers or os.cpu_count()
+        self.workers = workers
+        context = multiprocessing.get_context(context)
+        self.assignment = {}
+        self.sent = {}
+        nodes = [[] for k in range(workers)]
+        ancestors = [{} for k in range(workers)]
+        for k, node in enumerate(tree_nc.nodes):
+            self.assignment[node['id']] = k % workers
+            self.sent[node['id']] = {'feas': set(), 'opt': set()}
+            nodes[k % workers].append(_static_node(node))
+            for nodeid in tree_nc.return_ancestors(node['id'])[:-1]:
+                ancestors[k % workers][nodeid] = _data_node(
+                    tree_nc.return_node(nodeid))
+
+        self.connections = []
+        self.processes = []
+        for k in range(workers):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(child_conn, nodes[k], ancestors[k], data, solver,
+                      persistent, shared, hot_start, backend),
+                daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(conn)
+            self.processes.append(process)
+        self.locks = [threading.Lock() for k in range(workers)]
+        self.dispatcher = None
+        log.info('Started {} worker processes'.format(workers))
+
+    def solve(self, tasks):
+        """See :meth:`Serial_executor.solve`."""
+        return self._map('solve', tasks)
+
+    def feasibility(self, tasks):
+        """See :meth:`Serial_executor.feasibility`."""
+        return self._map('feasibility', [(n, s, True) for n, s in tasks])
+
+    def submit(self, kind, task):
+        """See :meth:`Serial_executor.submit`.
+
+        The task is sent to the worker of its node from a dispatcher thread,
+        so tasks of different workers run at the same time.
+        """
+        if self.dispatcher is None:
+            self.dispatcher = ThreadPoolExecutor(
+                max_workers=len(self.connections))
+        node, args = task[0], task[1:]
+        k = self.assignment[node['id']]
+        batch = [(node['id'], args, self._new_cuts(node))]
+        return self.dispatcher.submit(self._call, k, kind, batch)
+
+    def close(self):
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        for conn in self.connections:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+    def _call(self, k, kind, batch):
+        with self.locks[k]:
+            start = time.perf_counter()
+            _send(self.connections[k], (kind, batch))
+            status, results = _recv(self.connections[k])
+            instrument.record('worker', start, time.perf_counter(),
+                              'worker {}'.format(k), batch[0][0])
+        if status == 'error':
+            raise RuntimeError('Worker {} failed:\n{}'.format(k, results))
+        return results[0]
+
+    def _map(self, kind, tasks):
+        batches = [[] for conn in self.connections]
+        positions = [[] for conn in self.connections]
+        for position, (node, *args) in enumerate(tasks):
+            k = self.assignment[node['id']]
+            batches[k].append((node['id'], args, self._new_cuts(node)))
+            positions[k].append(position)
+
+        start = time.perf_counter()
+        for k, batch in enumerate(batches):
+            if batch:
+                _send(self.connections[k], (kind, batch))
+
+        # The replies of all the workers are read before raising an error,
+        # so none is left in the pipes for the next call
+        output = [None] * len(tasks)
+        errors = []
+        for k, batch in enumerate(batches):
+            if not batch:
+                continue
+            status, results = _recv(self.connections[k])
+            instrument.record('worker', start, time.perf_counter(),
+                              'worker {}'.format(k), tasks=len(batch))
+            if status == 'error':
+                errors.append('Worker {} failed:\n{}'.format(k, results))
+                continue
+            for position, result in zip(positions[k], results):
+                output[position] = result
+        if errors:
+            raise RuntimeError('\n'.join(errors))
+        return output
+
+    def _new_cuts(self, node):
+        new_cuts = {}
+        for kind, live in node.get('cuts', {}).items():
+            sent = self.sent[node['id']][kind]
+            added = {cid: cut for cid, cut in live.items() if cid not in sent}
+            removed = [cid for cid in sent if cid not in live]
+            if added or removed:
+                new_cuts[kind] = (added, removed)
+                sent.update(added)
+                sent.difference_update(removed)
+        return new_cuts
+
+
+executors = {
+    'serial': Serial_executor,
+    'threads': Thread_executor,
+    'processes': Process_executor,
+}
+
+
+def create_executor(executor, tree_nc, data, solver='gurobi', persistent=True,
+                    workers=None, shared=True, hot_start=False,
+                    backend='pyomo'):
+    """Return the executor called `executor` (see `executors`, and
+    :class:`ndusc.distributed.Distributed_executor` for 'distributed')."""
+    if executor == 'distributed':
+        # Imported here as the workers of ndusc.distributed use this module
+        from ndusc import distributed
+        return distributed.Distributed_executor(tree_nc, data, solver,
+                                                persistent, workers, shared,
+                                                hot_start, backend)
+    if executor not in executors:
+        raise ValueError('Unknown executor: {}'.format(executor))
+    return executors[executor](tree_nc, data, solver, persistent, workers,
+                               shared, hot_start, backend)
+
+
+def in_process(solver):
+    """Return True if `solver` runs inside the python process."""
+    return (solver.startswith('appsi_') or solver == 'highs'
+            or solver.endswith('_direct') or solver.endswith('_persistent'))
+
+
+def objective_value(problem_results):
+    """Return the value of the (active) objective function."""
+    for objective in problem_results['objective'].values():
+        return objective['value']
+
+
+def dual_bound(solver_results, value):
+    """Return the lower bound of the optimal value given by the solver (of
+    a problem with integer variables solved within a gap), `value` if
+    there is none."""
+    try:
+        bound = float(solver_results['Problem'][0]['Lower bound'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return value
+    return bound if np.isfinite(bound) and bound <= value else value
+
+
+def _gradient(technology, problem, params, duals=None):
+    with instrument.span('gradient'):
+        if technology.linear:
+            return technology.gradient(problem, duals)
+        gradient = cuts.state_gradient(problem, params)
+        return np.array([gradient[key] for key in technology.columns])
+
+
+def _send(conn, message):
+    """Send `message` through the pipe `conn`, counting its size."""
+    data = ForkingPickler.dumps(message)
+    conn.send_bytes(data)
+    instrument.count('bytes_sent', len(data))
+
+
+def _recv(conn):
+    """Receive a message from the pipe `conn`, counting its size."""
+    data = conn.recv_bytes()
+    instrument.count('bytes_received', len(data))
+    return ForkingPickler.loads(data)
+
+
+def _static_node(node):
+    """Copy of the information of the node given by the tree."""
+    return {key: value for key, value in node.items()
+            if key not in ('cuts', 'cut_pool')}
+
+
+def _data_node(node):
+    """Copy of the information of the node needed by its descendants."""
+    return {key: node[key] for key in ('id', 'prev_id', 'params', 'sets')
+            if key in node}
+
+
+def _apply_cuts(nodes, batch):
+    """Apply to the live cuts of `nodes` the changes of the tasks of
+    `batch` (``(node id, args, new cuts)``, see
+    :meth:`Process_executor._new_cuts`).
+
+    The changes of the whole batch are applied before any of its tasks is
+    solved: the executor counts them as sent, so they must be there even if
+    a task fails.
+    """
+    for nodeid, args, new_cuts in batch:
+        node = nodes[nodeid]
+        for kind, (added, removed) in new_cuts.items():
+            live = node.setdefault('cuts', {}).setdefault(kind, {})
+            live.update(added)
+            for cid in removed:
+                del live[cid]
+
+
+def _worker(conn, nodes, ancestors, data, solver, persistent, shared,
+            hot_start, backend):
+    nodes = {node['id']: node for node in nodes}
+    ancestors.update(nodes)
+    node_solver = Node_solver(data, solver, persistent, shared=shared,
+                              nodes=ancestors, hot_start=hot_start,
+                              backend=backend)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        kind, batch = message
+        try:
+            function = getattr(node_solver, kind)
+            _apply_cuts(nodes, batch)
+            results = [function(nodes[nodeid], *args)
+                       for nodeid, args, new_cuts in batch]
+            conn.send(('ok', results))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
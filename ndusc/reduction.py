@@ -0,0 +1,332 @@
+"""Scenario tree reduction.
+
+A scenario is the path from the root to a leaf of the tree. It is described
+by the numeric parameters of the nodes of the path (the `params` of each
+node that are numbers, or dictionaries of numbers), and the distance between
+two scenarios is the norm of the difference of their parameters, each
+parameter scaled by its standard deviation over the scenarios.
+
+The reduction keeps a subset of the scenarios and gives the probability of
+each deleted scenario to the closest kept one (the optimal redistribution),
+see Heitsch & Römisch (2003), Scenario reduction algorithms in stochastic
+programming. Its distance (the Kantorovich distance between the
+distributions of the scenarios) is the sum over the deleted scenarios of
+their probability times the distance to their closest kept scenario. Two
+methods choose the kept scenarios:
+
+    - `forward` (fast forward selection): starts from no scenario and adds
+      the scenario that most reduces the distance.
+    - `backward` (backward reduction): starts from all the scenarios and
+      deletes the scenario whose deletion least increases the distance (its
+      probability times the distance to its closest kept scenario).
+
+The reduced tree has the nodes of the paths of the kept scenarios, with the
+probabilities of their kept scenarios, so it is a subtree of the original
+one and can be solved as it.
+
+The distances between all the scenarios are computed, so the memory is
+quadratic in the number of scenarios.
+"""
+
+import argparse
+import numbers
+
+import numpy as np
+import yaml
+from scipy.spatial.distance import cdist
+
+from ndusc import tree
+
+methods = ('forward', 'backward')
+
+
+def reduce_tree(tree_nc, method='forward', scenarios=None, nodes=None,
+                tolerance=None, params=None, norm=2, scale=True):
+    """Reduce the scenarios of a tree.
+
+    The reduction stops at the first target reached. At least one of
+    `scenarios`, `nodes` and `tolerance` must be given.
+
+    Args:
+        tree_nc (:obj:`ndusc.tree.Tree`): scenario tree.
+        method (:obj:`str`): 'forward' or 'backward' (see :data:`methods`).
+        scenarios (:obj:`int`): number of scenarios to keep.
+        nodes (:obj:`int`): maximum number of nodes of the reduced tree.
+        tolerance (:obj:`float`): maximum distance of the reduction,
+            relative to the distance of the best tree with one scenario.
+        params (:obj:`list`): names of the parameters of the distance
+            (default: all the numeric parameters).
+        norm (:obj:`float`): order of the norm of the distance.
+        scale (:obj:`bool`): if True each parameter is divided by its
+            standard deviation over the scenarios.
+
+    Return:
+        :obj:`dict`: `tree` (:obj:`ndusc.tree.Tree`) and `tree_data` (its
+        nodes, as loaded from a tree file) of the reduced tree, ids of the
+        leaves of the kept `scenarios`, `distance` of the reduction and
+        `relative_distance` (relative to the best tree with one scenario).
+    """
+    if method not in methods:
+        raise ValueError('Unknown reduction method: {}'.format(method))
+    if scenarios is None and nodes is None and tolerance is None:
+        raise ValueError('Give the number of scenarios or nodes, or the '
+                         'tolerance of the reduction')
+
+    leaves, paths = scenario_paths(tree_nc)
+    probability = tree_nc.probability[[tree_nc.position[leaf]
+                                       for leaf in leaves]]
+    features = scenario_features(tree_nc, paths, params, scale)
+    distances = cdist(features, features, 'minkowski', p=norm)
+    single = float((probability @ distances).min())
+    limit = None if tolerance is None else tolerance * single
+
+    target = Path_counter(paths, len(tree_nc.nodes), nodes)
+    if method == 'forward':
+        kept = forward_selection(distances, probability, scenarios, limit,
+                                 target)
+    else:
+        kept = backward_reduction(distances, probability, scenarios, limit,
+                                  target)
+
+    # Redistribution of the probability of the deleted scenarios
+    kept = np.array(sorted(kept))
+    closest = kept[distances[:, kept].argmin(axis=1)]
+    # A kept scenario keeps its probability, even at distance 0 of another
+    closest[kept] = kept
+    new_probability = np.bincount(closest, weights=probability,
+                                  minlength=len(leaves))
+    distance = float(probability @ distances[np.arange(len(leaves)),
+                                             closest])
+
+    tree_data = subtree(tree_nc, [leaves[k] for k in kept],
+                        new_probability[kept])
+    return {'tree': tree.Tree(tree_data),
+            'tree_data': tree_data,
+            'scenarios': [leaves[k] for k in kept],
+            'distance': distance,
+            'relative_distance': distance / single if single else 0.0}
+
+
+def forward_selection(distances, probability, scenarios=None, limit=None,
+                      target=None):
+    """Fast forward selection.
+
+    Args:
+        distances (:obj:`numpy.ndarray`): distances between the scenarios.
+        probability (:obj:`numpy.ndarray`): probability of each scenario.
+        scenarios (:obj:`int`): maximum number of scenarios selected.
+        limit (:obj:`float`): the selection stops once the distance of the
+            reduction is below `limit`.
+        target (:obj:`Path_counter`): nodes of the selected scenarios.
+
+    Return:
+        :obj:`list`: positions of the selected scenarios.
+    """
+    n = len(probability)
+    scenarios = n if scenarios is None else min(scenarios, n)
+    closest = distances.copy()
+    remaining = np.ones(n, dtype=bool)
+    selected = []
+    while len(selected) < scenarios:
+        weights = np.where(remaining, probability, 0.0)
+        z = weights @ closest
+        z[~remaining] = np.inf
+        u = int(z.argmin())
+        if selected and target is not None and not target.fits(u):
+            break
+        selected.append(u)
+        remaining[u] = False
+        if target is not None:
+            target.add(u)
+        # Distance of each scenario to the closest selected one
+        closest = np.minimum(closest, closest[:, [u]])
+        if limit is not None and z[u] <= limit:
+            break
+    return selected
+
+
+def backward_reduction(distances, probability, scenarios=None, limit=None,
+                       target=None):
+    """Backward reduction.
+
+    The probability of each deleted scenario is moved to its closest kept
+    scenario, and the distance of the reduction is bounded by the sum of
+    the moved probabilities times the distances they are moved.
+
+    Args:
+        distances, probability, target: see :func:`forward_selection`.
+        scenarios (:obj:`int`): minimum number of scenarios kept.
+        limit (:obj:`float`): maximum distance of the reduction.
+
+    Return:
+        :obj:`list`: positions of the kept scenarios.
+    """
+    n = len(probability)
+    scenarios = 1 if scenarios is None else max(scenarios, 1)
+    kept = np.ones(n, dtype=bool)
+    mass = np.array(probability, dtype=np.float64)
+    others = distances + np.diag(np.full(n, np.inf))
+    nearest = others.argmin(axis=1)
+    distance = 0.0
+    count = n
+    while count > scenarios and (target is None or not target.done()):
+        cost = np.where(kept, mass * others[np.arange(n), nearest], np.inf)
+        d = int(cost.argmin())
+        if limit is not None and distance + cost[d] > limit:
+            break
+        distance += cost[d]
+        kept[d] = False
+        count -= 1
+        mass[nearest[d]] += mass[d]
+        if target is not None:
+            target.remove(d)
+        others[:, d] = np.inf
+        for k in np.flatnonzero(kept & (nearest == d)):
+            nearest[k] = others[k].argmin()
+    return list(np.flatnonzero(kept))
+
+
+class Path_counter(object):
+    """Number of nodes of the tree of a set of scenarios.
+
+    Args:
+        paths (:obj:`list`): positions of the nodes of each scenario.
+        size (:obj:`int`): number of nodes of the tree.
+        nodes (:obj:`int`): target number of nodes.
+    """
+
+    def __init__(self, paths, size, nodes=None):
+        self.paths = paths
+        self.nodes = nodes
+        self.count = np.zeros(size, dtype=np.int64)
+        for path in paths:
+            self.count[path] += 1
+        self.total = int((self.count > 0).sum())
+        self.added = np.zeros(size, dtype=bool)
+        self.total_added = 0
+
+    def fits(self, k):
+        """True if adding the scenario `k` keeps the target (forward)."""
+        if self.nodes is None:
+            return True
+        new = int((~self.added[self.paths[k]]).sum())
+        return self.total_added + new <= self.nodes
+
+    def add(self, k):
+        path = self.paths[k]
+        self.total_added += int((~self.added[path]).sum())
+        self.added[path] = True
+
+    def remove(self, k):
+        path = self.paths[k]
+        self.count[path] -= 1
+        self.total -= int((self.count[path] == 0).sum())
+
+    def done(self):
+        """True if the target is reached (backward)."""
+        return self.nodes is not None and self.total <= self.nodes
+
+
+def scenario_paths(tree_nc):
+    """Return the ids of the leaves and the positions of the nodes of the
+    path from the root to each one."""
+    is_parent = np.zeros(len(tree_nc.nodes), dtype=bool)
+    is_parent[tree_nc.parent[tree_nc.parent >= 0]] = True
+    leaves = []
+    paths = []
+    for k in np.flatnonzero(~is_parent):
+        leaves.append(tree_nc.nodes[k]['id'])
+        path = []
+        while k >= 0:
+            path.append(k)
+            k = tree_nc.parent[k]
+        paths.append(np.array(path[::-1]))
+    return leaves, paths
+
+
+def scenario_features(tree_nc, paths, params=None, scale=True):
+    """Return the matrix of the parameters of the scenarios (rows).
+
+    The columns are the numeric parameters (and their indices) of the node
+    at each depth of the paths. Missing parameters are 0.
+    """
+    columns = {}
+    rows = []
+    for path in paths:
+        row = {}
+        for depth, k in enumerate(path):
+            for name, value in (tree_nc.nodes[k].get('params') or {}).items():
+                if params is not None and name not in params:
+                    continue
+                if isinstance(value, dict):
+                    items = value.items()
+                else:
+                    items = [(None, value)]
+                for index, v in items:
+                    if isinstance(v, numbers.Real) and \
+                            not isinstance(v, bool):
+                        key = (depth, name, index)
+                        row[columns.setdefault(key, len(columns))] = v
+        rows.append(row)
+    features = np.zeros((len(paths), len(columns)))
+    for r, row in enumerate(rows):
+        features[r, list(row)] = list(row.values())
+    if scale and len(columns):
+        std = features.std(axis=0)
+        features[:, std > 0] /= std[std > 0]
+    return features
+
+
+def subtree(tree_nc, leaves, probabilities):
+    """Return the tree data of the paths to `leaves`.
+
+    Args:
+        leaves (:obj:`list`): ids of the leaves kept.
+        probabilities (:obj:`list`): new probability of each leaf.
+
+    Return:
+        :obj:`dict`: tree information (``{'nodes': [...]}``), with the nodes
+        in their original order and the probabilities of the kept leaves.
+    """
+    probability = np.zeros(len(tree_nc.nodes))
+    for leaf, p in zip(leaves, probabilities):
+        k = tree_nc.position[leaf]
+        while k >= 0:
+            probability[k] += p
+            k = tree_nc.parent[k]
+    nodes = []
+    for k, node in enumerate(tree_nc.nodes):
+        if probability[k] > 0:
+            node = {key: value for key, value in node.items()
+                    if key not in ('cuts', 'cut_pool')}
+            node['probability'] = float(probability[k])
+            nodes.append(node)
+    return {'nodes': nodes}
+
+
+def write_yaml(tree_data, path):
+    """Write the tree information `tree_data` to the YAML file `path`."""
+    with open(path, 'w') as tree_file:
+        yaml.safe_dump({'nodes': [dict(node) for node in tree_data['nodes']]},
+                       tree_file, default_flow_style=False, sort_keys=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce a scenario tree.')
+    parser.add_argument('tree', help='tree file')
+    parser.add_argument('output', help='reduced tree file')
+    parser.add_argument('--method', choices=methods, default='forward')
+    parser.add_argument('--scenarios', type=int)
+    parser.add_argument('--nodes', type=int)
+    parser.add_argument('--tolerance', type=float)
+    parser.add_argument('--params', nargs='*',
+                        help='parameters of the distance')
+    args = parser.parse_args()
+    with open(args.tree) as tree_file:
+        tree_data = yaml.safe_load(tree_file)
+    result = reduce_tree(tree.Tree(tree_data), args.method, args.scenarios,
+                         args.nodes, args.tolerance, args.params)
+    write_yaml(result['tree_data'], args.output)
+    print('{} scenarios, {} nodes, relative distance {:.4g}'.format(
+        len(result['scenarios']), len(result['tree_data']['nodes']),
+        result['relative_distance']))
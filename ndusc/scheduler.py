@@ -0,0 +1,366 @@
+"""Asynchronous nested decomposition.
+
+The stage by stage sweep of :func:`ndusc.nd.nested_decomposition` waits
+for the slowest node of each stage. The asynchronous scheduler instead
+turns every node into tasks that are sent to the executor as soon as they
+can run:
+
+    - `forward`: solve the node at the last trial solution of its parent.
+      It runs whenever its parent gets a new trial solution or the node gets
+      new cuts.
+    - `backward`: solve the node with duals, at the last trial solution of
+      its parent, to get a linearization of its value for the cuts of its
+      parent. It runs after each forward solve of the node.
+    - `feasibility`: solve the elastic problem of an infeasible node.
+
+The cuts of a parent are built as soon as all the children of a cut group
+(see :func:`ndusc.cuts.cut_groups`) have a linearization and at least one
+of them is new. A linearization computed at an older trial solution of the
+parent is still a valid cut; `staleness` bounds how many trial solutions
+old it may be. The cuts of a node are only changed while it is not being
+solved.
+
+The lower bound is the value of the root once it has cuts of all its
+groups. The upper bound is the expected cost of the trial solutions when
+they are consistent: every node has been solved at the current trial
+solution of its parent.
+"""
+
+import asyncio
+import collections
+import logging as log
+
+import numpy as np
+
+from ndusc import cuts
+from ndusc import instrument
+from ndusc import nd
+
+
+class Async_scheduler(object):
+    """Scheduler of the tasks of the nodes.
+
+    Args:
+        tree_nc (:obj:`ndusc.tree.Tree`): scenario tree, with the cut pools
+            of the nodes.
+        pool: executor (see :mod:`ndusc.parallel`).
+        output (:obj:`dict`): output of
+            :func:`ndusc.nd.nested_decomposition`, updated in place.
+        max_iter (:obj:`int`): maximum number of solves of the root.
+        tol (:obj:`float`): relative tolerance of the gap between bounds.
+        cut_mode, cut_clusters: see
+            :func:`ndusc.nd.nested_decomposition`.
+        staleness (:obj:`int`): number of trial solutions of a parent a
+            linearization of its children can lag behind to be used in its
+            cuts.
+        full_solution (:obj:`bool`): see
+            :func:`ndusc.nd.nested_decomposition`.
+        monitors (:obj:`list`): objects told of the end of each iteration
+            (between two solves of the root), see
+            :func:`ndusc.nd.end_iteration`.
+        cut_family: see :func:`ndusc.cuts.stage_family`.
+    """
+
+    def __init__(self, tree_nc, pool, output, max_iter=100, tol=1e-6,
+                 cut_mode='single', cut_clusters=None, staleness=0,
+                 full_solution=False, monitors=(), cut_family='benders'):
+        self.tree = tree_nc
+        self.pool = pool
+        self.output = output
+        self.max_iter = max_iter
+        self.tol = tol
+        self.cut_mode = cut_mode
+        self.cut_clusters = cut_clusters
+        self.staleness = staleness
+        self.full_solution = full_solution
+        self.monitors = monitors
+        self.cut_family = cut_family
+
+        self.root = tree_nc.return_stage_nodes(tree_nc.stages[0])[0]
+        self.cond_prob = tree_nc.conditional_probability()
+        ids = [node['id'] for node in tree_nc.nodes]
+        self.version = dict.fromkeys(ids, 0)
+        self.trial_parent = dict.fromkeys(ids)
+        self.linearization = dict.fromkeys(ids)
+        self.pending = {nodeid: set() for nodeid in ids}
+        self.inconsistent = set(ids)
+        self.queue = collections.deque()
+        self.busy = set()
+        self.deferred = {}
+        self.infeasible = {}
+        self.iteration = output['iterations']
+        self.status = None
+
+    def run(self):
+        """Run the decomposition until the bounds meet or no task is left.
+
+        Return:
+            :obj:`dict`: the output dictionary.
+        """
+        asyncio.run(self._run())
+        if self.status is None:
+            self.status = ('max_iter' if self.iteration >= self.max_iter
+                           else 'stalled')
+        self.output['status'] = self.status
+        return self.output
+
+    def enqueue(self, nodeid, kind):
+        """Ask for a task of kind `kind` of the node `nodeid`."""
+        if kind in self.pending[nodeid]:
+            return
+        self.pending[nodeid].add(kind)
+        if nodeid not in self.busy:
+            self.queue.append(nodeid)
+
+    async def _run(self):
+        self.enqueue(self.root['id'], 'forward')
+        running = {}
+        while self.status is None:
+            while self.queue and len(running) < self.pool.workers:
+                task = self._next()
+                if task is None:
+                    continue
+                kind, node, args, info = task
+                future = asyncio.wrap_future(
+                    self.pool.submit(kind, (node,) + args))
+                running[future] = (kind, node, info)
+            if not running:
+                break
+            done, pending = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                kind, node, info = running.pop(future)
+                self.busy.discard(node['id'])
+                self.output['solves'] += 1
+                getattr(self, '_' + kind)(node, future.result(), *info)
+                for function in self.deferred.pop(node['id'], []):
+                    function()
+                if self.pending[node['id']]:
+                    self.queue.append(node['id'])
+        if running:
+            await asyncio.wait(running)
+
+    def _next(self):
+        """Return the next task to send, None if the node can not run."""
+        nodeid = self.queue.popleft()
+        pending = self.pending[nodeid]
+        if nodeid in self.busy or not pending:
+            return None
+        node = self.tree.return_node(nodeid)
+        prev_id = node.get('prev_id')
+        if prev_id is not None and self.version[prev_id] == 0:
+            # The parent has no trial solution yet
+            pending.clear()
+            return None
+        state = nd.node_state(self.tree, node)
+        parent_version = self.version[prev_id] if prev_id is not None \
+            else None
+
+        for kind in ('feasibility', 'forward', 'backward'):
+            if kind in pending:
+                pending.discard(kind)
+                break
+        if kind == 'forward' and prev_id is None:
+            if self.iteration >= self.max_iter:
+                return None
+        self.busy.add(nodeid)
+        if kind == 'feasibility':
+            state = self.infeasible.pop(nodeid)
+            return 'feasibility', node, (state, True), (state,)
+        if kind == 'forward':
+            names = None if self.full_solution else node['state_names']
+            return 'solve', node, (state, False, names), \
+                ('forward', parent_version, state)
+        family = cuts.stage_family(self.cut_family, node['stage'])
+        return 'solve', node, (state, True, (), None, family), \
+            ('backward', parent_version, state)
+
+    # Task results ------------------------------------------------------------
+    def _solve(self, node, solution, kind, parent_version, state):
+        nd.count_solve(self.output, node, solution)
+        nd.update_state_names(self.tree, node, solution['linking'])
+        if solution['results'] is None:
+            if node is self.root:
+                self.status = 'infeasible'
+            else:
+                self.infeasible[node['id']] = state
+                self.enqueue(node['id'], 'feasibility')
+            return
+        if kind == 'forward':
+            self._forward(node, solution, parent_version)
+        else:
+            self._backward(node, solution, parent_version, state)
+
+    def _forward(self, node, solution, parent_version):
+        nodeid = node['id']
+        node.update(solution['results'])
+        node['value'] = solution['value']
+        node['cost'] = solution['cost']
+        self.version[nodeid] += 1
+        self.trial_parent[nodeid] = parent_version
+        evicted, revived = cuts.update_cut_pools(node, self.iteration)
+        self.output['cuts_evicted'] += evicted
+        self.output['cuts_revived'] += revived
+
+        prev_id = node.get('prev_id')
+        if prev_id is None or parent_version == self.version[prev_id]:
+            self.inconsistent.discard(nodeid)
+        for child in self.tree.return_children(nodeid):
+            self.inconsistent.add(child['id'])
+            self.enqueue(child['id'], 'forward')
+
+        if prev_id is None:
+            nd.end_iteration(self.monitors, self.output, self.tree)
+            self.iteration += 1
+            self.output['iterations'] = self.iteration
+            instrument.set_iteration(self.iteration)
+            log.info('Root solve {}'.format(self.iteration))
+            groups = len(node['cut_pool']['opt'].groups)
+            if groups and groups >= self._group_count(node):
+                self.output['lower_bound'] = max(self.output['lower_bound'],
+                                                 node['value'])
+        else:
+            self.enqueue(nodeid, 'backward')
+        self._bounds()
+
+    def _backward(self, node, solution, parent_version, state):
+        columns = solution['columns']
+        self.linearization[node['id']] = {
+            'value': solution['value'],
+            'columns': columns,
+            'gradient': solution['gradient'],
+            'x': cuts.state_vector(state, columns),
+            'version': parent_version,
+            'new': True,
+            # Benders cut of the relaxation, with integer L-shaped cuts
+            'benders': solution.get('benders'),
+        }
+        self._when_idle(node['prev_id'], self._cuts)
+
+    def _feasibility(self, node, solution, state):
+        instrument.count('solves', node=node['id'])
+        if solution['infeasibility'] <= self.tol:
+            # The relaxation of the node is feasible
+            if cuts.stage_family(self.cut_family, node['stage']) == 'benders':
+                self.status = 'stalled'
+                return
+            self._when_idle(node['prev_id'], self._nogood_cut, solution,
+                            state)
+            return
+        self._when_idle(node['prev_id'], self._feasibility_cut, solution,
+                        state)
+    # ---------------------------------------------------------------------- #
+
+    def _when_idle(self, nodeid, function, *args):
+        """Call ``function(nodeid, *args)`` once `nodeid` is not being
+        solved, as it changes its cuts."""
+        if nodeid in self.busy:
+            self.deferred.setdefault(nodeid, []).append(
+                lambda: function(nodeid, *args))
+        else:
+            function(nodeid, *args)
+
+    def _feasibility_cut(self, nodeid, solution, state):
+        cid = cuts.compute_feas_cuts(
+            self.tree.return_node(nodeid), solution['infeasibility'],
+            solution['columns'], solution['gradient'],
+            cuts.state_vector(state, solution['columns']))
+        if cid is None:
+            self.status = 'stalled'
+            return
+        self.enqueue(nodeid, 'forward')
+
+    def _nogood_cut(self, nodeid, solution, state):
+        cid = cuts.compute_nogood_cut(
+            self.tree.return_node(nodeid), solution['columns'],
+            cuts.state_vector(state, solution['columns']))
+        # A dominated cut has already been added for another child
+        if cid is not None:
+            self.enqueue(nodeid, 'forward')
+
+    def _cuts(self, nodeid):
+        """Add to `nodeid` the cuts of the groups of children ready."""
+        node = self.tree.return_node(nodeid)
+        children = [child['id'] for child in self.tree.return_children(nodeid)]
+        lins = [self.linearization[c] for c in children]
+        if self.cut_mode == 'hybrid' and 'cut_groups' not in node \
+                and any(lin is None for lin in lins):
+            return
+        ready = [c for c, lin in zip(children, lins) if lin is not None]
+        if not ready:
+            return
+        columns, gradients = cuts.stack_gradients(
+            [self.linearization[c]['columns'] for c in ready],
+            [self.linearization[c]['gradient'] for c in ready])
+        values = np.array([self.linearization[c]['value'] for c in ready])
+        groups = dict(zip(ready, cuts.cut_groups(
+            node, ready, values, gradients, self.cut_mode,
+            self.cut_clusters)))
+        if self.cut_mode == 'single':
+            members = {0: children}
+        elif self.cut_mode == 'multi':
+            members = {c: [c] for c in children}
+        else:
+            members = {}
+            for c, g in node['cut_groups'].items():
+                members.setdefault(g, []).append(c)
+
+        oldest = self.version[nodeid] - self.staleness
+        added = False
+        for g, group in members.items():
+            group_lins = [self.linearization[c] for c in group]
+            if any(lin is None or lin['version'] < oldest
+                   for lin in group_lins) \
+                    or not any(lin['new'] for lin in group_lins):
+                continue
+            rows = [ready.index(c) for c in group]
+            probabilities = self.cond_prob[[self.tree.position[c]
+                                            for c in group]]
+            x = np.vstack([_aligned(lin, columns) for lin in group_lins])
+            ids = cuts.compute_opt_cuts(
+                node, columns, probabilities, values[rows], gradients[rows],
+                x, [groups[c] for c in group])
+            if all(lin['benders'] is not None for lin in group_lins):
+                benders_columns, benders_gradients = cuts.stack_gradients(
+                    [lin['columns'] for lin in group_lins],
+                    [lin['benders']['gradient'] for lin in group_lins])
+                ids += cuts.compute_opt_cuts(
+                    node, benders_columns, probabilities,
+                    np.array([lin['benders']['value'] for lin in group_lins]),
+                    benders_gradients,
+                    np.vstack([_aligned(lin, benders_columns)
+                               for lin in group_lins]),
+                    [groups[c] for c in group])
+            for lin in group_lins:
+                lin['new'] = False
+            added = added or any(cid is not None for cid in ids)
+        if added:
+            self.enqueue(nodeid, 'forward')
+
+    def _group_count(self, node):
+        children = self.tree.return_children(node['id'])
+        if self.cut_mode == 'single':
+            return 1
+        if self.cut_mode == 'multi':
+            return len(children)
+        return len(set(node.get('cut_groups', {0: 0}).values()))
+
+    def _bounds(self):
+        if self.inconsistent:
+            return
+        costs = np.array([n['cost'] for n in self.tree.nodes])
+        self.output['upper_bound'] = min(self.output['upper_bound'],
+                                         self.tree.expected_value(costs))
+        log.info('Bounds: [{}, {}]'.format(self.output['lower_bound'],
+                                           self.output['upper_bound']))
+        gap = self.output['upper_bound'] - self.output['lower_bound']
+        if gap <= self.tol * max(1.0, abs(self.output['upper_bound'])):
+            self.status = 'optimal'
+
+
+def _aligned(linearization, columns):
+    """State of a linearization, aligned with `columns`."""
+    if linearization['columns'] == columns:
+        return linearization['x']
+    x = dict(zip(linearization['columns'], linearization['x']))
+    return np.array([x.get(key, 0.0) for key in columns])
@@ -0,0 +1,374 @@
+"""Stochastic dual dynamic programming (SDDP).
+
+When the outcomes of each stage do not depend on those of the previous
+stages (stagewise independence) the expected cost of the future of a node
+only depends on its stage and on its state, so the nodes of a stage can
+share their cuts and the tree does not need to be enumerated. Each stage
+is given once, with its model and its outcomes::
+
+    stages:
+      - stage: 1
+        model:
+            file: tests/test1/model_S1.py
+            function: model_S1
+        params:
+            demand: 1
+      - stage: 2
+        model:
+            file: tests/test1/model_S2.py
+            function: model_S2
+            linking:
+                y: y_prev
+        outcomes:
+          - probability: 0.5
+            params:
+                demand: 1
+          - probability: 0.5
+            params:
+                demand: 3
+
+A stage without `outcomes` has a single outcome. The `params` and `sets` of
+an outcome override those of its stage, which override the global data.
+Each outcome is a node of stage (see :func:`stage_nodes`); the outcomes of a
+stage share one model (see :class:`ndusc.model.Template`), so the
+parameters that change between outcomes must be mutable parameters of the
+model, and one pool of cuts.
+
+Each iteration:
+
+    - Forward pass: samples `samples` paths of outcomes and solves them
+      stage by stage, each node at the state reached by its path. The mean
+      cost of the paths is an estimate of the upper bound, with a
+      confidence interval.
+    - Backward pass: from the last stage, solves all the outcomes of the
+      stage at each state of the forward pass with duals, and adds the cut
+      built from them to the pool of the previous stage.
+
+The lower bound is the expected value of the first stage. The algorithm
+stops when the lower bound is within the confidence interval of the upper
+bound (only with `samples` > 1, or if no stage has several outcomes), or
+after `max_iter` iterations. If a sampled path reaches an infeasible node
+the upper bound of the iteration is infinite and the run does not stop.
+
+Memory and time per iteration are linear in the number of stages.
+"""
+
+import logging as log
+import statistics
+
+import numpy as np
+
+from ndusc import cuts
+from ndusc import instrument
+from ndusc import model
+from ndusc import nd
+from ndusc import parallel
+from ndusc import tree
+
+
+def sddp(stages_data, data, solver='gurobi', persistent=True, max_iter=100,
+         tol=1e-6, executor='serial', workers=None, cut_mode='single',
+         cut_max_age=None, shared=True, samples=20, simulations=0,
+         confidence=0.95, seed=None, output_path=None):
+    """Stochastic dual dynamic programming.
+
+    Args:
+        stages_data (:obj:`dict`): stages information (see
+            :mod:`ndusc.sddp`).
+        data (:obj:`dict`): dictionary with problem data.
+        solver, persistent, executor, workers, shared, cut_max_age: see
+            :func:`ndusc.nd.nested_decomposition`.
+        max_iter (:obj:`int`): maximum number of iterations.
+        tol (:obj:`float`): relative tolerance of the gap between bounds.
+        cut_mode (:obj:`str`): 'single' (one cut of the expected value of
+            the outcomes of the next stage) or 'multi' (one cut per
+            outcome).
+        samples (:obj:`int`): paths sampled in each forward pass. With a
+            single sample the upper bound has no confidence interval, and
+            the run only stops at `max_iter`.
+        simulations (:obj:`int`): if positive, the upper bound is estimated
+            at the end with this number of sampled paths.
+        confidence (:obj:`float`): confidence level of the interval of the
+            upper bound.
+        seed (:obj:`int`): seed of the sampling.
+        output_path: see :func:`ndusc.nd.nested_decomposition`.
+
+    Return:
+        :obj:`dict`: status, `lower_bound`, `upper_bound` (mean cost of the
+        sampled paths of the last forward pass, or of the simulations) and
+        its `confidence_interval`, number of iterations, node solves and
+        model builds, and the tree of the nodes of stage with the last
+        solution of each one.
+    """
+    if cut_mode not in ('single', 'multi'):
+        raise ValueError('Unknown cut mode for SDDP: {}'.format(cut_mode))
+    tree_nc = tree.Tree({'nodes': stage_nodes(stages_data)})
+    model.registry.refresh()
+    stages = [tree_nc.return_stage_nodes(stage) for stage in tree_nc.stages]
+    for nodes in stages:
+        cuts.init_cut_pools(nodes[0], cut_max_age)
+        for node in nodes:
+            node['cut_pool'] = nodes[0]['cut_pool']
+            node['cuts'] = nodes[0]['cuts']
+            node['cuts_id'] = ('stage', node['stage'])
+
+    output = {
+        'status': 'max_iter',
+        'lower_bound': -np.inf,
+        'upper_bound': np.inf,
+        'confidence_interval': (-np.inf, np.inf),
+        'iterations': 0,
+        'solves': 0,
+        'builds': 0,
+        'cuts_evicted': 0,
+        'cuts_revived': 0,
+    }
+    solver_state = {
+        'stages': stages,
+        'probabilities': [outcome_probabilities(nodes) for nodes in stages],
+        'names': [None] * (len(stages) - 1) + [()],
+        'rng': np.random.RandomState(seed),
+        'z': statistics.NormalDist().inv_cdf((1 + confidence) / 2),
+        'cut_mode': cut_mode,
+    }
+    sampled = any(len(nodes) > 1 for nodes in stages)
+
+    run_log = nd.open_log(output_path, algorithm='sddp',
+                          stages=len(stages), executor=executor,
+                          cut_mode=cut_mode, samples=samples)
+    monitors = [run_log] if run_log is not None else []
+    pool = parallel.create_executor(executor, tree_nc, data, solver,
+                                    persistent, workers, shared)
+    try:
+        for iteration in range(1, max_iter + 1):
+            nd.end_iteration(monitors, output, tree_nc)
+            output['iterations'] = iteration
+            instrument.set_iteration(iteration)
+            log.info('Iteration {}'.format(iteration))
+            with instrument.span('forward pass'):
+                paths = forward_pass(solver_state, pool, output, samples,
+                                     iteration, tol)
+            if paths is None:
+                break
+            log.info('Bounds: [{}, {}]'.format(output['lower_bound'],
+                                               output['upper_bound']))
+            low, high = output['confidence_interval']
+            if np.isfinite(output['upper_bound']) and (
+                    len(stages[0][0]['cut_pool']['opt']) or len(stages) == 1):
+                width = high - low if sampled else 0.0
+                if (samples > 1 or not sampled) and \
+                        output['upper_bound'] - output['lower_bound'] <= \
+                        width / 2 + tol * max(1.0,
+                                              abs(output['upper_bound'])):
+                    output['status'] = 'optimal'
+                    break
+            with instrument.span('backward pass'):
+                backward_pass(solver_state, pool, output, paths, tol)
+
+        if simulations and output['status'] in ('optimal', 'max_iter'):
+            forward_pass(solver_state, pool, output, simulations,
+                         output['iterations'], tol, update=False)
+    finally:
+        pool.close()
+        if run_log is not None:
+            run_log.close()
+
+    if run_log is not None:
+        run_log.finish(output, tree_nc)
+    output['tree'] = tree_nc
+    return output
+
+
+def stage_nodes(stages_data):
+    """Return the nodes of stage: one node per outcome of each stage.
+
+    Args:
+        stages_data (:obj:`dict`): stages information (see
+            :mod:`ndusc.sddp`).
+
+    Return:
+        :obj:`list`: nodes, with consecutive ids, no parent and the
+        probability of their outcome.
+    """
+    nodes = []
+    for k, stage in enumerate(stages_data['stages']):
+        outcomes = stage.get('outcomes') or [{'probability': 1.0}]
+        for outcome in outcomes:
+            node = {
+                'id': len(nodes) + 1,
+                'prev_id': None,
+                'stage': stage.get('stage', k + 1),
+                'probability': outcome.get('probability', 1.0 / len(outcomes)),
+                'model': stage['model'],
+            }
+            for key in ('params', 'sets'):
+                values = dict(stage.get(key) or {})
+                values.update(outcome.get(key) or {})
+                if values:
+                    node[key] = values
+            nodes.append(node)
+    return nodes
+
+
+def outcome_probabilities(nodes):
+    """Return the probabilities of the outcomes `nodes` of a stage."""
+    probabilities = np.array([node['probability'] for node in nodes],
+                             dtype=np.float64)
+    return probabilities / probabilities.sum()
+
+
+def forward_pass(solver_state, pool, output, samples, iteration, tol=1e-6,
+                 update=True):
+    """Solve `samples` sampled paths stage by stage.
+
+    Updates the lower bound (expected value of the first stage) and the
+    upper bound (mean cost of the paths) with its confidence interval. A
+    path that reaches an infeasible node ends there and a feasibility cut is
+    added to the previous stage; the upper bound is then infinite, as the
+    sampled policy is not feasible.
+
+    Args:
+        update (:obj:`bool`): if False (simulation) the cut pools are not
+            updated and no feasibility cut is added.
+
+    Return:
+        :obj:`list`: states of each path (list of the solutions of its
+        nodes) that reached each stage, None if the algorithm must stop
+        (its status is set).
+    """
+    stages = solver_state['stages']
+    rng = solver_state['rng']
+    paths = [[] for k in range(samples)]
+    costs = np.zeros(samples)
+    alive = list(range(samples))
+    for t, nodes in enumerate(stages):
+        probabilities = solver_state['probabilities'][t]
+        if t == 0:
+            # All the outcomes of the first stage, for the lower bound
+            picks = rng.choice(len(nodes), size=samples, p=probabilities)
+            tasks = [(node, {}, False, solver_state['names'][0])
+                     for node in nodes]
+        else:
+            picks = rng.choice(len(nodes), size=len(alive), p=probabilities)
+            tasks = [(nodes[j], paths[p][-1], False, solver_state['names'][t])
+                     for p, j in zip(alive, picks)]
+        solutions = pool.solve(tasks)
+        output['solves'] += len(tasks)
+        for (node, state, duals, names), solution in zip(tasks, solutions):
+            nd.count_solve(output, node, solution)
+            if t > 0:
+                _state_names(solver_state, t - 1, solution['linking'])
+
+        if t == 0:
+            if any(solution['results'] is None for solution in solutions):
+                output['status'] = 'infeasible'
+                return None
+            values = np.array([solution['value'] for solution in solutions])
+            if len(nodes[0]['cut_pool']['opt']) or len(stages) == 1:
+                output['lower_bound'] = float(probabilities @ values)
+            solutions = [solutions[j] for j in picks]
+            tasks = [tasks[j] for j in picks]
+
+        infeasible = []
+        next_alive = []
+        for p, (node, state, duals, names), solution in zip(alive, tasks,
+                                                            solutions):
+            if solution['results'] is None:
+                infeasible.append((node, state))
+                continue
+            if update:
+                node.update(solution['results'])
+                evicted, revived = cuts.update_cut_pools(node, iteration)
+                output['cuts_evicted'] += evicted
+                output['cuts_revived'] += revived
+            paths[p].append(solution['results']['variables'])
+            costs[p] += solution['cost']
+            next_alive.append(p)
+        alive = next_alive
+
+        if infeasible and update:
+            if not feasibility_cuts(solver_state, pool, output, t,
+                                    infeasible, tol):
+                output['status'] = 'stalled'
+                return None
+        if not alive:
+            break
+
+    if len(alive) < samples:
+        output['upper_bound'] = np.inf
+        output['confidence_interval'] = (-np.inf, np.inf)
+        return paths
+    mean = float(costs.mean())
+    width = 0.0
+    if len(costs) > 1:
+        width = solver_state['z'] * float(costs.std(ddof=1)) \
+            / len(costs) ** 0.5
+    output['upper_bound'] = mean
+    output['confidence_interval'] = (mean - width, mean + width)
+    return paths
+
+
+def backward_pass(solver_state, pool, output, paths, tol=1e-6):
+    """Add to each stage the cuts of the outcomes of the next stage at the
+    states of the forward pass."""
+    stages = solver_state['stages']
+    for t in range(len(stages) - 1, 0, -1):
+        nodes = stages[t]
+        states = [path[t - 1] for path in paths if len(path) >= t]
+        tasks = [(node, state, True, ()) for state in states
+                 for node in nodes]
+        solutions = pool.solve(tasks)
+        output['solves'] += len(tasks)
+        parent = stages[t - 1][0]
+        groups = None
+        if solver_state['cut_mode'] == 'multi':
+            groups = list(range(len(nodes)))
+        for k, state in enumerate(states):
+            outcomes = solutions[k * len(nodes):(k + 1) * len(nodes)]
+            for node, solution in zip(nodes, outcomes):
+                nd.count_solve(output, node, solution)
+            infeasible = [(node, state) for node, solution
+                          in zip(nodes, outcomes)
+                          if solution['results'] is None]
+            if infeasible:
+                feasibility_cuts(solver_state, pool, output, t,
+                                 infeasible[:1], tol)
+                continue
+            columns, gradients = cuts.stack_gradients(
+                [solution['columns'] for solution in outcomes],
+                [solution['gradient'] for solution in outcomes])
+            cuts.compute_opt_cuts(
+                parent, columns, solver_state['probabilities'][t],
+                np.array([solution['value'] for solution in outcomes]),
+                gradients, cuts.state_vector(state, columns), groups)
+
+
+def feasibility_cuts(solver_state, pool, output, t, infeasible, tol=1e-6):
+    """Add to the stage before `t` the feasibility cuts of the infeasible
+    ``(node, state)`` of stage `t`.
+
+    Return:
+        :obj:`int`: number of cuts added.
+    """
+    solutions = pool.feasibility(infeasible)
+    output['solves'] += len(infeasible)
+    parent = solver_state['stages'][t - 1][0]
+    added = 0
+    for (node, state), solution in zip(infeasible, solutions):
+        instrument.count('solves', node=node['id'])
+        if solution['infeasibility'] <= tol:
+            continue
+        cuts.compute_feas_cuts(
+            parent, solution['infeasibility'], solution['columns'],
+            solution['gradient'],
+            cuts.state_vector(state, solution['columns']))
+        added += 1
+    return added
+
+
+def _state_names(solver_state, t, linking):
+    """Add the variables received by stage t + 1 to the state of stage t."""
+    names = solver_state['names'][t]
+    if names is None or not set(linking) <= set(names):
+        solver_state['names'][t] = tuple(sorted(set(names or ()) |
+                                                set(linking)))
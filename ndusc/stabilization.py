@@ -0,0 +1,413 @@
+"""Stabilization of the trial points of the masters.
+
+In the forward pass of :func:`ndusc.nd.nested_decomposition` each node with
+children (a master) is solved with its cuts and its solution is the trial
+point given to its children. In the first iterations the cuts are a poor
+model of the future cost, and the trial points of a master jump between
+distant solutions (e.g. opposite choices of the binary `Z` of the first
+stage of the wildfire example), each one costing a pass over its subtree.
+The stabilization keeps the trial point of a master close to its center,
+the best trial point found so far, measuring the distance in the L1 norm of
+its state variables x (those that feed its children):
+
+    - `proximal` (regularized decomposition): the objective gets the term
+      ``weight * ||x - center||_1``.
+    - `trust_region`: the constraint ``||x - center||_1 <= radius`` is added.
+      With binary states it is a local branching constraint.
+    - `level` (level bundle): the problem minimizes ``||x - center||_1``
+      subject to its objective (cost and future cost) being at most the
+      level ``bound + fraction * (center value - bound)``, where the bound is
+      its optimal value without stabilization.
+
+Step control: after each forward pass the realized cost of the subtree of
+each master (its cost plus the expected realized cost of its children) is
+compared with the decrease predicted by its model (cost and future cost).
+If the trial point achieves at least 10% of the predicted decrease from the
+center (serious step) it becomes the center, otherwise (null step) the
+center is kept. Long steps are rewarded: the weight is halved (the radius
+doubled) when the trial point achieves 75% of the predicted decrease, and
+the weight doubled (the radius halved) after a null step. The initial
+weight and radius are relative to the size of the center and, for the
+weight, to the error of the model at the center when it was chosen. The
+level method has no step size, its level follows the bounds.
+
+The center of a node is only valid for the state (the trial point of the
+parent) it was found at: when the state changes the node is solved without
+stabilization and its new trial point is the new center.
+
+The cuts are computed as without stabilization (the backward solves are not
+stabilized), so they stay valid and the lower bound is given by the root
+solved without stabilization: the root (and, for the level method, each
+stabilized node) is solved twice in the forward pass. An iteration whose
+backward pass gives no new cut is followed by an iteration without
+stabilization, so the bounds still meet.
+
+Only the stage by stage sweep with whole forward and backward passes
+('FFFB' protocol) is stabilized.
+"""
+
+import logging as log
+
+import numpy as np
+from pyomo.environ import (Any, Constraint, NonNegativeReals, Objective,
+                           Param, Var, minimize, value)
+
+methods = ('proximal', 'trust_region', 'level')
+
+# Fractions of the predicted decrease of a serious step and of a long step
+_serious = 0.1
+_good = 0.75
+
+# Limits of the step multiplier
+_min_step = 2.0 ** -10
+_max_step = 2.0 ** 10
+
+
+class Stabilizer(object):
+    """Centers and step control of the stabilized masters of a run.
+
+    Args:
+        method (:obj:`str`): 'proximal', 'trust_region' or 'level' (see
+            :data:`methods`).
+        stages (:obj:`list`): stages whose masters are stabilized (default:
+            all the stages but the last).
+        weight (:obj:`float`): initial weight of the proximal term, relative
+            to the error of the model at the center divided by the size of
+            the center (the sum of ``max(1, |center|)``).
+        radius (:obj:`float`): initial radius of the trust region, relative
+            to the size of the center.
+        fraction (:obj:`float`): fraction of the gap between the bound and
+            the value of the center given by the level.
+        tol (:obj:`float`): relative tolerance of the predicted decrease.
+
+    Example:
+        >>> output = nd.nested_decomposition(
+        ...     tree_data, data, stabilize=Stabilizer('trust_region',
+        ...                                           radius=0.5))
+    """
+
+    def __init__(self, method='proximal', stages=None, weight=0.01,
+                 radius=0.5, fraction=0.5, tol=1e-6):
+        if method not in methods:
+            raise ValueError('Unknown stabilization: {}'.format(method))
+        self.method = method
+        self.stages = stages
+        self.weight = weight
+        self.radius = radius
+        self.fraction = fraction
+        self.tol = tol
+        self.nodes = set()
+        self.centers = {}
+        self.bounds = {}
+        self.paused = False
+        self.stabilized = 0
+        self.serious = 0
+        self.null = 0
+
+    def start(self, tree_nc):
+        """Choose the stabilized masters of `tree_nc`."""
+        stages = self.stages
+        if stages is None:
+            stages = tree_nc.stages[:-1]
+        self.nodes = set(node['id'] for node in tree_nc.nodes
+                         if node['stage'] in stages
+                         and tree_nc.return_children(node['id']))
+
+    def active(self, tree_nc, node):
+        """Return True if `node` has a center for its current state."""
+        if self.paused or node['id'] not in self.nodes:
+            return False
+        center = self.centers.get(node['id'])
+        return center is not None and _same(center['state'],
+                                            _state(tree_nc, node))
+
+    def settings(self, node, bound=None):
+        """Return the stabilization of the next solve of the (active) `node`,
+        the argument `stabilize` of :meth:`ndusc.parallel.Node_solver.solve`,
+        None if it is solved without stabilization.
+
+        Args:
+            bound (:obj:`float`): optimal value of the node without
+                stabilization (needed by the level method).
+        """
+        center = self.centers[node['id']]
+        settings = {'method': self.method, 'center': center['x']}
+        if self.method == 'proximal':
+            settings['weight'] = center['weight'] / center['step']
+        elif self.method == 'trust_region':
+            settings['radius'] = self.radius * center['size'] \
+                * center['step']
+        else:
+            gap = center['value'] - bound
+            if gap <= self.tol * max(1.0, abs(center['value'])):
+                return None
+            settings['level'] = bound + self.fraction * gap
+        return settings
+
+    def bounded(self, node):
+        """Return True if the (active) `node` must also be solved without
+        stabilization: the root, for the lower bound, and every node with
+        the level method."""
+        return self.method == 'level' or node.get('prev_id') is None
+
+    def solve(self, tree_nc, pool, nodes, tasks):
+        """Solve the nodes of a forward stage, stabilizing the active ones.
+
+        Args:
+            nodes (:obj:`list`): nodes of the stage.
+            tasks (:obj:`list`): their tasks without stabilization, see
+                :meth:`ndusc.parallel.Serial_executor.solve`.
+
+        Return:
+            :obj:`tuple`: output of the trial solve of each node and
+            ``(node, output)`` of the other solves (without stabilization
+            of the bounded nodes, and again without stabilization of the
+            nodes infeasible with it).
+        """
+        active = [p for p, node in enumerate(nodes)
+                  if self.active(tree_nc, node)]
+        plain = {}
+        bounded = [p for p in active if self.bounded(nodes[p])]
+        if bounded:
+            plain = dict(zip(bounded,
+                             pool.solve([tasks[p] for p in bounded])))
+
+        # Trial solves
+        stabilized = {}
+        batch = []
+        for p, node in enumerate(nodes):
+            solution = plain.get(p)
+            if solution is not None and solution['results'] is None:
+                # Infeasible without stabilization
+                continue
+            settings = None
+            if p in active:
+                settings = self.settings(
+                    node, None if solution is None else solution['value'])
+            if settings is not None:
+                stabilized[p] = settings
+                batch.append(tuple(tasks[p]) + (settings,))
+            elif solution is None:
+                batch.append(tasks[p])
+        positions = [p for p in range(len(nodes))
+                     if p in stabilized or p not in plain]
+        solutions = [plain.get(p) for p in range(len(nodes))]
+        extra = []
+        for p, solution in zip(positions, pool.solve(batch)):
+            if solutions[p] is not None:
+                extra.append((nodes[p], solutions[p]))
+            solutions[p] = solution
+        self.stabilized += len(stabilized)
+
+        # Nodes infeasible with stabilization
+        failed = [p for p in stabilized if solutions[p]['results'] is None]
+        if failed:
+            log.info('Stabilization infeasible at nodes {}'.format(
+                [nodes[p]['id'] for p in failed]))
+            for p, solution in zip(failed,
+                                   pool.solve([tasks[p] for p in failed])):
+                extra.append((nodes[p], solutions[p]))
+                solutions[p] = solution
+                stabilized.pop(p)
+                self.centers.pop(nodes[p]['id'], None)
+
+        # Optimal values without stabilization
+        for p, node in enumerate(nodes):
+            solution = plain.get(p) if p in stabilized else solutions[p]
+            if solution is not None and solution['results'] is not None:
+                self.bounds[node['id']] = solution['value']
+        return solutions, extra
+
+    def bound(self, node):
+        """Return the optimal value of `node` without stabilization in the
+        last forward pass."""
+        return self.bounds.get(node['id'], node['value'])
+
+    def update(self, tree_nc):
+        """Move the centers and the step sizes after a forward pass that
+        solved all the nodes."""
+        realized = subtree_costs(tree_nc)
+        for k, node in enumerate(tree_nc.nodes):
+            if node['id'] not in self.nodes or not node['state_names']:
+                continue
+            state = _state(tree_nc, node)
+            center = self.centers.get(node['id'])
+            if center is None or not _same(center['state'], state):
+                self._move(node, state, realized[k],
+                           1.0 if center is None else center['step'])
+                continue
+            predicted = center['value'] - node['value']
+            actual = center['value'] - realized[k]
+            if predicted <= self.tol * max(1.0, abs(center['value'])):
+                # The model does not expect a decrease
+                if actual > 0:
+                    self._move(node, state, realized[k], center['step'])
+                continue
+            if actual >= _serious * predicted:
+                self.serious += 1
+                step = center['step']
+                if actual >= _good * predicted:
+                    step = min(2.0 * step, _max_step)
+                self._move(node, state, realized[k], step)
+            else:
+                self.null += 1
+                center['step'] = max(0.5 * center['step'], _min_step)
+
+    def end_iteration(self, new):
+        """Pause the stabilization for one iteration if the backward pass
+        gave no `new` cuts."""
+        self.paused = not new and not self.paused
+        if self.paused:
+            log.info('Stabilization paused')
+
+    def _move(self, node, state, realized, step):
+        x = {name: dict(node['variables'][name])
+             for name in node['state_names']}
+        size = sum(max(1.0, abs(v)) for values in x.values()
+                   for v in values.values())
+        error = max(realized - node['value'],
+                    self.tol * max(1.0, abs(realized)))
+        self.centers[node['id']] = {
+            'x': x, 'state': state, 'value': realized, 'size': size,
+            'weight': self.weight * error / size, 'step': step}
+
+
+def subtree_costs(tree_nc):
+    """Return the realized cost of the subtree of each node: its cost plus
+    the expected realized cost of its children (aligned with `nodes`)."""
+    costs = np.array([node['cost'] for node in tree_nc.nodes])
+    realized = costs
+    for stage in tree_nc.stages[1:]:
+        realized = costs + tree_nc.children_expected_value(realized)
+    return realized
+
+
+def apply(problem, settings):
+    """Stabilize `problem` (see :meth:`Stabilizer.settings`) for its next
+    solve, until :func:`release`.
+
+    The deviations from the center are the variables `_Stab_Dev[k]` with
+    ``_Stab_Dev[k] >= |x[k] - _Stab_Center[k]|``, added the first time a
+    state variable is stabilized and kept in the problem (with zero cost
+    they do not change the problem without stabilization). The proximal
+    objective and the trust region and level constraints are built again
+    only when their objective or state variables change.
+    """
+    info = getattr(problem, '_stab_info', None)
+    if info is None:
+        info = problem._stab_info = {'columns': {}, 'built': None}
+        problem._Stab_Center = Param(Any, mutable=True, initialize={})
+        problem._Stab_Dev = Var(Any, dense=False, within=NonNegativeReals)
+        problem._Stab_Up = Constraint(Any)
+        problem._Stab_Down = Constraint(Any)
+        problem._Stab_Weight = Param(mutable=True, initialize=0.0)
+        problem._Stab_Radius = Param(mutable=True, initialize=0.0)
+        problem._Stab_Level = Param(mutable=True, initialize=0.0)
+
+    columns = info['columns']
+    stabilized = []
+    for name, values in settings['center'].items():
+        var = problem.component(name)
+        for index, center in values.items():
+            k = columns.get((name, index))
+            if k is None:
+                k = columns[(name, index)] = len(columns)
+                problem._Stab_Center[k] = center
+                deviation = problem._Stab_Dev[k]
+                problem._Stab_Up[k] = \
+                    deviation >= var[index] - problem._Stab_Center[k]
+                problem._Stab_Down[k] = \
+                    deviation >= problem._Stab_Center[k] - var[index]
+            elif value(problem._Stab_Center[k]) != center:
+                problem._Stab_Center[k] = center
+            stabilized.append(k)
+
+    method = settings['method']
+    base = next(problem.component_data_objects(Objective, active=True))
+    built = (method, base, tuple(stabilized))
+    if info['built'] is None or info['built'][0] != method or \
+            info['built'][1] is not base or info['built'][2] != built[2]:
+        _build(problem, method, base, stabilized)
+        info['built'] = built
+    info['base'] = base
+
+    if method == 'proximal':
+        problem._Stab_Weight = settings['weight']
+    elif method == 'trust_region':
+        problem._Stab_Radius = settings['radius']
+    else:
+        problem._Stab_Level = settings['level']
+    if problem.component('_Stab_Obj') is not None:
+        base.deactivate()
+        problem._Stab_Obj.activate()
+    for name in ('_Stab_Region', '_Stab_Bound'):
+        if problem.component(name) is not None:
+            problem.component(name).activate()
+
+
+def release(problem):
+    """Undo :func:`apply`: restore the objective of `problem` and
+    deactivate the stabilization constraints."""
+    for name in ('_Stab_Obj', '_Stab_Region', '_Stab_Bound'):
+        if problem.component(name) is not None:
+            problem.component(name).deactivate()
+    problem._stab_info['base'].activate()
+
+
+def lift(problem):
+    """Set the deviations of `problem` from its center to their smallest
+    values at the current values of the state variables (e.g. to complete a
+    starting solution)."""
+    info = getattr(problem, '_stab_info', None)
+    if info is None:
+        return
+    for (name, index), k in info['columns'].items():
+        x = problem.component(name)[index].value
+        if x is not None:
+            problem._Stab_Dev[k].set_value(
+                abs(x - value(problem._Stab_Center[k])),
+                skip_validation=True)
+
+
+def model_value(problem):
+    """Return the value of the objective of `problem` without
+    stabilization (cost and future cost) at its last solution."""
+    return value(problem._stab_info['base'].expr)
+
+
+def _build(problem, method, base, stabilized):
+    for name in ('_Stab_Obj', '_Stab_Region', '_Stab_Bound'):
+        if problem.component(name) is not None:
+            problem.del_component(name)
+    deviation = sum(problem._Stab_Dev[k] for k in stabilized)
+    if method == 'proximal':
+        problem._Stab_Obj = Objective(
+            expr=base.expr + problem._Stab_Weight * deviation,
+            sense=minimize)
+    elif method == 'trust_region':
+        problem._Stab_Region = Constraint(
+            expr=deviation <= problem._Stab_Radius)
+    else:
+        problem._Stab_Obj = Objective(expr=deviation, sense=minimize)
+        problem._Stab_Bound = Constraint(
+            expr=base.expr <= problem._Stab_Level)
+    for name in ('_Stab_Obj', '_Stab_Region', '_Stab_Bound'):
+        if problem.component(name) is not None:
+            problem.component(name).deactivate()
+
+
+def _state(tree_nc, node):
+    """Values of the state of `node` (the state variables of its
+    parent)."""
+    prev_id = node.get('prev_id')
+    if prev_id is None:
+        return np.zeros(0)
+    parent = tree_nc.return_node(prev_id)
+    return np.array([v for name in parent['state_names'] or ()
+                     for v in parent['variables'][name].values()],
+                    dtype=np.float64)
+
+
+def _same(state, other):
+    return state.shape == other.shape and np.allclose(state, other,
+                                                      rtol=1e-9, atol=1e-9)
@@ -1,22 +1,126 @@
-import jmespath
+import numpy as np
 from ndusc import node
 
+
 class Tree(object):
+    """Scenario tree.
+
+    The nodes are kept in the order given in the tree file. At construction
+    the tree builds the id -> node, stage -> nodes and parent -> children
+    indexes, so every lookup used by the decomposition is a dictionary hit,
+    and three arrays aligned with `nodes`:
+
+        - `parent`: position of the parent node (-1 for the root).
+        - `stage`: stage of the node.
+        - `probability`: (unconditional) probability of the node.
+
+    Args:
+        data_tree (:obj:`dict`): tree information, as loaded by
+            :class:`ndusc.input_module.Input_module`.
+
+    Raises:
+        ValueError: if a node id is repeated or a `prev_id` does not exist.
+    """
 
     def __init__(self, data_tree):
         self.nodes = [node.Node(n) for n in data_tree['nodes']]
-        self.stages = sorted(list(set(jmespath.search("[*].stage",
-                                                      self.nodes))))
+
+        # id -> position
+        self.position = {}
+        for k, n in enumerate(self.nodes):
+            if n['id'] in self.position:
+                raise ValueError("Repeated node id: {}".format(n['id']))
+            self.position[n['id']] = k
+
+        # stage -> nodes, parent -> children
+        self._stage_nodes = {}
+        self._children = {n['id']: [] for n in self.nodes}
+        for n in self.nodes:
+            self._stage_nodes.setdefault(n['stage'], []).append(n)
+            prev_id = n.get('prev_id')
+            if prev_id is not None:
+                if prev_id not in self._children:
+                    raise ValueError("Node {} has unknown prev_id: {}".format(
+                        n['id'], prev_id))
+                self._children[prev_id].append(n)
+        self.stages = sorted(self._stage_nodes.keys())
+
+        # Arrays
+        self.parent = np.array(
+            [-1 if n.get('prev_id') is None else self.position[n['prev_id']]
+             for n in self.nodes], dtype=np.int64)
+        self.stage = np.array([n['stage'] for n in self.nodes],
+                              dtype=np.int64)
+        self.probability = np.array(
+            [1.0 if n.get('probability') is None else n['probability']
+             for n in self.nodes], dtype=np.float64)
+
+    def return_node(self, nodeid):
+        """Return the node with id `nodeid`."""
+        return self.nodes[self.position[nodeid]]
 
     def return_stage_nodes(self, stageid):
-        return jmespath.search("[?stage==`{}`]".format(stageid),
-                               self.nodes)
+        """Return the nodes of stage `stageid`."""
+        return self._stage_nodes.get(stageid, [])
+
+    def return_previous_node(self, nodeid):
+        """Return the id of the previous (parent) node, None for the root."""
+        return self.nodes[self.position[nodeid]].get('prev_id')
+
+    def return_children(self, nodeid):
+        """Return the children nodes of `nodeid`."""
+        return self._children[nodeid]
+
+    def return_ancestors(self, nodeid):
+        """Return the ids of the path from the root to `nodeid` (included)."""
+        path = []
+        k = self.position[nodeid]
+        while k >= 0:
+            path.append(k)
+            k = self.parent[k]
+        return [self.nodes[k]['id'] for k in reversed(path)]
+
+    def conditional_probability(self):
+        """Return the probability of each node conditioned on its parent.
+
+        Return:
+            :obj:`numpy.ndarray`: array aligned with `nodes`.
+        """
+        cond = self.probability.copy()
+        has_parent = self.parent >= 0
+        cond[has_parent] /= self.probability[self.parent[has_parent]]
+        return cond
+
+    def expected_value(self, values, stageid=None):
+        """Return the expected value of `values` over the nodes of a stage.
+
+        Args:
+            values (:obj:`numpy.ndarray`): value of each node, aligned with
+                `nodes`.
+            stageid: stage to aggregate. If None, all the nodes are weighted
+                with their probability (e.g. the expected total cost of a
+                tree when `values` are the stage costs).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if stageid is None:
+            return float(np.dot(self.probability, values))
+        mask = self.stage == stageid
+        return float(np.dot(self.probability[mask], values[mask]))
+
+    def children_expected_value(self, values):
+        """Return, for every node, the conditional expectation of `values`
+        over its children (0 for the leaves).
 
-    def return_previous_node(self, previd):
-        """Retrun previous node id.
+        Args:
+            values (:obj:`numpy.ndarray`): value of each node, aligned with
+                `nodes`.
 
-        Todo:
-            Exception unique parent node
+        Return:
+            :obj:`numpy.ndarray`: array aligned with `nodes`.
         """
-        return jmespath.search("[?id==`{}`].prev_id".format(previd),
-                                self.nodes)
+        values = np.asarray(values, dtype=np.float64)
+        has_parent = self.parent >= 0
+        return np.bincount(self.parent[has_parent],
+                           weights=(self.conditional_probability()
+                                    * values)[has_parent],
+                           minlength=len(self.nodes))
@@ -1,49 +1,113 @@
-def update_tree(tree, results, key):
-    """Update main_data[key] with information of new_data[key].
+from collections import ChainMap
+from collections.abc import Mapping
+
+
+class Layered_data(Mapping):
+    """Read only view of the data of a node.
+
+    The data of a node is built from layers, from the lowest to the highest
+    priority: the global data, the overrides of its ancestors, its own
+    overrides and, when its model is built, the incoming state. Looking up a
+    key returns the value of the highest layer that has it, except for
+    dictionaries (e.g. `params` and `sets`), which are merged one level
+    deep, also in a :class:`collections.ChainMap` view. No layer is copied
+    or modified, and the resolved values are cached.
+
+    Args:
+        layers (:obj:`list`): dictionaries, lowest priority first.
     """
-    
-    data = dict(main_data)
-    
-    if key in new_data.keys():
-        if new_data[key]:
-            if key in data.keys():
-                data[key].update(new_data[key])
-            else:
-                data[key] = new_data[key]
-    
-    return(data)
 
+    def __init__(self, layers):
+        self.layers = [layer for layer in layers if layer]
+        self._resolved = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        values = [layer[key] for layer in reversed(self.layers)
+                  if key in layer]
+        if not values:
+            raise KeyError(key)
+        dicts = [v for v in values if isinstance(v, Mapping)]
+        if dicts and all(v is None or isinstance(v, Mapping)
+                         for v in values):
+            value = dicts[0] if len(dicts) == 1 else ChainMap(*dicts)
+        else:
+            value = values[0]
+        self._resolved[key] = value
+        return value
+
+    def __iter__(self):
+        keys = {}
+        for layer in self.layers:
+            keys.update(dict.fromkeys(layer))
+        return iter(keys)
+
+    def __len__(self):
+        return len(set().union(*self.layers)) if self.layers else 0
+
+    def with_state(self, state):
+        """Return the view with `state` as the top `params` layer."""
+        if not state:
+            return self
+        return Layered_data(self.layers + [{'params': state}])
+
+
+class Node_data(object):
+    """Per-node cache of the :class:`Layered_data` of the nodes.
 
-def node_data(node, data):
-    """Get data information from the node
-    
     Args:
-        node (:obj:`dict`): node information. 
         data (:obj:`dict`): dictionary with problem data.
+        nodes (:obj:`dict`): id -> node of the nodes whose overrides are
+            inherited (the tree). The ancestors missing in it are skipped.
     """
-    
-    data = update_data(data, node, 'params')
-    data = update_data(data, node, 'sets')
-    return data
 
+    def __init__(self, data, nodes=None):
+        self.data = data or {}
+        self.nodes = nodes if nodes is not None else {}
+        self._layers = {}
+        self._views = {}
+
+    def __call__(self, node):
+        """Return the data of `node`."""
+        view = self._views.get(node['id'])
+        if view is None:
+            view = self._views[node['id']] = Layered_data(self.layers(node))
+        return view
+
+    def layers(self, node):
+        """Return the data layers of `node`, lowest priority first."""
+        layers = self._layers.get(node['id'])
+        if layers is not None:
+            return layers
+        parent = self.nodes.get(node.get('prev_id'))
+        if parent is None:
+            layers = [self.data]
+        else:
+            layers = self.layers(parent)
+        layer = node_layer(node)
+        if layer:
+            layers = layers + [layer]
+        self._layers[node['id']] = layers
+        return layers
 
-def update_data(main_data, new_data, key):
-    """Update main_data[key] with information of new_data[key].
-    """
-    
-    data = dict(main_data)
-    
-    if key in new_data.keys():
-        if new_data[key]:
-            if key in data.keys():
-                data[key].update(new_data[key])
-            else:
-                data[key] = new_data[key]
-    
-    return(data)
 
+def node_layer(node):
+    """Return the overrides of `node` (its `params` and `sets`)."""
+    return {key: node[key] for key in ('params', 'sets') if node.get(key)}
 
 
+def node_data(node, data):
+    """Get data information from the node
 
+    The node `params` and `sets` override those of `data`, without copying
+    or modifying it (see :class:`Layered_data`).
 
+    Args:
+        node (:obj:`dict`): node information.
+        data (:obj:`dict`): dictionary with problem data.
+    """
 
+    return Layered_data([data, node_layer(node)])
@@ -0,0 +1,86 @@
+"""Fixtures of the tests: the bundled examples and the extensive form of a
+tree, solved directly to check the bounds of the decomposition."""
+
+import os
+import sys
+
+import pytest
+import pyomo.environ as pyenv
+from pyomo.core.expr.visitor import replace_expressions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import generators  # noqa: E402
+from ndusc import input_module  # noqa: E402
+from ndusc import model  # noqa: E402
+from ndusc import tree  # noqa: E402
+
+SOLVER = 'appsi_highs'
+
+
+@pytest.fixture(autouse=True)
+def root(monkeypatch):
+    """Run the tests from the root, where the model files of the bundled
+    trees are found."""
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture
+def solver():
+    """Name of the solver of the tests (skipped without HiGHS)."""
+    pytest.importorskip('highspy')
+    return SOLVER
+
+
+def bundled(directory):
+    """Tree and data of the example in `directory`."""
+    loader = input_module.Input_module(
+        os.path.join(ROOT, directory, 'data.yaml'),
+        os.path.join(ROOT, directory, 'tree.yaml'))
+    return loader.load_tree(), loader.load_data()
+
+
+def production(branching=3, stages=4):
+    """Tree and data of a generated production example."""
+    return (generators.production_tree(branching, stages, demands=(0, 6)),
+            generators.production_data(3))
+
+
+def extensive_form(tree_data, data, solver=SOLVER):
+    """Return the optimal value of the extensive form of the tree: the
+    problems of all the nodes in one model, with the linking parameters of
+    each node replaced by the variables of its parent and the objectives
+    weighted by the probabilities."""
+    tree_nc = tree.Tree(tree_data)
+    nodes = {node['id']: node for node in tree_nc.nodes}
+    models = model.Persistent_models(data, solver, shared=False,
+                                     nodes=nodes)
+    ef = pyenv.ConcreteModel()
+    objective = 0
+    for node in tree_nc.nodes:
+        parent = None
+        state = {}
+        if node['prev_id'] is not None:
+            parent = ef.component('node{}'.format(node['prev_id']))
+            state = {v.local_name: {index: 0.0 for index in v}
+                     for v in parent.component_objects(pyenv.Var)}
+        problem = models.problem(node, state)
+        ef.add_component('node{}'.format(node['id']), problem)
+        for obj in problem.component_data_objects(pyenv.Objective):
+            objective += tree_nc.probability[
+                tree_nc.position[node['id']]] * obj.expr
+            obj.deactivate()
+        if parent is None:
+            continue
+        params = model.linking_params(problem, state,
+                                      node['model'].get('linking'))
+        substitute = {}
+        for name, param in params.items():
+            for index in param:
+                substitute[id(param[index])] = parent.component(name)[index]
+        for c in problem.component_data_objects(pyenv.Constraint):
+            c.set_value(replace_expressions(c.expr, substitute))
+    ef.objective = pyenv.Objective(expr=objective)
+    pyenv.SolverFactory(solver).solve(ef)
+    return pyenv.value(ef.objective)
@@ -29,9 +29,9 @@ def model_S2(data):
     m.cost = Param(initialize=data['params']['cost'])
     m.high_cost = Param(initialize=data['params']['high_cost'])
     m.store_cost = Param(initialize=data['params']['store_cost'])
-    m.demand = Param(initialize=data['params']['demand'])
+    m.demand = Param(initialize=data['params']['demand'], mutable=True)
 
-    m.y_prev = Param(initialize=data['params']['y'])
+    m.y_prev = Param(initialize=data['params']['y'], mutable=True)
     #
     # Variables
     #
@@ -0,0 +1,88 @@
+"""Checkpoint and resume of nested decomposition runs."""
+
+import json
+import os
+
+import pytest
+
+from conftest import extensive_form, production
+from ndusc import checkpoint, nd
+
+
+@pytest.fixture(scope='module')
+def production_optimum():
+    return extensive_form(*production())
+
+
+def resume(how, path, tree_data, data, **kwargs):
+    if how == 'checkpoint_path':
+        return nd.nested_decomposition(tree_data, data, checkpoint_path=path,
+                                       resume=True, **kwargs)
+    if how == 'warm_start':
+        return nd.nested_decomposition(tree_data, data, warm_start=path,
+                                       checkpoint_path=path, resume=True,
+                                       **kwargs)
+    return checkpoint.resume(path, data, **kwargs)
+
+
+@pytest.mark.parametrize('how', ['checkpoint_path', 'warm_start',
+                                 'checkpoint.resume'])
+@pytest.mark.parametrize('cut_mode', ['single', 'hybrid'])
+def test_resume(solver, tmp_path, production_optimum, how, cut_mode):
+    """A resumed run starts from the saved iterations, counters and bounds,
+    and goes on as the run that was not stopped."""
+    tree_data, data = production()
+    options = {'solver': solver, 'cut_mode': cut_mode, 'cut_clusters': 2}
+    whole = nd.nested_decomposition(tree_data, data, **options)
+
+    path = str(tmp_path / 'run.ckpt')
+    first = nd.nested_decomposition(tree_data, data, max_iter=2,
+                                    checkpoint_path=path, **options)
+    assert first['status'] == 'max_iter'
+    saved = checkpoint.load(path)
+    assert saved['output']['iterations'] == 2
+
+    log_path = str(tmp_path / 'log')
+    output = resume(how, path, tree_data, data, output_path=log_path,
+                    **options)
+    with open(os.path.join(log_path, 'convergence.jsonl')) as log_file:
+        iterations = [record for record in map(json.loads, log_file)
+                      if record['event'] == 'iteration']
+    # The run starts from the state of the checkpoint
+    start = iterations[0]
+    assert start['iteration'] == 2
+    assert start['solves'] == saved['output']['solves']
+    assert start['lower_bound'] == saved['output']['lower_bound']
+    assert start['upper_bound'] == saved['output']['upper_bound']
+    assert iterations[1]['iteration'] == 3
+
+    history = checkpoint.load(path)['history']
+    assert history[:2] == saved['history']
+    assert [entry[0] for entry in history] == \
+        list(range(1, output['iterations'] + 1))
+    for key in ('iterations', 'solves', 'lower_bound', 'upper_bound'):
+        assert output[key] == pytest.approx(whole[key])
+    assert output['lower_bound'] == pytest.approx(production_optimum,
+                                                  rel=1e-6)
+
+
+def test_resume_hybrid_groups(solver, tmp_path, production_optimum):
+    """The clusters of the hybrid mode are restored with the cuts, so each
+    future cost keeps bounding the children of its cuts."""
+    tree_data, data = production()
+    path = str(tmp_path / 'run.ckpt')
+    first = nd.nested_decomposition(tree_data, data, solver=solver,
+                                    max_iter=1, cut_mode='hybrid',
+                                    cut_clusters=2, checkpoint_path=path)
+    output = nd.nested_decomposition(tree_data, data, solver=solver,
+                                     cut_mode='hybrid', cut_clusters=2,
+                                     warm_start=path, resume=True)
+    for node, resumed in zip(first['tree'].nodes, output['tree'].nodes):
+        assert resumed.get('cut_groups') == node.get('cut_groups')
+    assert output['lower_bound'] == pytest.approx(production_optimum,
+                                                  rel=1e-6)
+
+
+def test_resume_needs_checkpoint():
+    with pytest.raises(ValueError):
+        nd.nested_decomposition(*production(), resume=True)
@@ -0,0 +1,89 @@
+"""Messages between the distributed executor and its workers."""
+
+import logging
+
+import numpy as np
+import pytest
+
+from conftest import bundled, extensive_form, production
+from ndusc import checkpoint, distributed, nd, parallel
+
+
+def test_round_trip():
+    value = {'status': 'ok', 'value': 1.5, 'id': 2 ** 70, 'missing': None,
+             'flags': [True, False], 'key': (1, 'y'), 'raw': b'\x00\x01',
+             'duals': {('c', 1): -2.0, ('c', None): np.float64(0.25)},
+             'x': np.arange(6.0).reshape(2, 3)}
+    decoded = distributed.decode(distributed.encode(value))
+    x = decoded.pop('x')
+    assert np.array_equal(x, value.pop('x'))
+    value['duals'][('c', None)] = 0.25
+    assert decoded == value
+
+
+def test_unsupported_type():
+    with pytest.raises(TypeError):
+        distributed.encode({'value': object()})
+
+
+def test_error_keeps_cuts(solver):
+    """The cuts sent with a batch reach the worker even if a task before
+    them fails."""
+    tree_data, data = bundled('tests/test1')
+    tree_nc = nd.nested_decomposition(tree_data, data, solver=solver)['tree']
+    nodes = {node['id']: node for node in tree_nc.nodes}
+    state = {'y': {None: 0.0}}
+    serial = parallel.create_executor('serial', tree_nc, data, solver)
+    expected = serial.solve([(nodes[3], state, False, None)])[0]['value']
+    serial.close()
+
+    # Nodes 7 and 3 are in the same subtree
+    pool = parallel.create_executor('distributed', tree_nc, data, solver,
+                                    True, 2)
+    try:
+        with pytest.raises(RuntimeError):
+            pool.solve([(nodes[7], {'y': {None: 'bad'}}, False, None),
+                        (nodes[3], state, False, None)])
+        output = pool.solve([(nodes[3], state, False, None)])
+        assert output[0]['value'] == pytest.approx(expected)
+    finally:
+        pool.close()
+
+
+class Kill_worker(checkpoint.Checkpoint):
+    """Checkpoints that kill a worker at the end of an iteration."""
+
+    def __init__(self, path, process, iteration):
+        super(Kill_worker, self).__init__(path)
+        self.process = process
+        self.kill_iteration = iteration
+
+    def iteration(self, output, tree_nc):
+        super(Kill_worker, self).iteration(output, tree_nc)
+        if output['iterations'] == self.kill_iteration:
+            self.process.kill()
+            self.process.wait()
+
+
+def test_lost_worker(solver, tmp_path, caplog):
+    """The subtrees of a worker lost during the run are solved by the
+    others, and the run reaches the optimum of the extensive form."""
+    tree_data, data = production()
+    optimum = extensive_form(tree_data, data)
+    workers = distributed.start_local_workers(3)
+    try:
+        monitor = Kill_worker(str(tmp_path / 'run.ckpt'), workers[1][0], 2)
+        with caplog.at_level(logging.WARNING):
+            output = nd.nested_decomposition(
+                tree_data, data, solver=solver, executor='distributed',
+                workers=[address for process, address in workers],
+                checkpoint_path=monitor)
+    finally:
+        for process, address in workers:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+    assert 'Lost worker {}'.format(workers[1][1]) in caplog.text
+    assert output['status'] == 'optimal'
+    assert output['lower_bound'] == pytest.approx(optimum, rel=1e-6)
+    assert output['upper_bound'] == pytest.approx(optimum, rel=1e-6)
@@ -0,0 +1,40 @@
+"""Columnar npy format of the trees."""
+
+import os
+
+import pytest
+import yaml
+
+from conftest import ROOT
+from ndusc import input_module
+
+
+@pytest.mark.parametrize('directory', ['tests/test1', 'data'])
+def test_npy_round_trip(tmp_path, directory):
+    source = input_module.Input_module(
+        os.path.join(ROOT, directory, 'data.yaml'),
+        os.path.join(ROOT, directory, 'tree.yaml'))
+    source.convert(str(tmp_path / 'data'), str(tmp_path / 'tree'))
+    converted = input_module.Input_module(str(tmp_path / 'data'),
+                                          str(tmp_path / 'tree'),
+                                          format='npy')
+    assert converted.load_tree() == source.load_tree()
+    assert converted.load_data() == source.load_data()
+
+
+def test_npy_default_probability(tmp_path):
+    with open(os.path.join(ROOT, 'tests', 'test1', 'tree.yaml')) as stream:
+        tree_data = yaml.safe_load(stream)
+    del tree_data['nodes'][0]['probability']
+    with open(tmp_path / 'tree.yaml', 'w') as stream:
+        yaml.safe_dump(tree_data, stream)
+    source = input_module.Input_module(
+        os.path.join(ROOT, 'tests', 'test1', 'data.yaml'),
+        str(tmp_path / 'tree.yaml'))
+    source.convert(str(tmp_path / 'data'), str(tmp_path / 'tree'))
+    nodes = input_module.Input_module(str(tmp_path / 'data'),
+                                      str(tmp_path / 'tree'),
+                                      format='npy').load_tree()['nodes']
+    assert nodes[0]['probability'] == 1.0
+    assert [node['id'] for node in nodes] == \
+        [node['id'] for node in tree_data['nodes']]
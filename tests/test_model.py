@@ -0,0 +1,31 @@
+"""Models of the nodes shared by the nodes of a stage."""
+
+import logging
+import os
+import shutil
+
+import pytest
+
+from conftest import ROOT, bundled
+from ndusc import nd
+
+
+def test_build_time_params_not_shared(solver, tmp_path, caplog):
+    """A model that uses the values of the scenario parameters when it is
+    built is not shared, so each node keeps its own values."""
+    shutil.copytree(os.path.join(ROOT, 'tests', 'test1'), tmp_path,
+                    dirs_exist_ok=True)
+    source = (tmp_path / 'model_S2.py').read_text()
+    (tmp_path / 'model_S2.py').write_text(source.replace(
+        '\n    return m\n',
+        "\n    m.cap = Constraint(expr=m.w <= data['params']['demand'])\n"
+        '    return m\n'))
+    tree_data, data = bundled('tests/test1')
+    for node in tree_data['nodes']:
+        node['model']['file'] = node['model']['file'].replace(
+            'tests/test1', str(tmp_path))
+    with caplog.at_level(logging.WARNING):
+        output = nd.nested_decomposition(tree_data, data, solver=solver)
+    assert 'its problem is not shared' in caplog.text
+    assert output['status'] == 'optimal'
+    assert output['lower_bound'] == pytest.approx(5.0, rel=1e-6)
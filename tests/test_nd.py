@@ -0,0 +1,97 @@
+"""Nested decomposition reaches the optimum of the extensive form."""
+
+import pytest
+
+from conftest import bundled, extensive_form, production
+from ndusc import cuts, matrix, nd
+from ndusc import stabilization
+
+
+def assert_optimal(output, optimum):
+    assert output['status'] == 'optimal'
+    assert output['lower_bound'] == pytest.approx(optimum, rel=1e-6)
+    assert output['upper_bound'] == pytest.approx(optimum, rel=1e-6)
+
+
+@pytest.fixture(scope='module')
+def production_optimum():
+    return extensive_form(*production())
+
+
+@pytest.mark.parametrize('cut_mode', cuts.cut_modes)
+@pytest.mark.parametrize('protocol', nd.protocols)
+def test_test1(solver, cut_mode, protocol):
+    output = nd.nested_decomposition(*bundled('tests/test1'), solver=solver,
+                                     cut_mode=cut_mode, protocol=protocol)
+    assert_optimal(output, 5.0)
+
+
+def test_production_extensive_form(production_optimum):
+    assert production_optimum == pytest.approx(18.185185185185183)
+
+
+@pytest.mark.parametrize('persistent', [True, False])
+def test_production_persistent(solver, production_optimum, persistent):
+    output = nd.nested_decomposition(*production(), solver=solver,
+                                     persistent=persistent)
+    assert_optimal(output, production_optimum)
+
+
+@pytest.mark.parametrize('executor', ['serial', 'threads', 'processes',
+                                      'distributed'])
+def test_production_executors(solver, production_optimum, executor):
+    output = nd.nested_decomposition(*production(), solver=solver,
+                                     executor=executor, workers=2)
+    assert_optimal(output, production_optimum)
+
+
+def test_production_async(solver, production_optimum):
+    output = nd.nested_decomposition(*production(), solver=solver,
+                                     schedule='async', executor='threads',
+                                     workers=2)
+    assert_optimal(output, production_optimum)
+
+
+@pytest.mark.parametrize('method', stabilization.methods)
+def test_production_stabilization(solver, production_optimum, method):
+    output = nd.nested_decomposition(
+        *production(), solver=solver,
+        stabilize=stabilization.Stabilizer(method))
+    assert_optimal(output, production_optimum)
+
+
+@pytest.mark.parametrize('hot_start', [False, True])
+def test_same_result_for_any_workers(solver, hot_start):
+    runs = [nd.nested_decomposition(*production(), solver=solver,
+                                    executor=executor, workers=workers,
+                                    hot_start=hot_start)
+            for executor, workers in [('serial', 1), ('processes', 1),
+                                      ('processes', 3), ('threads', 2)]]
+    assert len(set((run['iterations'], run['solves'])
+                   for run in runs)) == 1
+
+
+@pytest.mark.parametrize('cut_family', ['integer', 'lagrangian'])
+def test_wildfire_cut_families(solver, cut_family):
+    tree_data, data = bundled('data')
+    optimum = extensive_form(tree_data, data)
+    output = nd.nested_decomposition(tree_data, data, solver=solver,
+                                     max_iter=200, cut_family=cut_family)
+    assert_optimal(output, optimum)
+
+
+@pytest.mark.parametrize('executor', ['serial', 'threads', 'processes',
+                                      'distributed'])
+def test_production_matrix(solver, production_optimum, executor):
+    output = nd.nested_decomposition(*production(), solver=solver,
+                                     executor=executor, workers=2,
+                                     backend='matrix')
+    assert_optimal(output, production_optimum)
+
+
+def test_production_matrix_through_scipy(solver, production_optimum,
+                                         monkeypatch):
+    monkeypatch.setattr(matrix.Matrix_problem, '_solver', lambda self: None)
+    output = nd.nested_decomposition(*production(), solver=solver,
+                                     backend='matrix')
+    assert_optimal(output, production_optimum)
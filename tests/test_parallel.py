@@ -0,0 +1,58 @@
+"""Executors of the node solves."""
+
+import pytest
+
+from conftest import bundled
+from ndusc import nd, parallel
+
+
+@pytest.fixture
+def solved(solver):
+    """Tree of test1 with the cuts of a finished run, and its data."""
+    tree_data, data = bundled('tests/test1')
+    output = nd.nested_decomposition(tree_data, data, solver=solver)
+    return output['tree'], data
+
+
+def test_process_error_keeps_replies_in_order(solver, solved):
+    """After a worker fails, the replies of the other workers to the same
+    call are not left for the next call."""
+    tree_nc, data = solved
+    nodes = {node['id']: node for node in tree_nc.nodes}
+    pool = parallel.create_executor('processes', tree_nc, data, solver, True,
+                                    2)
+    try:
+        state = {'y': {None: 1.0}}
+        with pytest.raises(RuntimeError):
+            pool.solve([(nodes[2], state, False, None),
+                        (nodes[7], {'y': {None: 'bad'}}, False, None)])
+        state = {'y': {None: 2.0}}
+        output = pool.solve([(nodes[4], state, False, None),
+                             (nodes[7], state, False, None)])
+        assert [result['value'] for result in output] == \
+            pytest.approx([0.5, 1.0])
+    finally:
+        pool.close()
+
+
+def test_process_error_keeps_cuts(solver, solved):
+    """The cuts sent with a batch reach the worker even if a task before
+    them fails."""
+    tree_nc, data = solved
+    nodes = {node['id']: node for node in tree_nc.nodes}
+    state = {'y': {None: 0.0}}
+    serial = parallel.create_executor('serial', tree_nc, data, solver)
+    expected = serial.solve([(nodes[3], state, False, None)])[0]['value']
+    serial.close()
+
+    # Nodes 7 and 3 are solved by the same worker
+    pool = parallel.create_executor('processes', tree_nc, data, solver, True,
+                                    2)
+    try:
+        with pytest.raises(RuntimeError):
+            pool.solve([(nodes[7], {'y': {None: 'bad'}}, False, None),
+                        (nodes[3], state, False, None)])
+        output = pool.solve([(nodes[3], state, False, None)])
+        assert output[0]['value'] == pytest.approx(expected)
+    finally:
+        pool.close()
@@ -0,0 +1,33 @@
+"""Scenario tree reduction."""
+
+import numpy as np
+import pytest
+
+from benchmarks import generators
+from ndusc import reduction, tree
+
+
+@pytest.mark.parametrize('method', reduction.methods)
+@pytest.mark.parametrize('scenarios', [1, 5, 20])
+def test_reduction_keeps_probability(method, scenarios):
+    tree_nc = tree.Tree(generators.production_tree(3, 4))
+    reduced = reduction.reduce_tree(tree_nc, method, scenarios=scenarios)
+    new_tree = reduced['tree']
+    assert len(reduced['scenarios']) == scenarios
+    for stage in new_tree.stages:
+        probability = sum(node['probability']
+                          for node in new_tree.return_stage_nodes(stage))
+        assert probability == pytest.approx(1.0)
+    leaves, paths = reduction.scenario_paths(new_tree)
+    assert sorted(leaves) == sorted(reduced['scenarios'])
+
+
+def test_reduction_without_loss():
+    tree_nc = tree.Tree(generators.production_tree(3, 3))
+    leaves, paths = reduction.scenario_paths(tree_nc)
+    reduced = reduction.reduce_tree(tree_nc, 'backward',
+                                    scenarios=len(leaves))
+    assert reduced['distance'] == 0.0
+    assert np.allclose(sorted(node['probability']
+                              for node in reduced['tree'].nodes),
+                       sorted(node['probability'] for node in tree_nc.nodes))
@@ -0,0 +1,55 @@
+"""SDDP on the stagewise independent example of test1."""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+import yaml
+
+from conftest import ROOT
+from ndusc import input_module, sddp
+
+
+def load(directory):
+    data = input_module.Input_module(
+        os.path.join(directory, 'data.yaml'),
+        os.path.join(directory, 'tree.yaml')).load_data()
+    with open(os.path.join(directory, 'stages.yaml')) as stream:
+        return yaml.safe_load(stream), data
+
+
+@pytest.mark.parametrize('cut_mode', ['single', 'multi'])
+def test_test1(solver, cut_mode):
+    stages_data, data = load(os.path.join(ROOT, 'tests', 'test1'))
+    output = sddp.sddp(stages_data, data, solver=solver, cut_mode=cut_mode,
+                       seed=0)
+    assert output['status'] == 'optimal'
+    assert output['lower_bound'] == pytest.approx(5.0, rel=1e-6)
+
+
+def test_infeasible_path(solver, tmp_path):
+    """A sampled path that reaches an infeasible node gives an infinite
+    upper bound, and the run goes on until the feasibility cuts remove
+    it."""
+    shutil.copytree(os.path.join(ROOT, 'tests', 'test1'), tmp_path,
+                    dirs_exist_ok=True)
+    source = (tmp_path / 'model_S3.py').read_text()
+    (tmp_path / 'model_S3.py').write_text(source.replace(
+        'm.w = Var(within=PositiveReals)',
+        'm.w = Var(within=PositiveReals, bounds=(0, 0))'))
+    stages_data, data = load(str(tmp_path))
+    for stage in stages_data['stages']:
+        stage['model']['file'] = stage['model']['file'].replace(
+            'tests/test1', str(tmp_path))
+    # The last stage must use the storage of the second one
+    last = stages_data['stages'][2]
+    last['params'] = {'prod': 2}
+    last['outcomes'][1]['params']['demand'] = 4
+
+    first = sddp.sddp(stages_data, data, solver=solver, max_iter=1, seed=0)
+    assert first['upper_bound'] == np.inf
+    assert first['confidence_interval'] == (-np.inf, np.inf)
+    output = sddp.sddp(stages_data, data, solver=solver, seed=0)
+    assert output['status'] == 'optimal'
+    assert np.isfinite(output['upper_bound'])